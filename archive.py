@@ -0,0 +1,288 @@
+'''Append-only on-disk archive of periodic dumps, for history beyond the daemon's hour of counters
+and its reservoirs. Archive a dump at the end of every minute (see archive_forever); the reader then
+answers per minute counter and per hour sampler queries over days of dumps by memory-mapping the
+file and reading only the columns of the variable asked for.
+
+File layout, all little-endian:
+  "VARZARC1"
+  frames, one per dump, each:
+    header: "FRAM", body_len uint64, dump_time_sec int64, num_new_names, num_counters,
+        num_samplers, num_samples (uint32 each), 4 pad bytes
+    body: new names appended to the file-wide name dictionary (uint16 length + utf-8 each), then
+        the fixed-width columns below, each starting on an 8 byte boundary. Rows are sorted by name
+        id and times are stored as int32 deltas from dump_time_sec.
+      counter_ids int32[C], counter_latest_deltas int32[C], counter_all_time int64[C],
+      counter_minutes int64[C * 60]
+      sampler_ids int32[S], sampler_latest_deltas int32[S], sampler_num_events int64[S],
+      sample_offsets int64[S + 1], sample_values int64[N], sample_time_deltas int32[N]
+Samplers keep their last minute samples. The daemon starts a new last minute reservoir with the
+first event of each minute, so only a frame dumped in the last second of its sampler's latest
+minute, or later, holds that whole minute; sampler queries ignore the other frames. A frame cut
+short by a crash is ignored.'''
+import bisect
+import mmap
+import os
+import struct
+import time
+
+import numpy
+
+import stats
+import utils
+
+MAGIC = "VARZARC1"
+FRAME_MAGIC = "FRAM"
+FRAME_HEADER = struct.Struct("<4sQqIIII4x")
+NAME_LENGTH = struct.Struct("<H")
+EMPTY_SAMPLES = {"sample_values": [], "sample_times_sec": [], "samples_size": 0, "num_events": 0}
+# Seconds into each minute archive_forever dumps at, late enough for the frame to cover the minute
+DUMP_SEC_OF_MINUTE = 59.5
+
+
+def _padding(length):
+  return -length % 8
+
+
+def _column_layout(num_counters, num_samplers, num_samples):
+  '''Returns: [(column name, dtype, count)] in file order'''
+  return [("counter_ids", numpy.int32, num_counters),
+          ("counter_latest_deltas", numpy.int32, num_counters),
+          ("counter_all_time", numpy.int64, num_counters),
+          ("counter_minutes", numpy.int64, num_counters * 60),
+          ("sampler_ids", numpy.int32, num_samplers),
+          ("sampler_latest_deltas", numpy.int32, num_samplers),
+          ("sampler_num_events", numpy.int64, num_samplers),
+          ("sample_offsets", numpy.int64, num_samplers + 1),
+          ("sample_values", numpy.int64, num_samples),
+          ("sample_time_deltas", numpy.int32, num_samples)]
+
+
+class ArchiveWriter(object):
+  '''Appends dumps to an archive file, creating it if needed'''
+
+  def __init__(self, path):
+    self.path = path
+    self.name_ids = {}
+    if os.path.exists(path) and os.path.getsize(path):
+      reader = ArchiveReader(path)
+      self.name_ids = dict(reader.name_ids)
+      valid_length = reader.valid_length
+      reader.close()
+      self.file = open(path, "r+b")
+      # Drop a frame left incomplete by a crash so appends stay readable
+      self.file.truncate(valid_length)
+      self.file.seek(valid_length)
+    else:
+      self.file = open(path, "wb")
+      self.file.write(MAGIC)
+      self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+  def append(self, dump, dump_time_sec=None):
+    '''Write one dump, as returned by VARZClient.all_dump, as a frame
+    Arguments
+      dump_time_sec (optional): When the dump was taken, defaults to now'''
+    if dump_time_sec is None:
+      dump_time_sec = utils.sec_since_epoch_now()
+    new_names = []
+    def name_id(name):
+      if name not in self.name_ids:
+        self.name_ids[name] = len(self.name_ids)
+        new_names.append(name)
+      return self.name_ids[name]
+    counters = sorted((name_id(c["name"]), c["value"]) for c in dump.get("mht_counters", []))
+    samplers = sorted((name_id(s["name"]), s["value"]) for s in dump.get("mht_samplers", []))
+    minute_sets = [value.get("last_minute_samples", EMPTY_SAMPLES) for _, value in samplers]
+    sample_counts = [len(s["sample_values"]) for s in minute_sets]
+    columns = {
+        "counter_ids": [i for i, _ in counters],
+        "counter_latest_deltas": [v["latest_time_sec"] - dump_time_sec for _, v in counters],
+        "counter_all_time": [v["all_time_count"] for _, v in counters],
+        "counter_minutes": [n for _, v in counters for n in v["min_counters"]],
+        "sampler_ids": [i for i, _ in samplers],
+        "sampler_latest_deltas": [v["latest_time_sec"] - dump_time_sec for _, v in samplers],
+        "sampler_num_events": [s["num_events"] for s in minute_sets],
+        "sample_offsets": numpy.concatenate([[0], numpy.cumsum(sample_counts)]),
+        "sample_values": [x for s in minute_sets for x in s["sample_values"]],
+        "sample_time_deltas": [t - dump_time_sec for s in minute_sets for t in s["sample_times_sec"]]}
+    body = []
+    for name in new_names:
+      encoded = name.encode("utf-8")
+      body.append(NAME_LENGTH.pack(len(encoded)) + encoded)
+    body.append("\0" * _padding(sum(len(chunk) for chunk in body)))
+    for column, dtype, count in _column_layout(len(counters), len(samplers), sum(sample_counts)):
+      data = numpy.asarray(columns[column], dtype=dtype).astype("<" + numpy.dtype(dtype).str[1:])
+      body.append(data.tostring() + "\0" * _padding(data.nbytes))
+    body = "".join(body)
+    header = FRAME_HEADER.pack(FRAME_MAGIC, len(body), dump_time_sec, len(new_names),
+                               len(counters), len(samplers), sum(sample_counts))
+    # One write per frame, so a reader sees either all of it or a short frame it skips
+    self.file.write(header + body)
+    self.file.flush()
+
+
+class _Frame(object):
+  __slots__ = ("dump_time_sec", "columns")
+
+
+class ArchiveReader(object):
+  '''Memory-maps an archive. Opening it only reads frame headers and the name dictionary; queries
+     read the columns of the frames and rows they need, as numpy views of the mapping.'''
+
+  def __init__(self, path):
+    self.file = open(path, "rb")
+    size = os.fstat(self.file.fileno()).st_size
+    self.mmap = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ) if size else ""
+    if self.mmap[:len(MAGIC)] != MAGIC:
+      raise ValueError("%s is not a varz archive" % path)
+    self.names = []
+    self.name_ids = {}
+    self.frames = []
+    offset = len(MAGIC)
+    while offset + FRAME_HEADER.size <= size:
+      (magic, body_len, dump_time_sec, num_new_names, num_counters, num_samplers,
+       num_samples) = FRAME_HEADER.unpack_from(self.mmap, offset)
+      body_start = offset + FRAME_HEADER.size
+      if magic != FRAME_MAGIC or body_start + body_len > size:
+        break
+      self._read_frame(body_start, dump_time_sec, num_new_names, num_counters, num_samplers,
+                       num_samples)
+      offset = body_start + body_len
+    # Where the last complete frame ends
+    self.valid_length = offset
+    self.frames.sort(key=lambda frame: frame.dump_time_sec)
+    self.frame_times = [frame.dump_time_sec for frame in self.frames]
+
+  def close(self):
+    if self.mmap:
+      self.mmap.close()
+    self.file.close()
+
+  def _read_frame(self, offset, dump_time_sec, num_new_names, num_counters, num_samplers,
+                  num_samples):
+    names_start = offset
+    for i in xrange(num_new_names):
+      length, = NAME_LENGTH.unpack_from(self.mmap, offset)
+      offset += NAME_LENGTH.size
+      name = self.mmap[offset:offset + length].decode("utf-8")
+      self.name_ids[name] = len(self.names)
+      self.names.append(name)
+      offset += length
+    offset += _padding(offset - names_start)
+    frame = _Frame()
+    frame.dump_time_sec = dump_time_sec
+    frame.columns = {}
+    for column, dtype, count in _column_layout(num_counters, num_samplers, num_samples):
+      dtype = numpy.dtype(dtype).newbyteorder("<")
+      frame.columns[column] = (offset, dtype, count)
+      offset += dtype.itemsize * count
+      offset += _padding(dtype.itemsize * count)
+    self.frames.append(frame)
+
+  def _column(self, frame, column, start=0, stop=None):
+    offset, dtype, count = frame.columns[column]
+    stop = count if stop is None else stop
+    return numpy.frombuffer(self.mmap, dtype, stop - start, offset + start * dtype.itemsize)
+
+  def _row(self, frame, kind, name_id):
+    '''Returns: the row of name_id in the kind ("counter" or "sampler") columns of frame, or None'''
+    ids = self._column(frame, kind + "_ids")
+    row = numpy.searchsorted(ids, name_id)
+    if row < len(ids) and ids[row] == name_id:
+      return int(row)
+    return None
+
+  def _frames_between(self, start_sec, end_sec):
+    return self.frames[bisect.bisect_left(self.frame_times, start_sec):
+                       bisect.bisect_right(self.frame_times, end_sec)]
+
+  def counter_per_minute(self, name, start_sec, end_sec):
+    '''Returns: [(minute start sec, count)] for each minute in [start_sec, end_sec] some frame has
+        data for, oldest first. A minute's count comes from the latest frame holding it.'''
+    minutes = {}
+    name_id = self.name_ids.get(name)
+    if name_id is None:
+      return []
+    start_min = utils.epoch_sec_to_minutes_since_epoch(start_sec)
+    end_min = utils.epoch_sec_to_minutes_since_epoch(end_sec)
+    # A frame holds the hour before it was taken
+    for frame in self._frames_between(start_sec, end_sec + 3600):
+      row = self._row(frame, "counter", name_id)
+      if row is None:
+        continue
+      latest_time_sec = frame.dump_time_sec + int(self._column(frame, "counter_latest_deltas",
+                                                               row, row + 1)[0])
+      latest_min = utils.epoch_sec_to_minutes_since_epoch(latest_time_sec)
+      slots = self._column(frame, "counter_minutes", row * 60, row * 60 + 60).tolist()
+      for slot in xrange(60):
+        minute = latest_min - (latest_min - slot) % 60
+        if start_min <= minute <= end_min:
+          minutes[minute] = slots[slot]
+    return [(minute * 60, minutes[minute]) for minute in sorted(minutes)]
+
+  def sampler_stats_per_period(self, name, start_sec, end_sec, period_sec=3600, percentiles=()):
+    '''Order statistics of a sampler's last minute samples, grouped into periods. Only minutes
+       that a frame covers completely are included, see the module docstring.
+    Arguments
+      period_sec (optional): Length of each period, aligned to multiples of it since the epoch
+      percentiles (optional): Extra percentiles to report, see stats.percentile_key
+    Returns: [(period start sec, stats)] for each period with samples, oldest first. stats has the
+        keys of SamplerStats.all_time_stats; its count sums the events of each minute.'''
+    name_id = self.name_ids.get(name)
+    if name_id is None:
+      return []
+    minute_samples = {}
+    for frame in self._frames_between(start_sec, end_sec + 60):
+      row = self._row(frame, "sampler", name_id)
+      if row is None:
+        continue
+      latest_time_sec = frame.dump_time_sec + int(self._column(frame, "sampler_latest_deltas",
+                                                               row, row + 1)[0])
+      if not start_sec <= latest_time_sec <= end_sec:
+        continue
+      latest_min = utils.epoch_sec_to_minutes_since_epoch(latest_time_sec)
+      if frame.dump_time_sec < (latest_min + 1) * 60 - 1:
+        # Dumped mid-minute: the rest of the minute went to a reservoir no frame has
+        continue
+      sample_start, sample_end = self._column(frame, "sample_offsets", row, row + 2).tolist()
+      minute_samples[latest_min] = (
+          self._column(frame, "sample_values", sample_start, sample_end),
+          int(self._column(frame, "sampler_num_events", row, row + 1)[0]))
+    periods = {}
+    for minute, (values, num_events) in minute_samples.iteritems():
+      if not len(values):
+        continue
+      period = periods.setdefault(minute * 60 // period_sec * period_sec, [[], 0])
+      period[0].append(values)
+      period[1] += num_events
+    keyed_percentiles = stats.DEFAULT_PERCENTILES + [(stats.percentile_key(p), p)
+                                                     for p in percentiles]
+    results = []
+    for period_start in sorted(periods):
+      values, num_events = periods[period_start]
+      sorted_values = numpy.sort(numpy.concatenate(values))
+      num_samples = len(sorted_values)
+      period_stats = dict((key, int(sorted_values[stats.percentile_position(num_samples, p)]))
+                          for key, p in keyed_percentiles)
+      period_stats["largest_value"] = int(sorted_values[-1])
+      period_stats["count"] = num_events
+      results.append((period_start, period_stats))
+    return results
+
+
+def archive_forever(varz_client, path, dump_sec_of_minute=DUMP_SEC_OF_MINUTE):
+  '''Append a dump of varz_client to the archive at path at dump_sec_of_minute into every minute,
+     until interrupted. Events in the rest of the minute after a dump are only in the counters.'''
+  writer = ArchiveWriter(path)
+  try:
+    while True:
+      now = time.time()
+      dump_time = now // 60 * 60 + dump_sec_of_minute
+      if dump_time <= now:
+        dump_time += 60
+      time.sleep(dump_time - now)
+      writer.append(varz_client.all_dump())
+  finally:
+    writer.close()
@@ -1,18 +1,79 @@
+import archive
 import client
 import json
+import merge
+import print_stats
+import snapshot
 import random
+import shutil
 import datetime
+import os
+import resource
+import server
+import sharded
+import shm
+import socket
+import stats
+import tempfile
+import signal
+import SocketServer
+import sys
+import threading
+import time
+
+class CountingUDPSocket(object):
+  '''Wraps a UDP socket and counts sendto calls, i.e. datagrams put on the wire'''
+  def __init__(self, sock):
+    self.sock = sock
+    self.num_packets = 0
+
+  def sendto(self, *args):
+    self.num_packets += 1
+    return self.sock.sendto(*args)
+
+def run_in_child(fn):
+  '''Run fn() in a forked child so its peak RSS isn't hidden by an earlier high-water mark
+  Returns: (elapsed seconds, growth of the child's peak RSS in KB)'''
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    try:
+      os.close(read_fd)
+      rss_before_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      start_time = datetime.datetime.now()
+      fn()
+      elapsed_seconds = (datetime.datetime.now() - start_time).total_seconds()
+      rss_after_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      os.write(write_fd, json.dumps([elapsed_seconds, rss_after_kb - rss_before_kb]))
+    finally:
+      os._exit(0)
+  os.close(write_fd)
+  result = os.read(read_fd, 4096)
+  os.close(read_fd)
+  os.waitpid(pid, 0)
+  return json.loads(result)
+
+def consume_all_dump(c):
+  for kind in ["mht_counters", "mht_samplers"]:
+    for entry in c.all_dump()[kind]:
+      pass
+
+def consume_iter_dump(c):
+  for kind, name, value in c.iter_dump():
+    pass
 
 def benchmark_all_dump(c):
-  start_time = datetime.datetime.now()
-  result  = c.all_dump()
-  end_time = datetime.datetime.now()
-  result_size = len(json.dumps(result))
-  elapsed_seconds = (end_time - start_time).total_seconds()
-  mbps = result_size / elapsed_seconds /(1024*1024)
-  print "All dump took: %0.2f, result_size=%d, %0.2f MB/s" % (elapsed_seconds, result_size, mbps)
+  result_size = len(c._send_and_receive_tcp_command("ALLDUMPJSON;"))
+  for label, consume_fn in [("all_dump", consume_all_dump), ("iter_dump", consume_iter_dump)]:
+    fresh_client = lambda: client.VARZClient(c.hostname, c.udp_port, c.tcp_port)
+    elapsed_seconds, peak_rss_growth_kb = run_in_child(lambda: consume_fn(fresh_client()))
+    mbps = result_size / elapsed_seconds /(1024*1024)
+    print "%-9s took: %0.2f, result_size=%d, %0.2f MB/s, peak RSS growth %0.2f MB" % (
+        label, elapsed_seconds, result_size, mbps, peak_rss_growth_kb / 1024.0)
 
-def benchmark_commands(c, num_commands=262144): #16777216):
+def benchmark_commands(c, num_commands=262144, label=""): #16777216):
+  counting_socket = CountingUDPSocket(c.udp_socket)
+  c.udp_socket = counting_socket
   start_time = datetime.datetime.now()
   for x in xrange(num_commands):
     r = random.randrange(2)
@@ -21,9 +82,373 @@ def benchmark_commands(c, num_commands=262144): #16777216):
       random_counter_command(c)
     elif r == 1:
       random_sampler_command(c)
+  c.flush()
   end_time = datetime.datetime.now()
+  c.udp_socket = counting_socket.sock
   elapsed_seconds = (end_time - start_time).total_seconds()
-  print "Commands Took %0.2fs; %0.2f commands per sec" % (elapsed_seconds, num_commands/elapsed_seconds)
+  print "%sCommands Took %0.2fs; %0.2f commands per sec; %0.2f packets per sec (%d packets)" % (
+      label, elapsed_seconds, num_commands/elapsed_seconds,
+      counting_socket.num_packets/elapsed_seconds, counting_socket.num_packets)
+
+class StandInTCPHandler(SocketServer.BaseRequestHandler):
+  '''Answers ALLLISTJSON with a small fixed document and keeps the connection open; every other
+     command is read and ignored'''
+  LIST_RESPONSE = json.dumps({"mht_counters": ["variable_%d" % i for i in range(64)],
+                              "mht_samplers": ["variable_%d" % i for i in range(64)]})
+
+  def handle(self):
+    pending = ""
+    while True:
+      new_data = self.request.recv(65536)
+      if not new_data:
+        return
+      pending += new_data
+      commands = pending.split(";")
+      pending = commands.pop()
+      for command in commands:
+        if command == "ALLLISTJSON":
+          self.request.sendall(self.LIST_RESPONSE)
+
+class StandInTCPServer(SocketServer.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+  request_queue_size = 1024
+
+def start_stand_in_tcp_server():
+  '''Returns: the port of a keep-alive TCP server running on a background thread'''
+  server = StandInTCPServer(("127.0.0.1", 0), StandInTCPHandler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server.server_address[1]
+
+def connect_per_call_all_list(c):
+  '''The pre-pooling behaviour: resolve, connect, send, read and close for every call'''
+  tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  tcp_socket.connect((c.hostname, c.tcp_port))
+  try:
+    tcp_socket.sendall("ALLLISTJSON;")
+    return client._recv_json_document(tcp_socket)[0]
+  finally:
+    tcp_socket.close()
+
+def connect_per_call_counter_increment(c):
+  tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  tcp_socket.connect((c.hostname, c.tcp_port))
+  try:
+    tcp_socket.sendall("MHTCOUNTERADD variable_0 0 1;")
+  finally:
+    tcp_socket.close()
+
+def benchmark_tcp_latency(num_calls=4096):
+  '''Compare per-call latency of TCP requests and TCP increments before and after pooling, against
+     a local stand-in server'''
+  c = client.VARZClient(hostname="localhost", tcp_port=start_stand_in_tcp_server())
+  c.setup()
+  for label, fn in [("all_list, connect per call", connect_per_call_all_list),
+                    ("all_list, pooled", lambda c: c.all_list()),
+                    ("TCP increment, connect per call", connect_per_call_counter_increment),
+                    ("TCP increment, pipelined",
+                     lambda c: c.counter_increment("variable_0", mode=client.VARZClient.MODE_TCP))]:
+    start_time = datetime.datetime.now()
+    for x in xrange(num_calls):
+      fn(c)
+    elapsed_seconds = (datetime.datetime.now() - start_time).total_seconds()
+    print "%-32s %0.2f us per call" % (label, elapsed_seconds / num_calls * 1e6)
+  c.close()
+
+def benchmark_per_call_cost(c, num_calls=200000):
+  '''Nanoseconds per counter_increment/sampler_add vs prepared handles. Sends are stubbed out to
+     isolate the client side cost, then measured again with real sends.'''
+  counter = c.counter("variable_0")
+  sampler = c.sampler("variable_1")
+  for send_label, stub_send in [("client only", True), ("with sendto", False)]:
+    if stub_send:
+      c._sendto_udp = lambda datagram: None
+    else:
+      del c._sendto_udp
+    for label, fn in [("counter_increment", lambda: c.counter_increment("variable_0")),
+                      ("counter handle", counter.increment),
+                      ("sampler_add", lambda: c.sampler_add("variable_1", 100)),
+                      ("sampler handle", lambda: sampler.add(100))]:
+      start_time = datetime.datetime.now()
+      for x in xrange(num_calls):
+        fn()
+      elapsed_seconds = (datetime.datetime.now() - start_time).total_seconds()
+      print "[%s] %-18s %6.0f ns per call" % (send_label, label, elapsed_seconds / num_calls * 1e9)
+
+class DiscardingUDPSocket(object):
+  def sendto(self, *args):
+    pass
+
+def benchmark_instrumentation_overhead(num_calls=200000):
+  '''Nanoseconds per counter_increment without instrumentation, and with every send or 1 in 16
+     sends timed. Sends go to a socket stand-in so only the client side cost is measured.'''
+  for label, kwargs in [("off", {}), ("every send", {"instrument": True, "instrument_sample_every": 1}),
+                        ("1 in 16 sends", {"instrument": True, "instrument_sample_every": 16})]:
+    c = client.VARZClient(**kwargs)
+    c.setup()
+    c.udp_socket = DiscardingUDPSocket()
+    counter = c.counter("variable_0")
+    start_time = datetime.datetime.now()
+    for x in xrange(num_calls):
+      counter.increment()
+    elapsed_seconds = (datetime.datetime.now() - start_time).total_seconds()
+    print "[instrumentation %-13s] %6.0f ns per counter handle increment" % (
+        label, elapsed_seconds / num_calls * 1e9)
+
+def benchmark_sampler_rate_limit(num_calls=200000, max_values_per_sec=100):
+  '''Datagrams sent for num_calls samples of one hot sampler, with and without client side
+     sampling, counted at a socket stand-in'''
+  for label, kwargs in [("off", {}), ("%d/sec" % max_values_per_sec,
+                                      {"sampler_max_values_per_sec": max_values_per_sec})]:
+    c = client.VARZClient(**kwargs)
+    c.setup()
+    c.udp_socket = CountingUDPSocket(DiscardingUDPSocket())
+    sampler = c.sampler("variable_1")
+    start_time = datetime.datetime.now()
+    for x in xrange(num_calls):
+      sampler.add(x % 16384)
+    c.flush()
+    elapsed_seconds = (datetime.datetime.now() - start_time).total_seconds()
+    print "[sampler rate limit %-8s] %7d datagrams for %d samples, %6.0f ns per call" % (
+        label, c.udp_socket.num_packets, num_calls, elapsed_seconds / num_calls * 1e9)
+
+def synthetic_dump(num_vars, num_samples=200, latest_time_sec=1400000000):
+  '''A dump with num_vars variables, half counters and half samplers, with random values'''
+  def sample_set(num_samples):
+    return {"sample_values": [random.randrange(1 << 20) for x in xrange(num_samples)],
+            "sample_times_sec": [latest_time_sec - random.randrange(3 * 86400)
+                                 for x in xrange(num_samples)],
+            "samples_size": num_samples,
+            "num_events": num_samples * 10}
+  return {"mht_counters": [{"name": "counter_%d" % i,
+                            "value": {"min_counters": [random.randrange(1 << 20) for x in range(60)],
+                                      "all_time_count": random.randrange(1 << 40),
+                                      "latest_time_sec": latest_time_sec}}
+                           for i in xrange(num_vars / 2)],
+          "mht_samplers": [{"name": "sampler_%d" % i,
+                            "value": {"latest_time_sec": latest_time_sec,
+                                      "last_minute_samples": sample_set(num_samples / 10),
+                                      "all_time_samples": sample_set(num_samples)}}
+                           for i in xrange(num_vars / 2)]}
+
+class SyntheticDumpClient(object):
+  '''Stands in for a VARZClient whose iter_dump yields num_vars variables, cycling through a few
+     distinct random values so dumps of any size don't have to be held in memory'''
+  def __init__(self, num_vars, num_distinct=64):
+    self.num_vars = num_vars
+    dump = synthetic_dump(num_distinct)
+    self.counters = [counter["value"] for counter in dump["mht_counters"]]
+    self.samplers = [sampler["value"] for sampler in dump["mht_samplers"]]
+
+  def iter_dump(self):
+    for i in xrange(self.num_vars / 2):
+      yield ("mht_counters", "counter_%d" % i, self.counters[i % len(self.counters)])
+    for i in xrange(self.num_vars / 2):
+      yield ("mht_samplers", "sampler_%d" % i, self.samplers[i % len(self.samplers)])
+
+def benchmark_parallel_report(var_counts=(1000, 10000, 50000, 200000), job_counts=(1, 2, 4, 8)):
+  '''Seconds to compute and render a print_stats report of synthetic dumps with --jobs N. Every
+     report is checked against the serial one.'''
+  args = print_stats.main_parser().parse_args([])
+  latest_time_sec = 1400000000
+  for num_vars in var_counts:
+    c = SyntheticDumpClient(num_vars)
+    serial_report = None
+    for jobs in job_counts:
+      pool = print_stats.create_pool(jobs)
+      start_time = datetime.datetime.now()
+      sampler_rows, counter_rows = print_stats.collect_rows(c, latest_time_sec, args,
+                                                            print_stats.RowCache(), pool)
+      report = "\n".join(print_stats.report_lines(sampler_rows, counter_rows, args.windows))
+      elapsed_seconds = (datetime.datetime.now() - start_time).total_seconds()
+      if pool is not None:
+        pool.terminate()
+      if serial_report is None:
+        serial_report, serial_seconds = report, elapsed_seconds
+      assert report == serial_report
+      print "[parallel report %6d vars, %d jobs] %7.2f s, %4.1fx" % (
+          num_vars, jobs, elapsed_seconds, serial_seconds / elapsed_seconds)
+
+def benchmark_snapshot_memory(num_vars=50000):
+  '''Peak RSS of holding a synthetic dump as nested dicts and lists vs as a DumpSnapshot'''
+  # Generate the dump in a child so its freed lists don't leave a heap the children can reuse
+  dump_file = tempfile.TemporaryFile()
+  def write_dump():
+    json.dump(synthetic_dump(num_vars), dump_file)
+    dump_file.flush()
+  run_in_child(write_dump)
+  dump_file.seek(0)
+  dump_text = dump_file.read()
+  def hold_dict_form():
+    dump = json.loads(dump_text)
+  def hold_snapshot():
+    parser = client.DumpStreamParser()
+    chunks = (dump_text[i:i + 65536] for i in xrange(0, len(dump_text), 65536))
+    snap = snapshot.DumpSnapshot.from_entries(
+        entry for chunk in chunks for entry in parser.feed(chunk))
+  for label, hold_fn in [("dict form", hold_dict_form), ("DumpSnapshot", hold_snapshot)]:
+    elapsed_seconds, peak_rss_growth_kb = run_in_child(hold_fn)
+    print "%-12s %d variables: %0.2fs to build, peak RSS growth %0.2f MB" % (
+        label, num_vars, elapsed_seconds, peak_rss_growth_kb / 1024.0)
+
+def benchmark_shared_memory(c, num_workers=8, num_events=100000):
+  '''Per-event cost of SharedMemoryClient in forked workers, and packets sent per drain of all
+     of their counters, vs each worker sending its own UDP packets'''
+  region = shm.SharedMetricsRegion(max_workers=num_workers + 1)
+  shared_client = shm.SharedMemoryClient(region)
+  names = ["variable_%d" % i for i in xrange(64)]
+  def worker():
+    # CPU time, so workers sharing a core don't count each other's time slices
+    start_cpu_seconds = sum(os.times()[:2])
+    for x in xrange(num_events):
+      shared_client.counter_increment(names[x % 64])
+    cpu_seconds = sum(os.times()[:2]) - start_cpu_seconds
+    os.write(write_fd, "%f\n" % (cpu_seconds / num_events * 1e9))
+  read_fd, write_fd = os.pipe()
+  for i in xrange(num_workers):
+    if os.fork() == 0:
+      try:
+        worker()
+      finally:
+        os._exit(0)
+  for i in xrange(num_workers):
+    os.wait()
+  os.close(write_fd)
+  ns_per_event = [float(line) for line in os.fdopen(read_fd).read().split()]
+  counting_socket = CountingUDPSocket(c.udp_socket)
+  c.udp_socket = counting_socket
+  shm.SharedMetricsSender(region, c).drain()
+  c.udp_socket = counting_socket.sock
+  print "[shared memory] %d workers x %d counter increments: %0.0f ns per event, %d packets" % (
+      num_workers, num_events, sum(ns_per_event) / len(ns_per_event), counting_socket.num_packets)
+
+def start_daemon_process():
+  '''Run a reference daemon in a child process so each one gets its own interpreter and core
+  Returns: (pid, udp_port, tcp_port)'''
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    try:
+      os.close(read_fd)
+      daemon = server.VARZServer(udp_port=0, tcp_port=0)
+      daemon.start()
+      os.write(write_fd, json.dumps([daemon.udp_port, daemon.tcp_port]))
+      while True:
+        daemon.thread.join(1)
+    finally:
+      os._exit(0)
+  os.close(write_fd)
+  udp_port, tcp_port = json.loads(os.read(read_fd, 4096))
+  os.close(read_fd)
+  return pid, udp_port, tcp_port
+
+def count_dump_events(dump):
+  return (sum(c["value"]["all_time_count"] for c in dump["mht_counters"]) +
+          sum(s["value"]["all_time_samples"]["num_events"] for s in dump["mht_samplers"]))
+
+def benchmark_sharding(shard_counts=(1, 2, 4), num_commands=262144, timeout_sec=30):
+  '''Events per second delivered to 1, 2, 4... daemon processes by a ShardedVARZClient, from the
+     first send until the merged dump holds them (or as many as arrived by timeout_sec)'''
+  for num_shards in shard_counts:
+    daemons = [start_daemon_process() for i in xrange(num_shards)]
+    try:
+      c = sharded.ShardedVARZClient([("localhost", udp_port, tcp_port)
+                                     for pid, udp_port, tcp_port in daemons], batch_udp=True)
+      c.setup()
+      start_time = datetime.datetime.now()
+      for x in xrange(num_commands):
+        if x % 2:
+          random_counter_command(c)
+        else:
+          random_sampler_command(c)
+      c.flush()
+      deadline = time.time() + timeout_sec
+      num_delivered = count_dump_events(c.all_dump())
+      while num_delivered < num_commands and time.time() < deadline:
+        time.sleep(0.05)
+        num_delivered = count_dump_events(c.all_dump())
+      elapsed_seconds = (datetime.datetime.now() - start_time).total_seconds()
+      c.close()
+    finally:
+      for pid, udp_port, tcp_port in daemons:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    print "[%d shards] %d of %d events delivered in %0.2fs; %0.2f events per sec" % (
+        num_shards, num_delivered, num_commands, elapsed_seconds, num_delivered / elapsed_seconds)
+
+def benchmark_merge(num_hosts=500, num_vars=200):
+  '''Time and peak RSS of merging num_hosts synthetic dumps one at a time, as fetch_and_merge does'''
+  def merge_hosts():
+    merger = merge.DumpMerger()
+    for i in xrange(num_hosts):
+      merger.add_dump(synthetic_dump(num_vars))
+    merger.dump()
+  elapsed_seconds, peak_rss_growth_kb = run_in_child(merge_hosts)
+  print "Merged %d hosts x %d variables in %0.2fs, peak RSS growth %0.2f MB" % (
+      num_hosts, num_vars, elapsed_seconds, peak_rss_growth_kb / 1024.0)
+
+def benchmark_sketch(num_samplers=2000, num_hosts=500):
+  '''Exact vs sketch based stats for every sampler of a synthetic dump, the serialized size of
+     each form, and the cost of merging one sampler's sketches from num_hosts hosts'''
+  samplers = synthetic_dump(2 * num_samplers, num_samples=1024)["mht_samplers"]
+  current_epoch_sec = samplers[0]["value"]["latest_time_sec"]
+  for label, stats_class in [("exact", stats.SamplerStats), ("sketch", stats.SketchSamplerStats)]:
+    start_time = datetime.datetime.now()
+    for sampler in samplers:
+      sampler_stats = stats_class(sampler["value"], current_epoch_sec)
+      sampler_stats.all_time_stats([99])
+      sampler_stats.last_hour_stats([99])
+    elapsed_seconds = (datetime.datetime.now() - start_time).total_seconds()
+    print "[%-6s] all time + last hour stats: %0.0f us per sampler" % (
+        label, elapsed_seconds / num_samplers * 1e6)
+  all_time_samples = samplers[0]["value"]["all_time_samples"]
+  sketch = stats.SketchSamplerStats(samplers[0]["value"], current_epoch_sec).all_time_sketch()
+  print "Serialized: %d bytes of samples, %d bytes of sketch" % (
+      len(json.dumps(all_time_samples)), len(json.dumps(sketch.to_json())))
+  sketches = [stats.SketchSamplerStats(sampler["value"], current_epoch_sec).all_time_sketch()
+              for sampler in samplers[:num_hosts]]
+  start_time = datetime.datetime.now()
+  merged = stats.QuantileSketch()
+  for host_sketch in sketches:
+    merged.merge(host_sketch)
+  merged.quantile(99)
+  elapsed_seconds = (datetime.datetime.now() - start_time).total_seconds()
+  print "Merged %d sketches in %0.2f ms" % (len(sketches), elapsed_seconds * 1e3)
+
+def benchmark_archive(num_dumps=1440, num_vars=200):
+  '''Write throughput of a day of one dump per minute, file size vs the JSON dumps, and the time
+     of per minute counter and per hour sampler queries over the whole day'''
+  dump = synthetic_dump(num_vars)
+  dump_dir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(dump_dir, "varz.arc")
+    latest_time_sec = dump["mht_counters"][0]["value"]["latest_time_sec"]
+    start_sec = latest_time_sec - num_dumps * 60
+    writer = archive.ArchiveWriter(path)
+    start_time = datetime.datetime.now()
+    for i in xrange(num_dumps):
+      writer.append(dump, dump_time_sec=start_sec + i * 60)
+    writer.close()
+    elapsed_seconds = (datetime.datetime.now() - start_time).total_seconds()
+    archive_mb = os.path.getsize(path) / (1024.0 * 1024)
+    json_mb = len(json.dumps(dump)) * num_dumps / (1024.0 * 1024)
+    print "Archived %d dumps in %0.2fs (%0.0f dumps/s, %0.2f MB/s); %0.1f MB vs %0.1f MB of JSON" % (
+        num_dumps, elapsed_seconds, num_dumps / elapsed_seconds, archive_mb / elapsed_seconds,
+        archive_mb, json_mb)
+    for label, query in [
+        ("open", lambda: archive.ArchiveReader(path)),
+        ("counter per minute", lambda: archive.ArchiveReader(path).counter_per_minute(
+            "counter_0", start_sec, latest_time_sec)),
+        ("sampler p95 per hour", lambda: archive.ArchiveReader(path).sampler_stats_per_period(
+            "sampler_0", 0, 2 ** 31))]:
+      start_time = datetime.datetime.now()
+      query()
+      elapsed_seconds = (datetime.datetime.now() - start_time).total_seconds()
+      print "%-22s %0.1f ms over %d dumps" % (label, elapsed_seconds * 1e3, num_dumps)
+  finally:
+    shutil.rmtree(dump_dir)
 
 def random_variable_name(num_names=2048):
   return "variable_%d" % random.randrange(num_names)
@@ -35,12 +460,32 @@ def random_sampler_command(c, value_range=16384):
   c.sampler_add(random_variable_name(), random.randrange(value_range))
 
 
-def main():
-  c = client.VARZClient()
+def main(argv):
+  hostname, udp_port, tcp_port = "localhost", 4447, 14447
+  if "--local" in argv:
+    # Benchmark against an in-process reference daemon instead of a real one
+    local_server = server.VARZServer(udp_port=0, tcp_port=0)
+    local_server.start()
+    udp_port, tcp_port = local_server.udp_port, local_server.tcp_port
+  c = client.VARZClient(hostname, udp_port, tcp_port)
   c.setup()
-  benchmark_commands(c)
+  benchmark_commands(c, label="[unbatched] ")
+  benchmark_per_call_cost(c)
+  benchmark_instrumentation_overhead()
+  benchmark_sampler_rate_limit()
+  batched_client = client.VARZClient(hostname, udp_port, tcp_port, batch_udp=True)
+  batched_client.setup()
+  benchmark_commands(batched_client, label="[batched]   ")
+  benchmark_shared_memory(batched_client)
   benchmark_all_dump(c)
+  benchmark_tcp_latency()
+  benchmark_snapshot_memory()
+  benchmark_sharding()
+  benchmark_merge()
+  benchmark_sketch()
+  benchmark_archive()
+  benchmark_parallel_report()
 
 
 if __name__ == "__main__":
-  main()
+  main(sys.argv)
@@ -1,28 +1,164 @@
-import datetime
+import atexit
+import errno
 try:
   import simplejson as json
 except ImportError:
   import json
+import random
+import re
+import select
 import socket
+import threading
+import time as time_module
 
 import utils
 
+# IPv4 (20 bytes) + UDP (8 bytes) headers, subtracted from the MTU to get the usable payload
+UDP_IP_HEADER_LEN = 28
+# Names starting with this are reserved for the client's reports about itself
+SELF_STATS_PREFIX = "varz_client."
+
 class VARZClient(object):
-  MODE_TCP = 1
-  MODE_UDP = 2
-  MAX_NAME_LEN = 128
+  MODE_TCP = utils.MODE_TCP
+  MODE_UDP = utils.MODE_UDP
+  MAX_NAME_LEN = utils.MAX_NAME_LEN
+  DEFAULT_MTU = 1500
+  DEFAULT_BATCH_MAX_LATENCY_SEC = 0.05
+  DEFAULT_AGGREGATE_INTERVAL_SEC = 1.0
+  DEFAULT_AGGREGATE_MAX_KEYS = 16384
+  DEFAULT_TCP_POOL_SIZE = 4
+  DUMP_CHUNK_SIZE = 65536
+  DEFAULT_INSTRUMENT_SAMPLE_EVERY = 16
 
-  def __init__(self, hostname='localhost', udp_port=4447, tcp_port=14447):
+  def __init__(self, hostname='localhost', udp_port=4447, tcp_port=14447, batch_udp=False,
+               mtu=DEFAULT_MTU, batch_max_latency_sec=DEFAULT_BATCH_MAX_LATENCY_SEC,
+               aggregate_counters=False,
+               aggregate_interval_sec=DEFAULT_AGGREGATE_INTERVAL_SEC,
+               aggregate_max_keys=DEFAULT_AGGREGATE_MAX_KEYS,
+               tcp_pool_size=DEFAULT_TCP_POOL_SIZE, instrument=False,
+               instrument_sample_every=DEFAULT_INSTRUMENT_SAMPLE_EVERY,
+               self_stats_report_interval_sec=None, sampler_max_values_per_sec=None):
+    '''Arguments
+      hostname, udp_port, tcp_port: Where the varz daemon is listening
+      batch_udp (optional): If True, UDP commands are buffered and packed into as few datagrams as
+          possible instead of one sendto per command
+      mtu (optional): Datagrams built in batching mode never exceed this size (including headers)
+      batch_max_latency_sec (optional): Buffered commands are never held longer than this
+      aggregate_counters (optional): If True, UDP counter increments are summed in memory per
+          (counter_name, second) and sent as one MHTCOUNTERADD per key every aggregate_interval_sec
+      aggregate_max_keys (optional): Forces an early flush once this many distinct keys are held
+      tcp_pool_size (optional): Maximum number of simultaneous request/response TCP connections.
+          Connections are only reused with servers that keep them open after a reply; the varz
+          daemon closes every connection after replying, so against it each request connects.
+      instrument (optional): If True, the client counts its commands, bytes, errors and dumps and
+          times its sends and TCP requests, see self_stats()
+      instrument_sample_every (optional): Only 1 in this many UDP sends is timed, which keeps the
+          instrumentation cost per event low; counts are always exact
+      self_stats_report_interval_sec (optional): If set (implies instrument), self_stats() are also
+          sent to the daemon every this many seconds, as variables starting with SELF_STATS_PREFIX
+      sampler_max_values_per_sec (optional): If set, UDP sampler_add sends at most this many
+          uniformly chosen values per sampler and second, and counts every event exactly in the
+          companion counter utils.sampler_events_counter_name(sampler_name); pass that counter to
+          SamplerStats as events_counter_data. Values are sent aggregate_interval_sec late. The
+          counter name must fit too, so UDP sampler names are then limited to
+          MAX_NAME_LEN - len(utils.SAMPLER_EVENTS_SUFFIX) characters.'''
     self.hostname = hostname
     self.udp_port = udp_port
     self.tcp_port = tcp_port
     self.udp_socket = None
     self.host_ip = None
+    self.batcher = None
+    if batch_udp:
+      self.batcher = UDPCommandBatcher(self._sendto_udp, mtu - UDP_IP_HEADER_LEN,
+                                       batch_max_latency_sec)
+    self.aggregator = None
+    if aggregate_counters:
+      self.aggregator = CounterAggregator(self._send_udp_command, aggregate_interval_sec,
+                                          aggregate_max_keys)
+    self.sampler_limiter = None
+    if sampler_max_values_per_sec:
+      self.sampler_limiter = SamplerRateLimiter(self._send_udp_command, sampler_max_values_per_sec,
+                                                aggregate_interval_sec, aggregate_max_keys)
+    self.tcp_pool = TCPConnectionPool(self._tcp_address, tcp_pool_size)
+    self.tcp_command_lock = threading.Lock()
+    self.tcp_command_conn = None
+    self.instrumentation = None
+    if instrument or self_stats_report_interval_sec:
+      self.instrumentation = ClientSelfStats(instrument_sample_every)
+    self.self_stats_report_interval_sec = self_stats_report_interval_sec
+    self.self_stats_reporter = None
+    self.flush_at_exit = False
 
   def setup(self):
     '''Create sockets and cache resolved hostname'''
     self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     self.host_ip = socket.gethostbyname(self.hostname)
+    if (self.batcher or self.aggregator or self.sampler_limiter) and not self.flush_at_exit:
+      # Registered once per client: setup() may run again after close(), and the handler
+      # inherited by a forked child flushes the child's own buffers
+      atexit.register(self.flush)
+      self.flush_at_exit = True
+    if self.self_stats_report_interval_sec and self.self_stats_reporter is None:
+      self._start_self_stats_reporter()
+
+  def flush(self):
+    '''Send any sampled values, aggregated counters and buffered UDP commands immediately. A no-op
+       when none of sampling, batching and aggregation is on.'''
+    if self.sampler_limiter:
+      self.sampler_limiter.flush()
+    if self.aggregator:
+      self.aggregator.flush()
+    if self.batcher:
+      self.batcher.flush()
+
+  def close(self):
+    '''Flush pending UDP commands and close all sockets. The client can be set up again.'''
+    if self.self_stats_reporter is not None:
+      # Waits for a report in progress, so nothing is sent once close() returns
+      self.self_stats_reporter.stop()
+      self.self_stats_reporter = None
+    self.flush()
+    self.tcp_pool.close()
+    with self.tcp_command_lock:
+      if self.tcp_command_conn is not None:
+        self.tcp_command_conn.close()
+        self.tcp_command_conn = None
+    if self.udp_socket is not None:
+      self.udp_socket.close()
+      self.udp_socket = None
+
+  def after_fork(self):
+    '''Call in a child process when setup() ran before fork(). Gives the child its own sockets and
+       locks, and drops its copy of buffered commands, which the parent still sends. Handles made
+       before the fork should be made again.'''
+    if self.batcher:
+      self.batcher = UDPCommandBatcher(self._sendto_udp, self.batcher.max_payload,
+                                       self.batcher.max_latency_sec)
+    if self.aggregator:
+      self.aggregator = CounterAggregator(self._send_udp_command, self.aggregator.interval_sec,
+                                          self.aggregator.max_keys)
+    if self.sampler_limiter:
+      self.sampler_limiter = SamplerRateLimiter(self._send_udp_command,
+                                                self.sampler_limiter.max_values_per_sec,
+                                                self.sampler_limiter.interval_sec,
+                                                self.sampler_limiter.max_keys)
+    # Closing the child's copies of the parent's sockets leaves the parent's connections open.
+    # The pool's lock may have been held by another thread at fork time, so don't take it.
+    for conn in self.tcp_pool.idle:
+      conn.close()
+    self.tcp_pool = TCPConnectionPool(self._tcp_address, self.tcp_pool.max_size)
+    if self.tcp_command_conn is not None:
+      self.tcp_command_conn.close()
+      self.tcp_command_conn = None
+    self.tcp_command_lock = threading.Lock()
+    if self.udp_socket is not None:
+      self.udp_socket.close()
+      self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if self.instrumentation:
+      self.instrumentation = ClientSelfStats(self.instrumentation.sample_every)
+    if self.self_stats_reporter is not None:
+      # The parent's reporter thread didn't survive the fork
+      self._start_self_stats_reporter()
 
   def counter_increment(self, counter_name, amt=1, time=None, mode=None):
     '''Increment a varz counter variable on the remote hosts.
@@ -33,8 +169,13 @@ class VARZClient(object):
           be utc time.
       mode (optional): Can be used to force either UDP or TCP mode
     Returns: None'''
-    counter_name, time, mode = self._defaults_for_name_time_and_mode(counter_name, time, mode)
+    counter_name, time, mode = utils.defaults_for_name_time_and_mode(counter_name, time, mode)
     sec_since_epoch = utils.datetime_to_sec_since_epoch(time)
+    if self.instrumentation:
+      self.instrumentation.commands["MHTCOUNTERADD"] += 1
+    if self.aggregator and mode == VARZClient.MODE_UDP:
+      self.aggregator.add(counter_name, sec_since_epoch, amt)
+      return
     command = "MHTCOUNTERADD %s %d %d;" % (counter_name, sec_since_epoch, amt)
     self._send_with_mode(command, mode)
 
@@ -48,35 +189,110 @@ class VARZClient(object):
           be utc time.
       mode (optional): Can be used to force either UDP or TCP mode
     Returns: None'''
-    sampler_name, time, mode = self._defaults_for_name_time_and_mode(sampler_name, time, mode)
+    sampler_name, time, mode = utils.defaults_for_name_time_and_mode(sampler_name, time, mode)
     sec_since_epoch = utils.datetime_to_sec_since_epoch(time)
+    if self.instrumentation:
+      self.instrumentation.commands["MHTSAMPLEADD"] += 1
+    if self.sampler_limiter and mode == VARZClient.MODE_UDP:
+      _validate_sampled_name_len(sampler_name)
+      self.sampler_limiter.add(sampler_name, sec_since_epoch, value)
+      return
     command = "MHTSAMPLEADD %s %d %d;" % (sampler_name, sec_since_epoch, value)
     self._send_with_mode(command, mode)
 
-  def _defaults_for_name_time_and_mode(self, name, time, mode):
-    if len(name) > VARZClient.MAX_NAME_LEN:
-      raise ValueError("name '%s' is longer than %d", name, VARZClient.MAX_NAME_LEN)
-    if not time:
-      time = datetime.datetime.now()
-    if not mode:
-      mode = VARZClient.MODE_UDP # TODO: Let this be an object level setting
-    return (name, time, mode)
+  def counter(self, counter_name, mode=None):
+    '''A prepared handle for counter_name: the name is validated and the command prefix built once,
+       so each increment only formats the time and amount.
+    Returns: a CounterHandle'''
+    return CounterHandle(self, counter_name, mode or VARZClient.MODE_UDP)
+
+  def sampler(self, sampler_name, mode=None):
+    '''A prepared handle for sampler_name, see counter()
+    Returns: a SamplerHandle'''
+    return SamplerHandle(self, sampler_name, mode or VARZClient.MODE_UDP)
+
+  def self_stats(self):
+    '''Returns: a snapshot of the client's own counts and latency histograms (see
+        ClientSelfStats.snapshot), or None if the client wasn't created with instrument=True'''
+    if self.instrumentation is None:
+      return None
+    return self.instrumentation.snapshot()
+
+  def report_self_stats(self):
+    '''Send the counts accumulated since the last report, and the mean of each latency, as
+       variables named SELF_STATS_PREFIX + stat'''
+    if self.instrumentation is None:
+      return
+    sec_since_epoch = utils.sec_since_epoch_now()
+    counts, mean_latencies_us = self.instrumentation.take_report()
+    # Sent past counter_increment and sampler_add so reports don't count as commands themselves
+    for name, amt in sorted(counts.iteritems()):
+      self._send_udp_command("MHTCOUNTERADD %s%s %d %d;" % (SELF_STATS_PREFIX, name,
+                                                           sec_since_epoch, amt))
+    for name, mean_us in sorted(mean_latencies_us.iteritems()):
+      self._send_udp_command("MHTSAMPLEADD %s%s %d %d;" % (SELF_STATS_PREFIX, name,
+                                                          sec_since_epoch, mean_us))
+
+  def _start_self_stats_reporter(self):
+    self.self_stats_reporter = RepeatingThread(self.report_self_stats,
+                                               self.self_stats_report_interval_sec,
+                                               "varz-self-stats")
 
   def all_dump(self):
     '''Execute the ALLDUMPJSON command, this must be executed over TCP
     Returns: <TODO>'''
     command = "ALLDUMPJSON;"
-    return json.loads(self._send_and_receive_tcp_command(command))
+    return self._send_and_receive_tcp_json(command)
+
+  def iter_dump(self):
+    '''Execute the ALLDUMPJSON command and parse the reply as it arrives, so memory use doesn't grow
+       with the size of the dump. Stopping early closes the connection.
+    Returns: A generator of (kind, name, value) where kind is "mht_counters" or "mht_samplers" and
+        value is the same COUNTER_JSON/SAMPLER_JSON object all_dump would return'''
+    buf = bytearray(VARZClient.DUMP_CHUNK_SIZE)
+    view = memoryview(buf)
+    while True:
+      conn, reused = self.tcp_pool.acquire()
+      parser = DumpStreamParser()
+      num_received = 0
+      keep_conn = False
+      try:
+        try:
+          conn.sendall("ALLDUMPJSON;")
+          while not parser.done:
+            num_bytes = conn.recv_into(buf)
+            if num_bytes == 0:
+              break
+            num_received += num_bytes
+            for entry in parser.feed(view[:num_bytes].tobytes()):
+              yield entry
+        except socket.error:
+          if reused and num_received == 0:
+            continue # The server dropped an idle connection, retry on the next one
+          raise
+        if reused and num_received == 0:
+          continue
+        parser.finish()
+        if self.instrumentation:
+          self.instrumentation.count_dump(num_received)
+        keep_conn = not _peer_closed(conn)
+        return
+      finally:
+        if keep_conn:
+          self.tcp_pool.release(conn)
+        else:
+          self.tcp_pool.discard(conn)
 
   def all_list(self):
     '''Execute the ALLLISTJSON command, this must be executed over TCP
     Returns: {'mhtcounters': [name1, name2...], 'mht_samplers': [name1, name2...]}'''
     command = "ALLLISTJSON;"
-    return json.loads(self._send_and_receive_tcp_command(command))
+    return self._send_and_receive_tcp_json(command)
 
   def all_flush(self):
     '''Execute the ALLFLUSH command, this must be executed over TCP. This command will flush
-       everything on the varz server, so be very careful when calling it'''
+       everything on the varz server, so be very careful when calling it. It is sent exactly once,
+       on a connection of its own, and never retried.'''
     command="ALLFLUSH;"
     self._send_and_receive_tcp_command(command)
 
@@ -84,23 +300,709 @@ class VARZClient(object):
     if mode == VARZClient.MODE_UDP:
       self._send_udp_command(command_string)
     else:
-      return self._send_and_receive_tcp_command(command_string)
+      self._send_tcp_command(command_string)
 
   def _send_udp_command(self, command_string):
+    if self.batcher:
+      self.batcher.add(command_string)
+    else:
+      self._sendto_udp(command_string)
+
+  def _sendto_udp(self, datagram):
     udp_address = (self.host_ip, self.udp_port)
-    self.udp_socket.sendto(command_string, udp_address)
+    instrumentation = self.instrumentation
+    if not instrumentation:
+      self.udp_socket.sendto(datagram, udp_address)
+      return
+    # Inlined rather than calling into instrumentation, this runs once per datagram
+    instrumentation.num_udp_sends += 1
+    timed = not instrumentation.num_udp_sends % instrumentation.sample_every
+    if timed:
+      start_time = time_module.time()
+    try:
+      self.udp_socket.sendto(datagram, udp_address)
+    except socket.error as e:
+      instrumentation.count_udp_error(e)
+      raise
+    if timed:
+      instrumentation.latencies["udp_sendto_us"].add(time_module.time() - start_time)
+    instrumentation.udp_datagrams += 1
+    instrumentation.udp_bytes += len(datagram)
+
+  def _tcp_address(self):
+    if self.host_ip is None:
+      self.host_ip = socket.gethostbyname(self.hostname)
+    return (self.host_ip, self.tcp_port)
+
+  def _send_tcp_command(self, command_string):
+    '''Fire-and-forget commands are pipelined over one long-lived connection. If the server has
+       dropped it, reconnect once and resend.'''
+    with self.tcp_command_lock:
+      if self.tcp_command_conn is None:
+        self.tcp_command_conn = self._tcp_connect()
+      try:
+        self.tcp_command_conn.sendall(command_string)
+      except socket.error:
+        self.tcp_command_conn.close()
+        self.tcp_command_conn = self._tcp_connect()
+        self.tcp_command_conn.sendall(command_string)
+      if self.instrumentation:
+        self.instrumentation.tcp_bytes_sent += len(command_string)
+
+  def _tcp_connect(self):
+    if not self.instrumentation:
+      return socket.create_connection(self._tcp_address())
+    start_time = time_module.time()
+    conn = socket.create_connection(self._tcp_address())
+    self.instrumentation.count_tcp_connect(start_time)
+    return conn
 
   def _send_and_receive_tcp_command(self, command_string):
-    tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    tcp_socket.connect((self.hostname, self.tcp_port))
+    '''Send a command on a new connection and return everything the server replies with before
+       closing. Our side is shut down after sending, so a server that keeps connections open
+       still closes once it has answered. Never retried, so safe for commands like ALLFLUSH.'''
+    start_time = time_module.time() if self.instrumentation else None
+    conn = self._tcp_connect()
     try:
-      tcp_socket.sendall(command_string)
-      recved = ""
-      while True:
-        new_data = tcp_socket.recv(4096)
-        if len(new_data) == 0:
-          break
-        recved += new_data
-      return recved
+      if self.instrumentation:
+        start_time = time_module.time()
+      conn.sendall(command_string)
+      conn.shutdown(socket.SHUT_WR)
+      result, server_closed, num_bytes = _recv_until_closed(conn)
+      if self.instrumentation:
+        self.instrumentation.count_tcp_request(command_string, num_bytes, start_time)
+      return result
     finally:
-      tcp_socket.close()
+      conn.close()
+
+  def _send_and_receive_tcp_json(self, command_string):
+    '''Send a command whose reply is a single JSON document and return it decoded'''
+    return self._tcp_request(command_string, _recv_json_document)
+
+  def _tcp_request(self, command_string, recv_fn):
+    '''Send a request on a pooled connection and read its reply with recv_fn. If a reused
+       connection fails or returns nothing, the server dropped it while idle and the request is
+       sent again on the next one, so only use this for idempotent requests like ALLDUMPJSON.'''
+    while True:
+      start_time = time_module.time() if self.instrumentation else None
+      conn, reused = self.tcp_pool.acquire()
+      if self.instrumentation and not reused:
+        self.instrumentation.count_tcp_connect(start_time)
+        start_time = time_module.time()
+      try:
+        conn.sendall(command_string)
+        result, server_closed, num_bytes = recv_fn(conn)
+        if self.instrumentation:
+          self.instrumentation.count_tcp_request(command_string, num_bytes, start_time)
+      except socket.error:
+        self.tcp_pool.discard(conn)
+        if reused:
+          continue # The server dropped an idle connection, retry on the next one
+        raise
+      if server_closed:
+        self.tcp_pool.discard(conn)
+      else:
+        self.tcp_pool.release(conn)
+      if result or not reused:
+        return result
+
+
+def _recv_until_closed(conn):
+  chunks = []
+  while True:
+    new_data = conn.recv(4096)
+    if len(new_data) == 0:
+      break
+    chunks.append(new_data)
+  data = "".join(chunks)
+  return (data, True, len(data))
+
+_JSON_STRUCTURE = re.compile(r'[{}"]')
+_JSON_STRING_SPECIAL = re.compile(r'["\\]')
+
+def _scan_json_depth(data, state):
+  '''Track the object nesting of a JSON document read in chunks, ignoring braces in strings
+  Arguments
+    state: (depth, in_string, escaped) after the previous chunks, (0, False, False) at the start
+  Returns: the state after data'''
+  depth, in_string, escaped = state
+  pos = 0
+  if escaped and data:
+    # The previous chunk ended with the backslash escaping this chunk's first character
+    pos = 1
+    escaped = False
+  while True:
+    if in_string:
+      match = _JSON_STRING_SPECIAL.search(data, pos)
+      if match is None:
+        return (depth, True, escaped)
+      if match.group() == '"':
+        in_string = False
+        pos = match.end()
+      elif match.end() == len(data):
+        return (depth, True, True)
+      else:
+        pos = match.end() + 1
+    else:
+      match = _JSON_STRUCTURE.search(data, pos)
+      if match is None:
+        return (depth, False, False)
+      char = match.group()
+      if char == '"':
+        in_string = True
+      elif char == "{":
+        depth += 1
+      else:
+        depth -= 1
+      pos = match.end()
+
+def _recv_json_document(conn):
+  '''Read one JSON object. The document ends when the server closes the connection or, for
+     servers that keep connections alive, when its outermost braces close. Braces and escaped
+     quotes inside strings are skipped.
+  Returns: (document, server_closed, num_bytes)'''
+  chunks = []
+  state = (0, False, False)
+  num_bytes = 0
+  while True:
+    new_data = conn.recv(4096)
+    if len(new_data) == 0:
+      return (json.loads("".join(chunks)) if chunks else None, True, num_bytes)
+    chunks.append(new_data)
+    num_bytes += len(new_data)
+    state = _scan_json_depth(new_data, state)
+    if state[0] == 0 and not state[1] and new_data.rstrip().endswith("}"):
+      return (json.loads("".join(chunks)), _peer_closed(conn), num_bytes)
+
+def _peer_closed(conn):
+  '''True if the server has already closed a connection we have read a complete reply from'''
+  readable, _, _ = select.select([conn], [], [], 0)
+  if not readable:
+    return False
+  try:
+    return len(conn.recv(1, socket.MSG_PEEK)) == 0
+  except socket.error:
+    return True
+
+
+class DumpStreamParser(object):
+  '''Incrementally parses an ALLDUMPJSON reply. feed() takes the next chunk of the reply and
+     returns the (kind, name, value) entries of "mht_counters" and "mht_samplers" it completed.
+     Only the entry currently being received is buffered. Other top level keys are skipped.'''
+  ENTRY_KINDS = ("mht_counters", "mht_samplers")
+  WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+  def __init__(self):
+    self.decoder = json.JSONDecoder()
+    self.pending = ""
+    self.state = self._expect_document_start
+    self.kind = None
+    self.done = False
+
+  def feed(self, data):
+    self.pending += data
+    entries = []
+    pos = 0
+    while not self.done:
+      pos = self.WHITESPACE.match(self.pending, pos).end()
+      if pos == len(self.pending):
+        break
+      next_pos = self.state(pos, entries)
+      if next_pos is None:
+        break # The next token is incomplete, wait for more data
+      pos = next_pos
+    self.pending = self.pending[pos:]
+    return entries
+
+  def finish(self):
+    '''Call once the reply has ended; raises ValueError if it was truncated'''
+    if not self.done:
+      raise ValueError("Truncated ALLDUMPJSON reply")
+
+  def _decode_value(self, pos):
+    '''Returns: (value, end) or None if the value isn't complete yet. A value must be followed by at
+       least one more byte, otherwise a number split across chunks would decode early.'''
+    try:
+      value, end = self.decoder.raw_decode(self.pending, pos)
+    except ValueError:
+      return None
+    if end == len(self.pending):
+      return None
+    return (value, end)
+
+  def _expect(self, pos, char):
+    if self.pending[pos] != char:
+      raise ValueError("Expected '%s' at '%s'" % (char, self.pending[pos:pos + 32]))
+    return pos + 1
+
+  def _expect_document_start(self, pos, entries):
+    self.state = self._expect_key_or_end
+    return self._expect(pos, "{")
+
+  def _expect_key_or_end(self, pos, entries):
+    if self.pending[pos] == "}":
+      self.done = True
+      return pos + 1
+    if self.pending[pos] == ",":
+      return pos + 1
+    decoded = self._decode_value(pos)
+    if decoded is None:
+      return None
+    key, end = decoded
+    end = self.WHITESPACE.match(self.pending, end).end()
+    if end == len(self.pending):
+      return None
+    end = self._expect(end, ":")
+    if key in DumpStreamParser.ENTRY_KINDS:
+      self.kind = key
+      self.state = self._expect_entries_start
+    else:
+      self.state = self._expect_skipped_value
+    return end
+
+  def _expect_skipped_value(self, pos, entries):
+    decoded = self._decode_value(pos)
+    if decoded is None:
+      return None
+    self.state = self._expect_key_or_end
+    return decoded[1]
+
+  def _expect_entries_start(self, pos, entries):
+    self.state = self._expect_entry_or_end
+    return self._expect(pos, "[")
+
+  def _expect_entry_or_end(self, pos, entries):
+    if self.pending[pos] == "]":
+      self.state = self._expect_key_or_end
+      return pos + 1
+    if self.pending[pos] == ",":
+      return pos + 1
+    decoded = self._decode_value(pos)
+    if decoded is None:
+      return None
+    entry, end = decoded
+    entries.append((self.kind, entry["name"], entry["value"]))
+    return end
+
+
+class TCPConnectionPool(object):
+  '''Thread safe pool of TCP connections to address_fn(). At most max_size connections are checked
+     out or idle at once; acquire() blocks until one is free. Connections are only handed back
+     with release() if the server left them open.'''
+
+  def __init__(self, address_fn, max_size):
+    self.address_fn = address_fn
+    self.max_size = max_size
+    self.slots = threading.BoundedSemaphore(max_size)
+    self.lock = threading.Lock()
+    self.idle = []
+
+  def acquire(self):
+    '''Returns: (connection, reused) where reused is True if the connection was idle in the pool'''
+    self.slots.acquire()
+    with self.lock:
+      if self.idle:
+        return (self.idle.pop(), True)
+    try:
+      return (socket.create_connection(self.address_fn()), False)
+    except:
+      self.slots.release()
+      raise
+
+  def release(self, conn):
+    with self.lock:
+      self.idle.append(conn)
+    self.slots.release()
+
+  def discard(self, conn):
+    conn.close()
+    self.slots.release()
+
+  def close(self):
+    with self.lock:
+      idle = self.idle
+      self.idle = []
+    for conn in idle:
+      conn.close()
+
+
+def _validate_name(name):
+  if len(name) > VARZClient.MAX_NAME_LEN:
+    raise ValueError("name '%s' is longer than %d" % (name, VARZClient.MAX_NAME_LEN))
+  if name.split() != [name] or ";" in name:
+    raise ValueError("name '%s' is empty or contains whitespace or ';'" % name)
+
+def _validate_sampled_name_len(sampler_name):
+  # The companion events counter appends SAMPLER_EVENTS_SUFFIX, and the daemon would reject it
+  max_len = VARZClient.MAX_NAME_LEN - len(utils.SAMPLER_EVENTS_SUFFIX)
+  if len(sampler_name) > max_len:
+    raise ValueError("sampler name '%s' is longer than %d, the most that leaves room for '%s'" %
+                     (sampler_name, max_len, utils.SAMPLER_EVENTS_SUFFIX))
+
+def _event_sec_since_epoch(time):
+  if time is None:
+    return utils.sec_since_epoch_now()
+  return utils.datetime_to_sec_since_epoch(time)
+
+
+class CounterHandle(object):
+  '''Returned by VARZClient.counter(). increment() has the same arguments as counter_increment,
+     minus the name and mode.'''
+  __slots__ = ("name", "prefix", "send_fn", "aggregator", "instrumentation")
+
+  def __init__(self, varz_client, counter_name, mode):
+    _validate_name(counter_name)
+    self.name = counter_name
+    self.instrumentation = varz_client.instrumentation
+    self.prefix = "MHTCOUNTERADD %s " % counter_name
+    if mode == VARZClient.MODE_UDP:
+      self.send_fn = varz_client._send_udp_command
+      self.aggregator = varz_client.aggregator
+    else:
+      self.send_fn = varz_client._send_tcp_command
+      self.aggregator = None
+
+  def increment(self, amt=1, time=None):
+    sec_since_epoch = _event_sec_since_epoch(time)
+    if self.instrumentation:
+      self.instrumentation.commands["MHTCOUNTERADD"] += 1
+    if self.aggregator:
+      self.aggregator.add(self.name, sec_since_epoch, amt)
+    else:
+      self.send_fn("%s%d %d;" % (self.prefix, sec_since_epoch, amt))
+
+
+class SamplerHandle(object):
+  '''Returned by VARZClient.sampler(). add() has the same arguments as sampler_add, minus the name
+     and mode.'''
+  __slots__ = ("name", "prefix", "send_fn", "limiter", "instrumentation")
+
+  def __init__(self, varz_client, sampler_name, mode):
+    _validate_name(sampler_name)
+    self.name = sampler_name
+    self.instrumentation = varz_client.instrumentation
+    self.prefix = "MHTSAMPLEADD %s " % sampler_name
+    if mode == VARZClient.MODE_UDP:
+      self.send_fn = varz_client._send_udp_command
+      self.limiter = varz_client.sampler_limiter
+      if self.limiter:
+        _validate_sampled_name_len(sampler_name)
+    else:
+      self.send_fn = varz_client._send_tcp_command
+      self.limiter = None
+
+  def add(self, value, time=None):
+    if self.instrumentation:
+      self.instrumentation.commands["MHTSAMPLEADD"] += 1
+    if self.limiter:
+      self.limiter.add(self.name, _event_sec_since_epoch(time), value)
+    else:
+      self.send_fn("%s%d %d;" % (self.prefix, _event_sec_since_epoch(time), value))
+
+
+class DeadlineFlusher(object):
+  '''Calls flush_fn delay_sec after arm(), from one long-lived daemon thread started on the first
+     arm(). Arming again before the deadline keeps the earlier deadline; disarm() cancels it.'''
+
+  def __init__(self, flush_fn, delay_sec):
+    self.flush_fn = flush_fn
+    self.delay_sec = delay_sec
+    self.condition = threading.Condition()
+    self.deadline = None
+    self.thread = None
+
+  def arm(self):
+    with self.condition:
+      if self.deadline is not None:
+        return
+      self.deadline = time_module.time() + self.delay_sec
+      if self.thread is None:
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+      self.condition.notify()
+
+  def disarm(self):
+    with self.condition:
+      self.deadline = None
+
+  def _run(self):
+    while True:
+      with self.condition:
+        while self.deadline is None:
+          self.condition.wait()
+        remaining = self.deadline - time_module.time()
+        if remaining > 0:
+          self.condition.wait(remaining)
+          continue
+        self.deadline = None
+      # Outside the condition: flush_fn takes its buffer's lock, which is held around arm()
+      self.flush_fn()
+
+
+class RepeatingThread(object):
+  '''Calls fn every interval_sec from one daemon thread until stop()'''
+
+  def __init__(self, fn, interval_sec, name):
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self._run, args=(fn, interval_sec), name=name)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    '''Stop the thread and wait for a call of fn in progress to finish'''
+    self.stopped.set()
+    if self.thread is not threading.current_thread():
+      self.thread.join()
+
+  def _run(self, fn, interval_sec):
+    # Event.wait returns the flag, so a stop() during the wait ends the loop without calling fn
+    while not self.stopped.wait(interval_sec):
+      fn()
+
+
+class UDPCommandBatcher(object):
+  '''Packs ';' terminated commands into datagrams of at most max_payload bytes. The buffer is sent
+     when the next command would not fit, or max_latency_sec after the first command was buffered,
+     whichever comes first. Safe to share between threads.'''
+
+  def __init__(self, send_fn, max_payload, max_latency_sec):
+    self.send_fn = send_fn
+    self.max_payload = max_payload
+    self.max_latency_sec = max_latency_sec
+    self.lock = threading.Lock()
+    self.pending = []
+    self.pending_size = 0
+    self.flusher = DeadlineFlusher(self.flush, max_latency_sec)
+
+  def add(self, command_string):
+    with self.lock:
+      if self.pending_size + len(command_string) > self.max_payload:
+        self._flush_locked()
+      self.pending.append(command_string)
+      self.pending_size += len(command_string)
+      if self.pending_size >= self.max_payload:
+        self._flush_locked()
+      else:
+        self.flusher.arm()
+
+  def flush(self):
+    with self.lock:
+      self._flush_locked()
+
+  def _flush_locked(self):
+    self.flusher.disarm()
+    if self.pending:
+      datagram = "".join(self.pending)
+      self.pending = []
+      self.pending_size = 0
+      self.send_fn(datagram)
+
+
+class CounterAggregator(object):
+  '''Sums counter increments per (counter_name, sec_since_epoch) and emits one MHTCOUNTERADD per
+     key through send_fn. Keys are flushed interval_sec after the first one arrives, or as soon
+     as max_keys distinct keys are held. Safe to share between threads.'''
+
+  def __init__(self, send_fn, interval_sec, max_keys):
+    self.send_fn = send_fn
+    self.interval_sec = interval_sec
+    self.max_keys = max_keys
+    self.lock = threading.Lock()
+    self.totals = {}
+    self.flusher = DeadlineFlusher(self.flush, interval_sec)
+
+  def add(self, counter_name, sec_since_epoch, amt):
+    key = (counter_name, sec_since_epoch)
+    with self.lock:
+      self.totals[key] = self.totals.get(key, 0) + amt
+      if len(self.totals) < self.max_keys:
+        self.flusher.arm()
+        return
+      totals = self._take_locked()
+    self._send(totals)
+
+  def flush(self):
+    with self.lock:
+      totals = self._take_locked()
+    self._send(totals)
+
+  def _take_locked(self):
+    self.flusher.disarm()
+    totals = self.totals
+    self.totals = {}
+    return totals
+
+  def _send(self, totals):
+    for (counter_name, sec_since_epoch), amt in totals.iteritems():
+      self.send_fn("MHTCOUNTERADD %s %d %d;" % (counter_name, sec_since_epoch, amt))
+
+
+class SamplerRateLimiter(object):
+  '''Keeps a uniform reservoir of at most max_values_per_sec values per (sampler_name,
+     sec_since_epoch) and counts every value added. interval_sec after the first value arrives, or
+     as soon as max_keys keys are held, each key is sent through send_fn as its reservoir's
+     MHTSAMPLEADDs plus one MHTCOUNTERADD of the exact count to the companion counter. Every second
+     gets the same share of the daemon's reservoir whatever its event rate. Safe to share between
+     threads.'''
+
+  def __init__(self, send_fn, max_values_per_sec, interval_sec, max_keys):
+    self.send_fn = send_fn
+    self.max_values_per_sec = max_values_per_sec
+    self.interval_sec = interval_sec
+    self.max_keys = max_keys
+    self.random = random.Random().random
+    self.lock = threading.Lock()
+    self.reservoirs = {}
+    self.flusher = DeadlineFlusher(self.flush, interval_sec)
+
+  def add(self, sampler_name, sec_since_epoch, value):
+    key = (sampler_name, sec_since_epoch)
+    with self.lock:
+      reservoir = self.reservoirs.get(key)
+      if reservoir is None:
+        reservoir = self.reservoirs[key] = [0, []]
+      reservoir[0] += 1
+      values = reservoir[1]
+      if len(values) < self.max_values_per_sec:
+        values.append(value)
+      else:
+        # Algorithm R: the n-th value replaces a kept one with probability max / n
+        pos = int(self.random() * reservoir[0])
+        if pos < self.max_values_per_sec:
+          values[pos] = value
+      if len(self.reservoirs) < self.max_keys:
+        self.flusher.arm()
+        return
+      reservoirs = self._take_locked()
+    self._send(reservoirs)
+
+  def flush(self):
+    with self.lock:
+      reservoirs = self._take_locked()
+    self._send(reservoirs)
+
+  def _take_locked(self):
+    self.flusher.disarm()
+    reservoirs = self.reservoirs
+    self.reservoirs = {}
+    return reservoirs
+
+  def _send(self, reservoirs):
+    for (sampler_name, sec_since_epoch), (num_events, values) in reservoirs.iteritems():
+      for value in values:
+        self.send_fn("MHTSAMPLEADD %s %d %d;" % (sampler_name, sec_since_epoch, value))
+      self.send_fn("MHTCOUNTERADD %s %d %d;" % (utils.sampler_events_counter_name(sampler_name),
+                                               sec_since_epoch, num_events))
+
+
+class LatencyHistogram(object):
+  '''Latencies in power of two microsecond buckets: bucket i counts latencies under 2**i us'''
+  __slots__ = ("counts", "total_us", "max_us")
+  NUM_BUCKETS = 32
+
+  def __init__(self):
+    self.counts = [0] * LatencyHistogram.NUM_BUCKETS
+    self.total_us = 0
+    self.max_us = 0
+
+  def add(self, seconds):
+    us = int(seconds * 1e6)
+    self.counts[min(us.bit_length(), LatencyHistogram.NUM_BUCKETS - 1)] += 1
+    self.total_us += us
+    if us > self.max_us:
+      self.max_us = us
+
+  def count(self):
+    return sum(self.counts)
+
+  def to_json(self):
+    '''Returns: {"count", "mean_us", "max_us", "buckets_us": [[upper bound, count], ...]} with only
+        the non empty buckets'''
+    count = self.count()
+    return {"count": count,
+            "mean_us": self.total_us / count if count else 0,
+            "max_us": self.max_us,
+            "buckets_us": [[1 << i, n] for i, n in enumerate(self.counts) if n]}
+
+
+class ClientSelfStats(object):
+  '''What a VARZClient costs: commands, bytes, errors, dumps and latency histograms. Updates take no
+     lock, so counts may be slightly low when many threads share a client. Only 1 in sample_every
+     UDP sends is timed.'''
+  COUNTS = ("udp_datagrams", "udp_bytes", "udp_errors", "udp_eagain_drops", "tcp_bytes_sent",
+            "tcp_connects", "tcp_requests", "tcp_bytes_received", "dumps", "dump_bytes")
+
+  def __init__(self, sample_every):
+    self.sample_every = max(1, sample_every)
+    self.num_udp_sends = 0
+    self.commands = {"MHTCOUNTERADD": 0, "MHTSAMPLEADD": 0}
+    for name in ClientSelfStats.COUNTS:
+      setattr(self, name, 0)
+    self.largest_dump_bytes = 0
+    self.latencies = {"udp_sendto_us": LatencyHistogram(), "tcp_connect_us": LatencyHistogram()}
+    self.reported_counts = {}
+    self.reported_latencies = {}
+
+  def count_udp_error(self, error):
+    if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+      self.udp_eagain_drops += 1
+    else:
+      self.udp_errors += 1
+
+  def count_tcp_connect(self, start_time):
+    self.tcp_connects += 1
+    self.latencies["tcp_connect_us"].add(time_module.time() - start_time)
+
+  def count_tcp_request(self, command_string, num_bytes, start_time):
+    self.tcp_requests += 1
+    self.tcp_bytes_sent += len(command_string)
+    self.tcp_bytes_received += num_bytes
+    command = command_string.rstrip(";")
+    key = "tcp_%s_us" % command.lower()
+    histogram = self.latencies.get(key)
+    if histogram is None:
+      histogram = self.latencies[key] = LatencyHistogram()
+    histogram.add(time_module.time() - start_time)
+    if command == "ALLDUMPJSON":
+      self.count_dump(num_bytes)
+
+  def count_dump(self, num_bytes):
+    self.dumps += 1
+    self.dump_bytes += num_bytes
+    if num_bytes > self.largest_dump_bytes:
+      self.largest_dump_bytes = num_bytes
+
+  def counts(self):
+    '''Returns: {name: total} of every count, commands as "commands_<type>"'''
+    counts = dict((name, getattr(self, name)) for name in ClientSelfStats.COUNTS)
+    for command, count in self.commands.items():
+      counts["commands_" + command.lower()] = count
+    return counts
+
+  def snapshot(self):
+    '''Returns: {"commands": {type: count}, "counts": {name: total}, "largest_dump_bytes": #,
+        "latencies": {name: LatencyHistogram.to_json()}, "sample_every": #}'''
+    return {"commands": dict(self.commands),
+            "counts": dict((name, getattr(self, name)) for name in ClientSelfStats.COUNTS),
+            "largest_dump_bytes": self.largest_dump_bytes,
+            "latencies": dict((name, histogram.to_json())
+                              for name, histogram in self.latencies.items()),
+            "sample_every": self.sample_every}
+
+  def take_report(self):
+    '''Returns: (the non zero count increases since the last report, the mean latency of what was
+        timed since the last report for each histogram that timed something)'''
+    counts = {}
+    for name, total in self.counts().iteritems():
+      if total != self.reported_counts.get(name, 0):
+        counts[name] = total - self.reported_counts.get(name, 0)
+        self.reported_counts[name] = total
+    mean_latencies_us = {}
+    for name, histogram in self.latencies.items():
+      count, total_us = histogram.count(), histogram.total_us
+      reported_count, reported_total_us = self.reported_latencies.get(name, (0, 0))
+      if count != reported_count:
+        mean_latencies_us[name] = (total_us - reported_total_us) / (count - reported_count)
+        self.reported_latencies[name] = (count, total_us)
+    return counts, mean_latencies_us
@@ -0,0 +1,226 @@
+'''HTTP exporter for monitoring systems, stdlib only. /metrics serves Prometheus text format and
+/metrics.json the same stats as JSON. A dump and its rendered bodies are cached for ttl_sec, and
+scrapes arriving while a dump is in flight wait for that dump instead of asking the daemon again,
+so any number of scrapers costs one ALLDUMPJSON per TTL.'''
+import argparse
+import BaseHTTPServer
+try:
+  import simplejson as json
+except ImportError:
+  import json
+import SocketServer
+import sys
+import threading
+import time
+
+import client
+import sharded
+import stats
+import utils
+
+DEFAULT_PORT = 9447
+DEFAULT_TTL_SEC = 5.0
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+JSON_CONTENT_TYPE = "application/json"
+QUANTILES = [("0.25", "quartile_1"), ("0.5", "median"), ("0.75", "quartile_3"),
+             ("0.95", "percentile_95"), ("1", "largest_value")]
+
+
+class SingleFlightCache(object):
+  '''Caches the result of fetch_fn for ttl_sec. When it is stale, the first caller fetches and the
+     callers arriving meanwhile wait for and share that result, or its exception. Failures aren't
+     cached.'''
+
+  def __init__(self, fetch_fn, ttl_sec, clock=time.time):
+    self.fetch_fn = fetch_fn
+    self.ttl_sec = ttl_sec
+    self.clock = clock
+    self.lock = threading.Lock()
+    self.value = None
+    self.expires_at = None
+    self.flight = None
+
+  def get(self):
+    with self.lock:
+      if self.expires_at is not None and self.clock() < self.expires_at:
+        return self.value
+      flight = self.flight
+      leader = flight is None
+      if leader:
+        flight = self.flight = _Flight()
+    if not leader:
+      flight.done.wait()
+      if flight.error is not None:
+        raise flight.error
+      return flight.value
+    try:
+      flight.value = self.fetch_fn()
+    except Exception as e:
+      flight.error = e
+    with self.lock:
+      self.flight = None
+      if flight.error is None:
+        self.value = flight.value
+        self.expires_at = self.clock() + self.ttl_sec
+    flight.done.set()
+    if flight.error is not None:
+      raise flight.error
+    return flight.value
+
+
+class _Flight(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.value = None
+    self.error = None
+
+
+class Scrape(object):
+  '''One dump and the bodies rendered from it; each format is rendered at most once'''
+
+  def __init__(self, dump, current_epoch_sec):
+    self.dump = dump
+    self.current_epoch_sec = current_epoch_sec
+    self.lock = threading.Lock()
+    self.bodies = {}
+
+  def body(self, render_fn):
+    '''Returns: the body rendered by render_fn as UTF-8 bytes; names from the dump are unicode'''
+    with self.lock:
+      if render_fn not in self.bodies:
+        body = render_fn(self.dump, self.current_epoch_sec)
+        if isinstance(body, unicode):
+          body = body.encode("utf-8")
+        self.bodies[render_fn] = body
+      return self.bodies[render_fn]
+
+
+def _label_value(value):
+  return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _counters_by_name(dump):
+  return dict((counter["name"], counter["value"]) for counter in dump.get("mht_counters", []))
+
+
+def _sampler_stats(sampler, counters_by_name, current_epoch_sec):
+  '''SamplerStats counting events with the sampler's companion counter if the dump has one'''
+  events_counter_name = utils.sampler_events_counter_name(sampler["name"])
+  return stats.SamplerStats(sampler["value"], current_epoch_sec,
+                            counters_by_name.get(events_counter_name))
+
+
+def _sampler_windows(sampler_stats):
+  return [("last_minute", sampler_stats.last_minute_stats()),
+          ("last_hour", sampler_stats.last_hour_stats()),
+          ("all_time", sampler_stats.all_time_stats())]
+
+
+def _counter_windows(counter_stats):
+  return [("last_minute", counter_stats.last_minute_count()),
+          ("last_hour", counter_stats.last_hour_count()),
+          ("all_time", counter_stats.all_time_count())]
+
+
+def render_prometheus(dump, current_epoch_sec):
+  '''Returns: the Prometheus text exposition of every variable. Variable names go in the name
+     label so they needn't be valid metric names.'''
+  lines = ["# TYPE varz_counter gauge"]
+  for counter in dump.get("mht_counters", []):
+    name = _label_value(counter["name"])
+    counter_stats = stats.CounterStats(counter["value"], current_epoch_sec)
+    for window, count in _counter_windows(counter_stats):
+      lines.append('varz_counter{name="%s",window="%s"} %d' % (name, window, count))
+  # Declared as gauges: a summary would also need a _sum, which reservoirs can't give
+  lines.append("# TYPE varz_sampler gauge")
+  lines.append("# TYPE varz_sampler_count gauge")
+  counters_by_name = _counters_by_name(dump)
+  for sampler in dump.get("mht_samplers", []):
+    name = _label_value(sampler["name"])
+    sampler_stats = _sampler_stats(sampler, counters_by_name, current_epoch_sec)
+    for window, window_stats in _sampler_windows(sampler_stats):
+      for quantile, key in QUANTILES:
+        lines.append('varz_sampler{name="%s",window="%s",quantile="%s"} %d' % (
+            name, window, quantile, window_stats[key]))
+      lines.append('varz_sampler_count{name="%s",window="%s"} %d' % (
+          name, window, window_stats["count"]))
+  lines.append("")
+  return "\n".join(lines)
+
+
+def render_json(dump, current_epoch_sec):
+  '''Returns: {"counters": {name: {window: count}}, "samplers": {name: {window: stats}}} as JSON'''
+  counters = dict((counter["name"], dict(_counter_windows(
+                      stats.CounterStats(counter["value"], current_epoch_sec))))
+                  for counter in dump.get("mht_counters", []))
+  counters_by_name = _counters_by_name(dump)
+  samplers = dict((sampler["name"], dict(_sampler_windows(
+                      _sampler_stats(sampler, counters_by_name, current_epoch_sec))))
+                  for sampler in dump.get("mht_samplers", []))
+  return json.dumps({"current_epoch_sec": current_epoch_sec, "counters": counters,
+                     "samplers": samplers})
+
+
+class ExporterHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  ROUTES = {"/metrics": (render_prometheus, PROMETHEUS_CONTENT_TYPE),
+            "/metrics.json": (render_json, JSON_CONTENT_TYPE)}
+
+  def do_GET(self):
+    route = self.ROUTES.get(self.path.split("?", 1)[0])
+    if route is None:
+      self.send_error(404)
+      return
+    render_fn, content_type = route
+    try:
+      body = self.server.scrapes.get().body(render_fn)
+    except Exception as e:
+      self.send_error(503, "varz daemon unavailable: %s" % e)
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class ExporterHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, varz_client, ttl_sec=DEFAULT_TTL_SEC):
+    '''Arguments
+      address: (host, port) to listen on; port 0 picks a free one
+      varz_client: A VARZClient or ShardedVARZClient to dump
+      ttl_sec (optional): How long a dump is served before fetching a new one'''
+    BaseHTTPServer.HTTPServer.__init__(self, address, ExporterHandler)
+    self.varz_client = varz_client
+    self.scrapes = SingleFlightCache(self._scrape, ttl_sec)
+
+  def _scrape(self):
+    return Scrape(self.varz_client.all_dump(), utils.sec_since_epoch_now())
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Serve varz stats over HTTP for monitoring")
+  parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+  parser.add_argument("--ttl", type=float, default=DEFAULT_TTL_SEC,
+                      help="Seconds a dump is served from cache (default %g)" % DEFAULT_TTL_SEC)
+  parser.add_argument("--shards", type=sharded.parse_shards, metavar="HOST:UDP:TCP,...",
+                      help="Export variables sharded over these daemons instead of localhost")
+  args = parser.parse_args(argv[1:])
+  if args.shards:
+    varz_client = sharded.ShardedVARZClient(args.shards)
+  else:
+    varz_client = client.VARZClient()
+  server = ExporterHTTPServer(("", args.port), varz_client, args.ttl)
+  print "Serving /metrics and /metrics.json on port %d" % server.server_address[1]
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    server.server_close()
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,211 @@
+'''Combines the dumps of several varz daemons, e.g. one per host, into one fleet-wide dump that
+stats.SamplerStats and stats.CounterStats read like any other.
+
+Counters are summed minute by minute: each dump's min_counters ring is placed on the timeline by its
+own latest_time_sec, so hosts whose last event fell in different minutes still add up per minute.
+Sampler reservoirs are merged by weighted reservoir sampling (Efraimidis-Spirakis): a sample stands
+for num_events / samples_size events of its host, so a busy host's values get proportionally more
+room in the merged reservoir and merged percentiles aren't biased toward quiet hosts.
+
+Merging is incremental. DumpMerger keeps one bounded state per variable and takes entries one at a
+time, so dumps can be streamed from many hosts at once without any of them being held whole.'''
+import heapq
+import Queue
+import random
+import threading
+
+import server
+import utils
+
+
+class _MergedCounter(object):
+  __slots__ = ("min_counters", "all_time_count", "latest_time_sec")
+
+  def __init__(self):
+    self.min_counters = [0] * 60
+    self.all_time_count = 0
+    self.latest_time_sec = 0
+
+  def add(self, counter_data):
+    self.all_time_count += counter_data["all_time_count"]
+    latest_min = utils.epoch_sec_to_minutes_since_epoch(self.latest_time_sec)
+    other_latest_min = utils.epoch_sec_to_minutes_since_epoch(counter_data["latest_time_sec"])
+    if other_latest_min > latest_min:
+      # Same as server.Counter.add: slots of the minutes skipped now hold data from over an hour ago
+      for minute in xrange(max(latest_min + 1, other_latest_min - 59), other_latest_min + 1):
+        self.min_counters[minute % 60] = 0
+      latest_min = other_latest_min
+    if counter_data["latest_time_sec"] > self.latest_time_sec:
+      self.latest_time_sec = counter_data["latest_time_sec"]
+    other_min_counters = counter_data["min_counters"]
+    for slot in xrange(60):
+      # The minute slot held in the other dump; only the hour ending at the merged latest minute
+      # is kept
+      minute = other_latest_min - (other_latest_min - slot) % 60
+      if minute > latest_min - 60:
+        self.min_counters[slot] += other_min_counters[slot]
+
+  def to_json(self):
+    return {"min_counters": list(self.min_counters),
+            "all_time_count": self.all_time_count,
+            "latest_time_sec": self.latest_time_sec}
+
+
+class _WeightedReservoir(object):
+  '''Keeps the size samples with the largest random keys u ** (1 / weight), u uniform in (0, 1)'''
+  __slots__ = ("size", "rng", "heap", "num_events")
+
+  def __init__(self, size, rng):
+    self.size = size
+    self.rng = rng
+    self.heap = []
+    self.num_events = 0
+
+  def add(self, sample_set):
+    values = sample_set["sample_values"]
+    times = sample_set["sample_times_sec"]
+    self.num_events += sample_set["num_events"]
+    if not len(values):
+      return
+    exponent = float(len(values)) / max(sample_set["num_events"], len(values))
+    heap = self.heap
+    for i in xrange(len(values)):
+      key = self.rng.random() ** exponent
+      if len(heap) < self.size:
+        heapq.heappush(heap, (key, values[i], times[i]))
+      elif key > heap[0][0]:
+        heapq.heapreplace(heap, (key, values[i], times[i]))
+
+  def to_json(self):
+    return {"sample_values": [value for key, value, sec in self.heap],
+            "sample_times_sec": [sec for key, value, sec in self.heap],
+            "samples_size": len(self.heap),
+            "num_events": self.num_events}
+
+
+class _MergedSampler(object):
+  __slots__ = ("last_minute_samples", "all_time_samples", "latest_time_sec", "last_minute_size",
+               "rng")
+
+  def __init__(self, last_minute_size, all_time_size, rng):
+    self.last_minute_size = last_minute_size
+    self.rng = rng
+    self.last_minute_samples = _WeightedReservoir(last_minute_size, rng)
+    self.all_time_samples = _WeightedReservoir(all_time_size, rng)
+    self.latest_time_sec = 0
+
+  def add(self, sampler_data):
+    self.all_time_samples.add(sampler_data["all_time_samples"])
+    latest_min = utils.epoch_sec_to_minutes_since_epoch(self.latest_time_sec)
+    other_latest_min = utils.epoch_sec_to_minutes_since_epoch(sampler_data["latest_time_sec"])
+    # A host whose last sample is from an earlier minute has nothing in the merged last minute
+    if other_latest_min > latest_min:
+      self.last_minute_samples = _WeightedReservoir(self.last_minute_size, self.rng)
+    if other_latest_min >= latest_min and "last_minute_samples" in sampler_data:
+      self.last_minute_samples.add(sampler_data["last_minute_samples"])
+    if sampler_data["latest_time_sec"] > self.latest_time_sec:
+      self.latest_time_sec = sampler_data["latest_time_sec"]
+
+  def to_json(self):
+    return {"latest_time_sec": self.latest_time_sec,
+            "last_minute_samples": self.last_minute_samples.to_json(),
+            "all_time_samples": self.all_time_samples.to_json()}
+
+
+class DumpMerger(object):
+  '''Accumulates entries of any number of dumps. Memory is bounded by the number of distinct
+     variables times the reservoir sizes, not by the number of dumps.'''
+
+  def __init__(self, last_minute_size=server.VARZServer.DEFAULT_LAST_MINUTE_RESERVOIR_SIZE,
+               all_time_size=server.VARZServer.DEFAULT_ALL_TIME_RESERVOIR_SIZE, seed=None):
+    '''Arguments
+      last_minute_size, all_time_size (optional): Reservoir sizes of the merged samplers
+      seed (optional): Seed for the sampler merge, for reproducible results'''
+    self.last_minute_size = last_minute_size
+    self.all_time_size = all_time_size
+    self.rng = random.Random(seed)
+    self.counters = {}
+    self.samplers = {}
+
+  def add(self, kind, name, value):
+    '''Merge one (kind, name, value) entry, as yielded by VARZClient.iter_dump'''
+    if kind == "mht_samplers":
+      sampler = self.samplers.get(name)
+      if sampler is None:
+        sampler = self.samplers[name] = _MergedSampler(self.last_minute_size, self.all_time_size,
+                                                       self.rng)
+      sampler.add(value)
+    else:
+      counter = self.counters.get(name)
+      if counter is None:
+        counter = self.counters[name] = _MergedCounter()
+      counter.add(value)
+
+  def add_dump(self, dump):
+    '''Merge a whole dump, as returned by VARZClient.all_dump'''
+    for kind in ("mht_counters", "mht_samplers"):
+      for entry in dump.get(kind, []):
+        self.add(kind, entry["name"], entry["value"])
+
+  def dump(self):
+    '''Returns: the merged dump, in the same format as VARZClient.all_dump'''
+    return {"mht_counters": [{"name": name, "value": counter.to_json()}
+                             for name, counter in sorted(self.counters.iteritems())],
+            "mht_samplers": [{"name": name, "value": sampler.to_json()}
+                             for name, sampler in sorted(self.samplers.iteritems())]}
+
+
+def merge_dumps(dumps, seed=None):
+  '''Returns: the merged dump of an iterable of dumps'''
+  merger = DumpMerger(seed=seed)
+  for dump in dumps:
+    merger.add_dump(dump)
+  return merger.dump()
+
+
+def fetch_and_merge(clients, max_concurrency=32, merger=None):
+  '''Stream the dumps of all clients concurrently into one merger. Fetching threads hand entries
+     over through a bounded queue, so at most a few thousand unmerged entries are held at a time.
+     If any fetch fails the first error is raised once the others finished.
+  Arguments
+    clients: VARZClients, e.g. one per host
+    max_concurrency (optional): Most dumps fetched at the same time
+    merger (optional): A DumpMerger to add to, e.g. to choose reservoir sizes
+  Returns: the merged dump'''
+  if merger is None:
+    merger = DumpMerger()
+  pending = Queue.Queue()
+  for c in clients:
+    pending.put(c)
+  entries = Queue.Queue(maxsize=4096)
+  errors = []
+  done = object()
+  def fetch():
+    try:
+      while True:
+        try:
+          c = pending.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          for entry in c.iter_dump():
+            entries.put(entry)
+        except Exception as e:
+          errors.append(e)
+    finally:
+      entries.put(done)
+  num_threads = max(1, min(max_concurrency, pending.qsize()))
+  for i in xrange(num_threads):
+    thread = threading.Thread(target=fetch, name="varz-merge-fetch")
+    thread.daemon = True
+    thread.start()
+  num_running = num_threads
+  while num_running:
+    entry = entries.get()
+    if entry is done:
+      num_running -= 1
+    else:
+      merger.add(*entry)
+  if errors:
+    raise errors[0]
+  return merger.dump()
@@ -1,53 +1,317 @@
+import argparse
 import datetime
+import heapq
+import multiprocessing
+import re
+import signal
 import sys
+import time
 
 import client
+import sharded
 import stats
 import utils
 
-def print_samplers(samplers, current_epoch_sec):
-  print "%64s  ||   %21s   ||   %21s   ||   %21s" % (
-      "", "Last Minute", "Last Hour", "All Time"
-  )
-  print "%64s  ||   %10s %10s   ||   %10s %10s   ||   %10s %10s" % (
-      "name", "median", "95th", "median", "95th", "median", "95th"
-  )
-  print "-" * 150
-  for sampler_wrapper in samplers:
-    sampler_stats = stats.SamplerStats(sampler_wrapper["value"], current_epoch_sec)
-    minute_stats = sampler_stats.last_minute_stats()
-    hour_stats = sampler_stats.last_hour_stats()
-    all_time_stats = sampler_stats.all_time_stats()
-    print "%64s  ||   %10d %10d   ||   %10d %10d   ||   %10d %10d" %  \
-        (sampler_wrapper["name"],
-         minute_stats["median"], minute_stats["percentile_95"],
-         hour_stats["median"], hour_stats["percentile_95"],
-         all_time_stats["median"], all_time_stats["percentile_95"])
-
-def print_counters(counters, current_epoch_sec):
-  print "%64s  ||  %10s  ||  %10s  ||  %10s" % (
-    "name", "last min", "last hr", "all time")
-  print "-" * 150
-  for counter_wrapper in counters:
-    counter_stats = stats.CounterStats(counter_wrapper["value"], current_epoch_sec)
-    print "%64s  ||  %10d  ||  %10d  ||  %10d" % \
-        (counter_wrapper["name"],
-         counter_stats.last_minute_count(),
-         counter_stats.last_hour_count(),
-         counter_stats.all_time_count())
-
-def sort_vars_by_name(vars_list):
-  return sorted(vars_list, key=lambda x:x["name"])
+DEFAULT_WINDOWS = "1m,1h,all"
+# Variables per task sent to a --jobs worker. A chunk is pickled as one message, so the pipe is
+# crossed once per chunk rather than once per variable; the sample lists are still Python lists.
+DEFAULT_CHUNK_SIZE = 256
+# With --top, the highest rate candidates are trimmed back to N whenever this many more are held
+TOP_CANDIDATES_SLACK = 4096
+
+def parse_windows(windows_arg):
+  '''Parse a comma separated list like "1m,5m,15m,1h,all" into window lengths in minutes, with
+     None standing for all time'''
+  windows = []
+  for window in windows_arg.split(","):
+    if window == "all":
+      windows.append(None)
+    elif window[-1:] in ("m", "h") and window[:-1].isdigit() and 0 < int(window[:-1]):
+      windows.append(int(window[:-1]) * (60 if window[-1] == "h" else 1))
+    else:
+      raise argparse.ArgumentTypeError("bad window '%s', expected e.g. 5m, 1h or all" % window)
+  if [w for w in windows if w is not None and w > 60]:
+    raise argparse.ArgumentTypeError("counters only keep an hour of history, windows must be <= 1h")
+  return windows
+
+def sampler_window_label(window):
+  if window is None:
+    return "All Time"
+  if window == 1:
+    return "Last Minute"
+  if window == 60:
+    return "Last Hour"
+  return "Last %d Minutes" % window
+
+def counter_window_label(window):
+  if window is None:
+    return "all time"
+  if window == 1:
+    return "last min"
+  if window == 60:
+    return "last hr"
+  return "last %dm" % window
+
+def sampler_row(name, sampler_data, current_epoch_sec, windows):
+  '''Returns: (name, median, 95th) followed by the median and 95th of each window'''
+  sampler_stats = stats.SamplerStats(sampler_data, current_epoch_sec)
+  row = [name]
+  for window in windows:
+    if window is None:
+      window_stats = sampler_stats.all_time_stats()
+    elif window == 1:
+      window_stats = sampler_stats.last_minute_stats()
+    else:
+      window_stats = sampler_stats.stats_for_window(window * 60)
+    row.extend([window_stats["median"], window_stats["percentile_95"]])
+  return tuple(row)
+
+def counter_row(name, counter_data, current_epoch_sec, windows):
+  '''Returns: (name, ) followed by the count in each window'''
+  counter_stats = stats.CounterStats(counter_data, current_epoch_sec)
+  row = [name]
+  for window in windows:
+    if window is None:
+      row.append(counter_stats.all_time_count())
+    elif window == 1:
+      row.append(counter_stats.last_minute_count())
+    else:
+      row.append(counter_stats.count_for_window(window))
+  return tuple(row)
+
+def last_minute_rate(kind, value, current_epoch_sec):
+  '''Events in the current minute, used to rank variables for --top. Same count as the last minute
+     column, read straight from the dump so variables can be ranked before any row is built.'''
+  if kind == "mht_samplers":
+    latest_min = utils.epoch_sec_to_minutes_since_epoch(value["latest_time_sec"])
+    if latest_min != utils.epoch_sec_to_minutes_since_epoch(current_epoch_sec):
+      return 0
+    return value["last_minute_samples"]["num_events"]
+  return stats.CounterStats(value, current_epoch_sec).last_minute_count()
+
+def variable_fingerprint(kind, value):
+  '''Changes whenever the daemon records an event for the variable'''
+  if kind == "mht_samplers":
+    return (value["latest_time_sec"], value["all_time_samples"]["num_events"])
+  return (value["latest_time_sec"], value["all_time_count"])
+
+def row_fingerprint(kind, value, current_epoch_sec):
+  return (variable_fingerprint(kind, value), current_epoch_sec / 60)
+
+def compute_row(kind, name, value, current_epoch_sec, windows):
+  row_fn = sampler_row if kind == "mht_samplers" else counter_row
+  return row_fn(name, value, current_epoch_sec, windows)
+
+def compute_chunk(kind, entries, current_epoch_sec, windows):
+  '''Worker task: the row of each (name, value) of one kind'''
+  return [compute_row(kind, name, value, current_epoch_sec, windows) for name, value in entries]
+
+def _ignore_sigint():
+  # Ctrl-C is handled by the parent, which terminates the pool
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def create_pool(jobs):
+  '''Returns: a process pool of jobs workers for collect_rows, or None to compute in-process
+     when jobs is 1. 0 means one worker per CPU.'''
+  if jobs == 1:
+    return None
+  return multiprocessing.Pool(jobs or None, _ignore_sigint)
+
+class RowCache(object):
+  '''Rows computed by earlier polls. A variable's row is reused while its fingerprint is unchanged
+     and we are still in the same minute; the windows only move on by whole minutes for counters,
+     so sampler windows may show a sample that aged out up to a minute late.'''
+
+  def __init__(self):
+    self.entries = {}
+    self.num_computed = 0
+
+  def row(self, kind, name, value, current_epoch_sec, windows):
+    key = (kind, name)
+    fingerprint = row_fingerprint(kind, value, current_epoch_sec)
+    row = self.lookup(key, fingerprint)
+    if row is None:
+      row = compute_row(kind, name, value, current_epoch_sec, windows)
+      self.store(key, fingerprint, row)
+    return row
+
+  def lookup(self, key, fingerprint):
+    '''Returns: the cached row of key if it was computed for fingerprint, else None'''
+    cached = self.entries.get(key)
+    if cached is not None and cached[0] == fingerprint:
+      return cached[1]
+    return None
+
+  def store(self, key, fingerprint, row):
+    self.entries[key] = (fingerprint, row)
+    self.num_computed += 1
+
+  def retain_only(self, keys):
+    '''Forget variables that are no longer in the dump'''
+    for key in set(self.entries) - keys:
+      del self.entries[key]
+
+def collect_rows(c, current_epoch_sec, args, cache, pool=None, chunk_size=DEFAULT_CHUNK_SIZE):
+  '''Stream one dump and build its report rows. With args.top, variables are first ranked by
+     last_minute_rate, keeping ties for the first names, and rows are only built for the top ones.
+  Arguments
+    pool (optional): A process pool from create_pool. Variables not found in the cache are then
+        sent to it in chunks of chunk_size and computed while the dump is still streaming in.
+  Returns: (sampler_rows, counter_rows), each sorted by name'''
+  name_filter = re.compile(args.filter) if args.filter else None
+  rows = {"mht_samplers": [], "mht_counters": []}
+  seen = set()
+  # (-rate, name, value) of the variables that may still make the top, per kind
+  top_candidates = {"mht_samplers": [], "mht_counters": []}
+  chunks = {"mht_samplers": [], "mht_counters": []}
+  # (kind, [(key, fingerprint)], AsyncResult) of every chunk handed to the pool
+  pending = []
+  def submit(kind):
+    chunk = chunks[kind]
+    chunks[kind] = []
+    result = pool.apply_async(compute_chunk, (kind, [entry for key, fingerprint, entry in chunk],
+                                              current_epoch_sec, args.windows))
+    pending.append((kind, [(key, fingerprint) for key, fingerprint, entry in chunk], result))
+  def add_row(kind, name, value):
+    if pool is None:
+      rows[kind].append(cache.row(kind, name, value, current_epoch_sec, args.windows))
+      return
+    key = (kind, name)
+    fingerprint = row_fingerprint(kind, value, current_epoch_sec)
+    row = cache.lookup(key, fingerprint)
+    if row is not None:
+      rows[kind].append(row)
+      return
+    chunks[kind].append((key, fingerprint, (name, value)))
+    if len(chunks[kind]) >= chunk_size:
+      submit(kind)
+  for kind, name, value in c.iter_dump():
+    if name_filter and not name_filter.search(name):
+      continue
+    seen.add((kind, name))
+    if not args.top:
+      add_row(kind, name, value)
+      continue
+    candidates = top_candidates[kind]
+    # Names are unique per kind, so values are never compared
+    candidates.append((-last_minute_rate(kind, value, current_epoch_sec), name, value))
+    if len(candidates) >= args.top + TOP_CANDIDATES_SLACK:
+      top_candidates[kind] = heapq.nsmallest(args.top, candidates)
+  if args.top:
+    for kind, candidates in top_candidates.iteritems():
+      for _, name, value in heapq.nsmallest(args.top, candidates):
+        add_row(kind, name, value)
+  for kind in chunks:
+    if chunks[kind]:
+      submit(kind)
+  for kind, keys, result in pending:
+    for (key, fingerprint), row in zip(keys, result.get()):
+      cache.store(key, fingerprint, row)
+      rows[kind].append(row)
+  cache.retain_only(seen)
+  return (sorted(rows["mht_samplers"]), sorted(rows["mht_counters"]))
+
+def sampler_lines(sampler_rows, windows):
+  lines = ["%64s  ||   " % "" + "   ||   ".join(
+               "%21s" % sampler_window_label(window) for window in windows),
+           "%64s  ||   " % "name" + "   ||   ".join(
+               "%10s %10s" % ("median", "95th") for window in windows),
+           "-" * 150]
+  row_format = "%64s  ||   " + "   ||   ".join("%10d %10d" for window in windows)
+  lines.extend(row_format % row for row in sampler_rows)
+  return lines
+
+def counter_lines(counter_rows, windows):
+  lines = ["%64s" % "name" + "".join("  ||  %10s" % counter_window_label(window)
+                                     for window in windows),
+           "-" * 150]
+  row_format = "%64s" + "".join("  ||  %10d" for window in windows)
+  lines.extend(row_format % row for row in counter_rows)
+  return lines
+
+def report_lines(sampler_rows, counter_rows, windows):
+  return (["SAMPLERS"] + sampler_lines(sampler_rows, windows) + ["", "COUNTERS"] +
+          counter_lines(counter_rows, windows))
+
+class TerminalRedrawer(object):
+  '''Draws a list of lines on an ANSI terminal, rewriting only the lines that changed since the
+     previous draw'''
+
+  def __init__(self, out):
+    self.out = out
+    self.lines = None
+
+  def draw(self, lines):
+    output = []
+    previous_lines = self.lines
+    if previous_lines is None:
+      output.append("\033[H\033[2J")
+      previous_lines = []
+    for i, line in enumerate(lines):
+      if i >= len(previous_lines) or previous_lines[i] != line:
+        output.append("\033[%d;1H%s\033[K" % (i + 1, line))
+    if len(lines) < len(previous_lines):
+      output.append("\033[%d;1H\033[J" % (len(lines) + 1))
+    self.out.write("".join(output))
+    self.out.flush()
+    self.lines = lines
+
+def watch(c, args, pool=None):
+  '''Poll every args.watch seconds until interrupted, only recomputing changed variables'''
+  cache = RowCache()
+  redrawer = TerminalRedrawer(sys.stdout)
+  try:
+    while True:
+      current_epoch_sec = utils.datetime_to_sec_since_epoch(datetime.datetime.now())
+      cache.num_computed = 0
+      sampler_rows, counter_rows = collect_rows(c, current_epoch_sec, args, cache, pool)
+      status = "Every %gs: %s   (recomputed %d of %d variables)" % (
+          args.watch, utils.sec_since_epoch_to_datetime(current_epoch_sec), cache.num_computed,
+          len(cache.entries))
+      redrawer.draw([status, ""] + report_lines(sampler_rows, counter_rows, args.windows))
+      time.sleep(args.watch)
+  except KeyboardInterrupt:
+    sys.stdout.write("\n")
+
+def main_parser():
+  parser = argparse.ArgumentParser(description="Print stats for every variable on a varz daemon")
+  parser.add_argument("--windows", type=parse_windows, default=parse_windows(DEFAULT_WINDOWS),
+                      help="Comma separated columns, e.g. 1m,5m,15m,30m,1h,all (default %s)" %
+                           DEFAULT_WINDOWS)
+  parser.add_argument("--filter", help="Only show variables whose name matches this regex")
+  parser.add_argument("--top", type=int, metavar="N",
+                      help="Only show the N samplers and N counters with the most events this minute")
+  parser.add_argument("--watch", type=float, metavar="INTERVAL",
+                      help="Refresh every INTERVAL seconds, redrawing only rows that changed")
+  parser.add_argument("--jobs", type=int, default=1, metavar="N",
+                      help="Compute stats in N worker processes, 0 for one per CPU (default 1)")
+  parser.add_argument("--shards", type=sharded.parse_shards, metavar="HOST:UDP:TCP,...",
+                      help="Report on variables sharded over these daemons instead of localhost")
+  return parser
 
 def main(argv):
-  current_epoch_sec = utils.datetime_to_sec_since_epoch(datetime.datetime.now())
-  c = client.VARZClient()
-  dump = c.all_dump()
-  print "SAMPLERS"
-  print_samplers(sort_vars_by_name(dump["mht_samplers"]), current_epoch_sec)
-  print ""
-  print "COUNTERS"
-  print_counters(sort_vars_by_name(dump["mht_counters"]), current_epoch_sec)
+  parser = main_parser()
+  args = parser.parse_args(argv[1:])
+
+  if args.shards:
+    c = sharded.ShardedVARZClient(args.shards)
+  else:
+    c = client.VARZClient()
+  if args.jobs < 0:
+    parser.error("--jobs must be 0 or more")
+  pool = create_pool(args.jobs)
+  try:
+    if args.watch:
+      watch(c, args, pool)
+      return
+    current_epoch_sec = utils.datetime_to_sec_since_epoch(datetime.datetime.now())
+    # Rows are computed as the dump streams in, so only one variable's samples are held at a time,
+    # or with --jobs the chunks still waiting for a worker, or with --top the current candidates
+    sampler_rows, counter_rows = collect_rows(c, current_epoch_sec, args, RowCache(), pool)
+    sys.stdout.write("\n".join(report_lines(sampler_rows, counter_rows, args.windows)) + "\n")
+  finally:
+    if pool is not None:
+      pool.terminate()
 
 if __name__ == "__main__":
   main(sys.argv)
@@ -0,0 +1,337 @@
+'''A Python implementation of the server side of the varz protocol, for local load testing and
+regression tests, or embedded in a process as a local aggregator.
+
+UDP accepts MHTCOUNTERADD/MHTSAMPLEADD. TCP accepts the same plus ALLDUMPJSON, ALLLISTJSON and
+ALLFLUSH. Several ';' terminated commands may share one datagram or one TCP stream. Add commands
+never get a reply, so a TCP client can pipeline them over one connection; the other commands are
+answered and the connection is closed after the reply, which is how clients find its end.'''
+import errno
+try:
+  import simplejson as json
+except ImportError:
+  import json
+import os
+import random
+import select
+import socket
+import sys
+import threading
+
+import utils
+
+
+class Counter(object):
+  __slots__ = ("min_counters", "all_time_count", "latest_time_sec")
+
+  def __init__(self):
+    self.min_counters = [0] * 60
+    self.all_time_count = 0
+    self.latest_time_sec = 0
+
+  def add(self, sec_since_epoch, amt):
+    self.all_time_count += amt
+    latest_min = utils.epoch_sec_to_minutes_since_epoch(self.latest_time_sec)
+    event_min = utils.epoch_sec_to_minutes_since_epoch(sec_since_epoch)
+    if event_min > latest_min:
+      # Zero the slots of the minutes we skipped, they now hold data from over an hour ago
+      for minute in xrange(max(latest_min + 1, event_min - 59), event_min + 1):
+        self.min_counters[minute % 60] = 0
+      self.latest_time_sec = sec_since_epoch
+    elif event_min <= latest_min - 60:
+      return # Older than the ring, only counts towards all_time_count
+    elif sec_since_epoch > self.latest_time_sec:
+      self.latest_time_sec = sec_since_epoch
+    self.min_counters[event_min % 60] += amt
+
+  def to_json(self):
+    '''Returns: the COUNTER_JSON object'''
+    return {"min_counters": list(self.min_counters),
+            "all_time_count": self.all_time_count,
+            "latest_time_sec": self.latest_time_sec}
+
+
+class Reservoir(object):
+  '''Uniform reservoir sample (algorithm R) of the (value, time) pairs added to it'''
+  __slots__ = ("size", "sample_values", "sample_times_sec", "num_events")
+
+  def __init__(self, size):
+    self.size = size
+    self.sample_values = []
+    self.sample_times_sec = []
+    self.num_events = 0
+
+  def add(self, sec_since_epoch, value):
+    self.num_events += 1
+    if len(self.sample_values) < self.size:
+      self.sample_values.append(value)
+      self.sample_times_sec.append(sec_since_epoch)
+      return
+    pos = random.randrange(self.num_events)
+    if pos < self.size:
+      self.sample_values[pos] = value
+      self.sample_times_sec[pos] = sec_since_epoch
+
+  def to_json(self):
+    return {"sample_values": list(self.sample_values),
+            "sample_times_sec": list(self.sample_times_sec),
+            "samples_size": len(self.sample_values),
+            "num_events": self.num_events}
+
+
+class Sampler(object):
+  __slots__ = ("last_minute_samples", "all_time_samples", "latest_time_sec", "last_minute_size")
+
+  def __init__(self, last_minute_size, all_time_size):
+    self.last_minute_size = last_minute_size
+    self.last_minute_samples = Reservoir(last_minute_size)
+    self.all_time_samples = Reservoir(all_time_size)
+    self.latest_time_sec = 0
+
+  def add(self, sec_since_epoch, value):
+    self.all_time_samples.add(sec_since_epoch, value)
+    latest_min = utils.epoch_sec_to_minutes_since_epoch(self.latest_time_sec)
+    event_min = utils.epoch_sec_to_minutes_since_epoch(sec_since_epoch)
+    if event_min > latest_min:
+      self.last_minute_samples = Reservoir(self.last_minute_size)
+    if event_min >= latest_min:
+      self.last_minute_samples.add(sec_since_epoch, value)
+    if sec_since_epoch > self.latest_time_sec:
+      self.latest_time_sec = sec_since_epoch
+
+  def to_json(self):
+    '''Returns: the SAMPLER_JSON object'''
+    return {"latest_time_sec": self.latest_time_sec,
+            "last_minute_samples": self.last_minute_samples.to_json(),
+            "all_time_samples": self.all_time_samples.to_json()}
+
+
+class VARZServer(object):
+  '''Holds counters and samplers and optionally serves them over UDP/TCP from a background thread.
+     counter_add, sampler_add and the all_* methods may be called directly from any thread, which
+     is all an embedded aggregator needs.'''
+  DEFAULT_LAST_MINUTE_RESERVOIR_SIZE = 128
+  DEFAULT_ALL_TIME_RESERVOIR_SIZE = 1024
+  MAX_DATAGRAM_SIZE = 65536
+  # Datagrams drained per wakeup before TCP connections get a turn
+  MAX_DATAGRAMS_PER_WAKEUP = 256
+
+  def __init__(self, hostname='localhost', udp_port=4447, tcp_port=14447,
+               last_minute_reservoir_size=DEFAULT_LAST_MINUTE_RESERVOIR_SIZE,
+               all_time_reservoir_size=DEFAULT_ALL_TIME_RESERVOIR_SIZE):
+    '''Port 0 picks a free port; the bound ports are in udp_port and tcp_port after start()'''
+    self.hostname = hostname
+    self.udp_port = udp_port
+    self.tcp_port = tcp_port
+    self.last_minute_reservoir_size = last_minute_reservoir_size
+    self.all_time_reservoir_size = all_time_reservoir_size
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.samplers = {}
+    self.num_bad_commands = 0
+    self.udp_socket = None
+    self.tcp_listener = None
+    self.wakeup_fds = None
+    self.connections = {}
+    self.thread = None
+    self.running = False
+
+  def counter_add(self, counter_name, sec_since_epoch, amt):
+    with self.lock:
+      self._counter_add(counter_name, sec_since_epoch, amt)
+
+  def sampler_add(self, sampler_name, sec_since_epoch, value):
+    with self.lock:
+      self._sampler_add(sampler_name, sec_since_epoch, value)
+
+  def all_dump(self):
+    '''Returns: the same object VARZClient.all_dump returns'''
+    with self.lock:
+      return {"mht_counters": [{"name": name, "value": counter.to_json()}
+                               for name, counter in self.counters.iteritems()],
+              "mht_samplers": [{"name": name, "value": sampler.to_json()}
+                               for name, sampler in self.samplers.iteritems()]}
+
+  def all_list(self):
+    with self.lock:
+      return {"mht_counters": self.counters.keys(), "mht_samplers": self.samplers.keys()}
+
+  def all_flush(self):
+    with self.lock:
+      self.counters = {}
+      self.samplers = {}
+
+  def _counter_add(self, counter_name, sec_since_epoch, amt):
+    counter = self.counters.get(counter_name)
+    if counter is None:
+      counter = self.counters[counter_name] = Counter()
+    counter.add(sec_since_epoch, amt)
+
+  def _sampler_add(self, sampler_name, sec_since_epoch, value):
+    sampler = self.samplers.get(sampler_name)
+    if sampler is None:
+      sampler = self.samplers[sampler_name] = Sampler(self.last_minute_reservoir_size,
+                                                      self.all_time_reservoir_size)
+    sampler.add(sec_since_epoch, value)
+
+  def execute_commands(self, data):
+    '''Apply every complete ';' terminated command in data
+    Returns: (the commands that need a reply, in order, the unterminated remainder of data)'''
+    commands = data.split(";")
+    remainder = commands.pop()
+    replies = []
+    with self.lock:
+      for command in commands:
+        parts = command.split()
+        if not parts:
+          continue
+        try:
+          if parts[0] == "MHTCOUNTERADD" and len(parts) == 4:
+            self._counter_add(parts[1], int(parts[2]), int(parts[3]))
+          elif parts[0] == "MHTSAMPLEADD" and len(parts) == 4:
+            self._sampler_add(parts[1], int(parts[2]), int(parts[3]))
+          elif len(parts) == 1 and parts[0] in ("ALLDUMPJSON", "ALLLISTJSON", "ALLFLUSH"):
+            replies.append(parts[0])
+          else:
+            self.num_bad_commands += 1
+        except ValueError:
+          self.num_bad_commands += 1
+    return (replies, remainder)
+
+  def _reply(self, command):
+    if command == "ALLDUMPJSON":
+      return json.dumps(self.all_dump())
+    if command == "ALLLISTJSON":
+      return json.dumps(self.all_list())
+    self.all_flush()
+    return ""
+
+  def start(self):
+    '''Bind the sockets and serve from a daemon thread until stop()'''
+    self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    self.udp_socket.bind((self.hostname, self.udp_port))
+    self.udp_socket.setblocking(False)
+    self.udp_port = self.udp_socket.getsockname()[1]
+    self.tcp_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.tcp_listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.tcp_listener.bind((self.hostname, self.tcp_port))
+    self.tcp_listener.listen(128)
+    self.tcp_listener.setblocking(False)
+    self.tcp_port = self.tcp_listener.getsockname()[1]
+    self.wakeup_fds = os.pipe()
+    self.running = True
+    self.thread = threading.Thread(target=self.serve_forever, name="varz-server")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.running = False
+    os.write(self.wakeup_fds[1], "x")
+    self.thread.join()
+    for conn in self.connections.values():
+      conn.sock.close()
+    self.connections = {}
+    self.udp_socket.close()
+    self.tcp_listener.close()
+    for fd in self.wakeup_fds:
+      os.close(fd)
+
+  def serve_forever(self):
+    while self.running:
+      readers = [self.udp_socket, self.tcp_listener, self.wakeup_fds[0]] + self.connections.keys()
+      writers = [sock for sock, conn in self.connections.iteritems() if conn.outbound]
+      readable, writable, _ = select.select(readers, writers, [])
+      for sock in readable:
+        if sock is self.udp_socket:
+          self._read_datagrams()
+        elif sock is self.tcp_listener:
+          self._accept()
+        elif sock == self.wakeup_fds[0]:
+          os.read(self.wakeup_fds[0], 64)
+        elif sock in self.connections:
+          self._read_connection(self.connections[sock])
+      for sock in writable:
+        if sock in self.connections:
+          self._write_connection(self.connections[sock])
+
+  def _read_datagrams(self):
+    for x in xrange(VARZServer.MAX_DATAGRAMS_PER_WAKEUP):
+      try:
+        datagram = self.udp_socket.recv(VARZServer.MAX_DATAGRAM_SIZE)
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        raise
+      # A datagram always ends on a command boundary, so any remainder is garbage
+      self.execute_commands(datagram)
+
+  def _accept(self):
+    while True:
+      try:
+        sock, _ = self.tcp_listener.accept()
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        raise
+      sock.setblocking(False)
+      self.connections[sock] = _Connection(sock)
+
+  def _read_connection(self, conn):
+    try:
+      data = conn.sock.recv(VARZServer.MAX_DATAGRAM_SIZE)
+    except socket.error as e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return
+      data = ""
+    if not data:
+      self._close_connection(conn)
+      return
+    if conn.closing:
+      return # Already replied, ignore anything after the command we are answering
+    replies, conn.pending = self.execute_commands(conn.pending + data)
+    if replies:
+      conn.outbound = memoryview(self._reply(replies[0]))
+      conn.closing = True
+      self._write_connection(conn)
+
+  def _write_connection(self, conn):
+    try:
+      sent = conn.sock.send(conn.outbound)
+    except socket.error as e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return
+      self._close_connection(conn)
+      return
+    conn.outbound = conn.outbound[sent:]
+    if not conn.outbound and conn.closing:
+      self._close_connection(conn)
+
+  def _close_connection(self, conn):
+    del self.connections[conn.sock]
+    conn.sock.close()
+
+
+class _Connection(object):
+  __slots__ = ("sock", "pending", "outbound", "closing")
+
+  def __init__(self, sock):
+    self.sock = sock
+    self.pending = ""
+    self.outbound = ""
+    self.closing = False
+
+
+def main(argv):
+  udp_port = int(argv[1]) if len(argv) > 1 else 4447
+  tcp_port = int(argv[2]) if len(argv) > 2 else 14447
+  server = VARZServer(udp_port=udp_port, tcp_port=tcp_port)
+  server.start()
+  print "Serving varz on udp:%d tcp:%d" % (server.udp_port, server.tcp_port)
+  try:
+    while server.thread.is_alive():
+      server.thread.join(1)
+  except KeyboardInterrupt:
+    server.stop()
+
+if __name__ == "__main__":
+  main(sys.argv)
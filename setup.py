@@ -1,7 +1,13 @@
+import sys
 from distutils.core import setup
 
+packages = ["varz_client"]
+if sys.version_info[0] >= 3:
+  # The asyncio client; varz_client itself still targets Python 2
+  packages.append("varz_async")
+
 setup(name="varz_client",
       version='0.2a', 
-      package_dir={"varz_client": ""},
-      packages=["varz_client"],
+      package_dir={"varz_client": "", "varz_async": "varz_async"},
+      packages=packages,
      )
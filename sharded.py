@@ -0,0 +1,166 @@
+'''Spreads variables over several varz daemons. Every name is routed to one shard by consistent
+hashing, so adding or removing a shard only moves about 1/N of the names; dumps and lists are
+fetched from all shards in parallel and merged into the single daemon format.'''
+import bisect
+import hashlib
+import struct
+import threading
+
+import client
+import merge
+
+
+class HashRing(object):
+  '''Consistent hash ring. Each node is placed at replicas points so names spread evenly.'''
+  DEFAULT_REPLICAS = 160
+
+  def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+    '''Arguments
+      nodes: Distinct node keys (strings); a node's points only depend on its own key
+      replicas (optional): Points per node'''
+    points = sorted((_hash("%s#%d" % (node, i)), node) for node in nodes for i in xrange(replicas))
+    self.hashes = [h for h, node in points]
+    self.nodes = [node for h, node in points]
+
+  def node_for(self, name):
+    '''Returns: the node owning name, i.e. the first point clockwise from its hash'''
+    index = bisect.bisect(self.hashes, _hash(name))
+    return self.nodes[index % len(self.nodes)]
+
+
+def _hash(key):
+  return struct.unpack(">Q", hashlib.md5(key).digest()[:8])[0]
+
+
+def shard_key(shard):
+  '''Returns: the ring key of a (hostname, udp_port, tcp_port) shard'''
+  return "%s:%d:%d" % shard
+
+
+def merge_dumps(dumps):
+  '''Combine the all_dump results of several shards into one dump. A name present on more than one
+     shard (it moved when shards were added) is merged like the dumps of several hosts, see
+     merge.DumpMerger, so the old shard's minutes, totals and samples are kept.'''
+  return merge.merge_dumps(dumps)
+
+
+def merge_lists(lists):
+  '''Combine the all_list results of several shards into one, without duplicate names'''
+  merged = {}
+  for kind in ("mht_counters", "mht_samplers"):
+    names = set()
+    for names_list in lists:
+      names.update(names_list.get(kind, []))
+    merged[kind] = sorted(names)
+  return merged
+
+
+def fan_out(fns):
+  '''Call every fn in its own thread
+  Returns: their results, in order; re-raises the first exception after all of them finished'''
+  results = [None] * len(fns)
+  errors = [None] * len(fns)
+  def run(i):
+    try:
+      results[i] = fns[i]()
+    except Exception as e:
+      errors[i] = e
+  threads = [threading.Thread(target=run, args=(i,)) for i in xrange(len(fns))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  for error in errors:
+    if error is not None:
+      raise error
+  return results
+
+
+class ShardedVARZClient(object):
+  '''Same interface as client.VARZClient, over one VARZClient per shard'''
+  MODE_TCP = client.VARZClient.MODE_TCP
+  MODE_UDP = client.VARZClient.MODE_UDP
+
+  def __init__(self, shards, replicas=HashRing.DEFAULT_REPLICAS, **client_kwargs):
+    '''Arguments
+      shards: List of (hostname, udp_port, tcp_port)
+      replicas (optional): Points per shard on the hash ring
+      client_kwargs (optional): Passed on to every shard's VARZClient, e.g. batch_udp=True'''
+    self.shards = [tuple(shard) for shard in shards]
+    self.clients = [client.VARZClient(hostname, udp_port, tcp_port, **client_kwargs)
+                    for hostname, udp_port, tcp_port in self.shards]
+    clients_by_key = dict((shard_key(shard), c) for shard, c in zip(self.shards, self.clients))
+    self.ring = HashRing(clients_by_key.keys(), replicas)
+    self.clients_by_key = clients_by_key
+    # Ring lookups hash the name, so remember the shard of names already seen
+    self.name_clients = {}
+
+  def setup(self):
+    for c in self.clients:
+      c.setup()
+
+  def flush(self):
+    for c in self.clients:
+      c.flush()
+
+  def close(self):
+    for c in self.clients:
+      c.close()
+
+  def after_fork(self):
+    for c in self.clients:
+      c.after_fork()
+
+  def client_for(self, name):
+    '''Returns: the VARZClient of the shard owning name'''
+    c = self.name_clients.get(name)
+    if c is None:
+      c = self.name_clients[name] = self.clients_by_key[self.ring.node_for(name)]
+    return c
+
+  def counter_increment(self, counter_name, amt=1, time=None, mode=None):
+    '''See VARZClient.counter_increment'''
+    self.client_for(counter_name).counter_increment(counter_name, amt, time, mode)
+
+  def sampler_add(self, sampler_name, value, time=None, mode=None):
+    '''See VARZClient.sampler_add'''
+    self.client_for(sampler_name).sampler_add(sampler_name, value, time, mode)
+
+  def counter(self, counter_name, mode=None):
+    '''A prepared handle bound to the shard owning counter_name, see VARZClient.counter'''
+    return self.client_for(counter_name).counter(counter_name, mode)
+
+  def sampler(self, sampler_name, mode=None):
+    '''A prepared handle bound to the shard owning sampler_name, see VARZClient.sampler'''
+    return self.client_for(sampler_name).sampler(sampler_name, mode)
+
+  def all_dump(self):
+    '''Fetch every shard's dump in parallel
+    Returns: the merged dump, in the same format as VARZClient.all_dump'''
+    return merge_dumps(fan_out([c.all_dump for c in self.clients]))
+
+  def iter_dump(self):
+    '''Stream every shard's dump into one merger, see merge.fetch_and_merge
+    Returns: an iterator of (kind, name, value) like VARZClient.iter_dump, one per name'''
+    dump = merge.fetch_and_merge(self.clients)
+    for kind in ("mht_counters", "mht_samplers"):
+      for entry in dump[kind]:
+        yield (kind, entry["name"], entry["value"])
+
+  def all_list(self):
+    '''Fetch every shard's list in parallel
+    Returns: the merged list, in the same format as VARZClient.all_list'''
+    return merge_lists(fan_out([c.all_list for c in self.clients]))
+
+  def all_flush(self):
+    '''Flush every shard. Be very careful when calling it'''
+    fan_out([c.all_flush for c in self.clients])
+
+
+def parse_shards(shards_arg):
+  '''Parse "host:udp_port:tcp_port,host:udp_port:tcp_port" into a list of shards'''
+  shards = []
+  for shard in shards_arg.split(","):
+    hostname, udp_port, tcp_port = shard.rsplit(":", 2)
+    shards.append((hostname, int(udp_port), int(tcp_port)))
+  return shards
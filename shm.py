@@ -0,0 +1,305 @@
+'''Aggregation of counters and samples across pre-fork worker processes through a shared mmap.
+
+Create a SharedMetricsRegion in the master before forking. Each process then writes through its
+own SharedMemoryClient into a worker slot that no other process writes to, so the hot path takes
+no cross-process lock. Threads of one process share its slot, so each write holds the process's own
+threading.Lock: a counter increment adds to a cell of the worker's counter row, and a sample is
+pushed on the worker's ring, which has one producing process and one consumer. One sender, either
+a dedicated process running SharedMetricsSender or a worker elected through the region, drains
+every slot and sends one MHTCOUNTERADD per counter name per drain, so the packet rate doesn't grow
+with the number of workers. Samples are forwarded one command each, packed into datagrams if the
+sender's client batches.
+
+Only the rare operations (registering a new name, claiming a worker slot, draining) take the
+region's multiprocessing.Lock, and a drain releases it before sending anything. The sender reads
+the workers' slots without their threading.Locks, relying on aligned 64 bit stores becoming
+visible to other processes in program order, which holds on x86-64.'''
+import ctypes
+import errno
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+
+import client
+import utils
+
+KIND_COUNTER = 1
+KIND_SAMPLER = 2
+NAME_ENTRY_SIZE = client.VARZClient.MAX_NAME_LEN
+
+
+class _Header(ctypes.Structure):
+  _fields_ = [("num_names", ctypes.c_int64),
+              ("sender_pid", ctypes.c_int64),
+              ("sender_heartbeat", ctypes.c_double)]
+
+
+class _NameEntry(ctypes.Structure):
+  _fields_ = [("kind", ctypes.c_int32),
+              ("length", ctypes.c_int32),
+              ("name", ctypes.c_char * NAME_ENTRY_SIZE)]
+
+
+class _SampleEntry(ctypes.Structure):
+  _fields_ = [("name_index", ctypes.c_int64),
+              ("sec_since_epoch", ctypes.c_int64),
+              ("value", ctypes.c_int64)]
+
+
+def _pid_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+
+class SharedMetricsRegion(object):
+  '''The shared mmap and the lock guarding its rare operations. Must be created before fork().'''
+  DEFAULT_MAX_WORKERS = 64
+  DEFAULT_MAX_NAMES = 4096
+  DEFAULT_RING_SIZE = 4096
+
+  def __init__(self, max_workers=DEFAULT_MAX_WORKERS, max_names=DEFAULT_MAX_NAMES,
+               ring_size=DEFAULT_RING_SIZE):
+    self.max_workers = max_workers
+    self.max_names = max_names
+    self.ring_size = ring_size
+    self.lock = multiprocessing.Lock()
+    int64_row = ctypes.c_int64 * max_workers
+    cell_matrix = ctypes.c_int64 * (max_workers * max_names)
+    layout = [("header", _Header),
+              ("worker_pids", int64_row),
+              ("names", _NameEntry * max_names),
+              # counter_totals[worker * max_names + name] only ever grows; counter_sent is the
+              # part of it already sent, written only by the sender
+              ("counter_totals", cell_matrix),
+              ("counter_sent", cell_matrix),
+              ("ring_heads", int64_row),
+              ("ring_tails", int64_row),
+              ("ring_drops", int64_row),
+              ("rings", _SampleEntry * (max_workers * ring_size))]
+    size = sum(ctypes.sizeof(ctype) for _, ctype in layout)
+    # Anonymous mmaps are MAP_SHARED, so children see the parent's pages after fork
+    self.mmap = mmap.mmap(-1, size)
+    offset = 0
+    for name, ctype in layout:
+      setattr(self, name, ctype.from_buffer(self.mmap, offset))
+      offset += ctypes.sizeof(ctype)
+
+  def register_name(self, kind, name):
+    '''Returns: the index of (kind, name) in the name table, adding it if needed'''
+    with self.lock:
+      for index in xrange(self.header.num_names):
+        entry = self.names[index]
+        if entry.kind == kind and entry.name == name:
+          return index
+      index = self.header.num_names
+      if index >= self.max_names:
+        raise RuntimeError("all %d shared metric names are in use" % self.max_names)
+      entry = self.names[index]
+      entry.kind = kind
+      entry.length = len(name)
+      entry.name = name
+      # Published last, readers only look at entries below num_names
+      self.header.num_names = index + 1
+      return index
+
+  def claim_worker_slot(self):
+    '''Returns: a worker slot for this process, reusing the slots of processes that exited'''
+    pid = os.getpid()
+    with self.lock:
+      for worker in xrange(self.max_workers):
+        slot_pid = self.worker_pids[worker]
+        if slot_pid == 0 or slot_pid == pid or not _pid_alive(slot_pid):
+          self.worker_pids[worker] = pid
+          return worker
+    raise RuntimeError("all %d shared metric worker slots are in use" % self.max_workers)
+
+  def try_become_sender(self, stale_after_sec):
+    '''Elect this process as the sender if there is none or the current one stopped heartbeating
+    Returns: True if this process is the sender'''
+    pid = os.getpid()
+    now = time.time()
+    with self.lock:
+      header = self.header
+      if (header.sender_pid in (0, pid) or not _pid_alive(header.sender_pid) or
+          now - header.sender_heartbeat > stale_after_sec):
+        header.sender_pid = pid
+        header.sender_heartbeat = now
+        return True
+    return False
+
+  def dropped_samples(self):
+    '''Returns: how many samples were dropped because a worker's ring was full'''
+    return sum(self.ring_drops)
+
+
+class SharedMemoryClient(object):
+  '''Per-process writer into a SharedMetricsRegion. The same object may be used before and after
+     fork; a forked child notices the new pid, claims its own worker slot and calls the
+     varz_client's after_fork. Any number of threads of a process may use it.'''
+
+  def __init__(self, region, varz_client=None, elect_sender=False, interval_sec=1.0):
+    '''Arguments
+      region: A SharedMetricsRegion created before fork
+      varz_client (optional): Client the process sends with if it is elected sender
+      elect_sender (optional): If True, every process runs a thread that takes over sending when
+          no other process is doing it
+      interval_sec (optional): How often the elected sender drains the region'''
+    self.region = region
+    self.varz_client = varz_client
+    self.elect_sender = elect_sender
+    self.interval_sec = interval_sec
+    self.pid = None
+    # The process varz_client's sockets were set up in; a child gets its own on attach
+    self.varz_client_pid = os.getpid()
+    self.worker = None
+    self.name_indexes = {}
+    self.ring = None
+    self.attach_lock = threading.Lock()
+    self.lock = None
+
+  def counter_increment(self, counter_name, amt=1):
+    '''Add amt to counter_name. The event is reported in the second the sender drains it.'''
+    if self.pid != os.getpid():
+      self._attach()
+    index = self.name_indexes.get((KIND_COUNTER, counter_name))
+    if index is None:
+      index = self._register(KIND_COUNTER, counter_name)
+    with self.lock:
+      self.region.counter_totals[self.counter_row + index] += amt
+
+  def sampler_add(self, sampler_name, value, time=None):
+    '''Queue a sample for the sender; dropped and counted if this worker's ring is full'''
+    if self.pid != os.getpid():
+      self._attach()
+    index = self.name_indexes.get((KIND_SAMPLER, sampler_name))
+    if index is None:
+      index = self._register(KIND_SAMPLER, sampler_name)
+    if time is None:
+      sec_since_epoch = utils.sec_since_epoch_now()
+    else:
+      sec_since_epoch = utils.datetime_to_sec_since_epoch(time)
+    region = self.region
+    worker = self.worker
+    with self.lock:
+      head = region.ring_heads[worker]
+      if head - region.ring_tails[worker] >= region.ring_size:
+        region.ring_drops[worker] += 1
+        return
+      entry = self.ring[head % region.ring_size]
+      entry.name_index = index
+      entry.sec_since_epoch = sec_since_epoch
+      entry.value = value
+      # Published last, the sender only reads entries below the head
+      region.ring_heads[worker] = head + 1
+
+  def _register(self, kind, name):
+    client._validate_name(name)
+    if kind == KIND_SAMPLER and getattr(self.varz_client, "sampler_limiter", None):
+      # Rejected here rather than when the sender drains the sample
+      client._validate_sampled_name_len(name)
+    index = self.region.register_name(kind, name)
+    self.name_indexes[(kind, name)] = index
+    return index
+
+  def _attach(self):
+    '''First use in this process: claim a worker slot and, if asked, start the election thread'''
+    with self.attach_lock:
+      if self.pid != os.getpid():
+        self._attach_locked()
+
+  def _attach_locked(self):
+    region = self.region
+    pid = os.getpid()
+    if self.varz_client and self.varz_client_pid != pid:
+      # Only in a forked child, and on the caller's thread rather than the election thread
+      self.varz_client.after_fork()
+      self.varz_client_pid = pid
+    # The parent's lock may have been held by another of its threads at fork time
+    self.lock = threading.Lock()
+    self.worker = region.claim_worker_slot()
+    self.counter_row = self.worker * region.max_names
+    ring_start = self.worker * region.ring_size
+    self.ring = (_SampleEntry * region.ring_size).from_buffer(
+        region.rings, ring_start * ctypes.sizeof(_SampleEntry))
+    # Published last: other threads skip attaching once pid matches
+    self.pid = pid
+    if self.elect_sender and self.varz_client:
+      thread = threading.Thread(target=self._run_election, name="varz-shm-election")
+      thread.daemon = True
+      thread.start()
+
+  def _run_election(self):
+    sender = SharedMetricsSender(self.region, self.varz_client)
+    my_pid = self.pid
+    while self.pid == my_pid:
+      if self.region.try_become_sender(stale_after_sec=3 * self.interval_sec):
+        sender.drain()
+      time.sleep(self.interval_sec)
+
+
+class SharedMetricsSender(object):
+  '''Drains a SharedMetricsRegion into a VARZClient. Run it in one process only, or let
+     SharedMemoryClient elect one.'''
+
+  def __init__(self, region, varz_client):
+    self.region = region
+    self.varz_client = varz_client
+    self.names = []
+
+  def drain(self):
+    '''Send the counter increments and samples written since the last drain. They are copied out
+       under the region's lock and sent after releasing it, so workers registering names or
+       claiming slots never wait on the network.'''
+    region = self.region
+    samples = []
+    with region.lock:
+      self._refresh_names()
+      num_names = len(self.names)
+      sec_since_epoch = utils.sec_since_epoch_now()
+      counter_deltas = [0] * num_names
+      for worker in xrange(region.max_workers):
+        if region.worker_pids[worker] == 0:
+          continue
+        row = worker * region.max_names
+        for index in xrange(num_names):
+          total = region.counter_totals[row + index]
+          sent = region.counter_sent[row + index]
+          if total != sent:
+            counter_deltas[index] += total - sent
+            region.counter_sent[row + index] = total
+        self._take_ring(worker, samples)
+      region.header.sender_heartbeat = time.time()
+    drain_time = utils.sec_since_epoch_to_datetime(sec_since_epoch)
+    for index, delta in enumerate(counter_deltas):
+      if delta:
+        self.varz_client.counter_increment(self.names[index], delta, time=drain_time)
+    for name_index, sample_sec_since_epoch, value in samples:
+      self.varz_client.sampler_add(self.names[name_index], value,
+                                   time=utils.sec_since_epoch_to_datetime(sample_sec_since_epoch))
+    self.varz_client.flush()
+
+  def _take_ring(self, worker, samples):
+    '''Append the (name_index, sec_since_epoch, value) of worker's queued samples to samples and
+       free their ring entries'''
+    region = self.region
+    tail = region.ring_tails[worker]
+    head = region.ring_heads[worker]
+    ring_start = worker * region.ring_size
+    for position in xrange(tail, head):
+      entry = region.rings[ring_start + position % region.ring_size]
+      samples.append((entry.name_index, entry.sec_since_epoch, entry.value))
+    region.ring_tails[worker] = head
+
+  def _refresh_names(self):
+    for index in xrange(len(self.names), self.region.header.num_names):
+      self.names.append(self.region.names[index].name)
+
+  def run_forever(self, interval_sec=1.0):
+    while True:
+      self.drain()
+      time.sleep(interval_sec)
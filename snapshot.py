@@ -0,0 +1,120 @@
+'''Compact in-memory form of an ALLDUMPJSON dump. Sample and counter columns are stored as
+array.array of 64 bit ints instead of lists of Python ints, and records use __slots__. Records
+answer the same record["key"] lookups as the JSON objects, so stats.SamplerStats and
+stats.CounterStats accept them directly.'''
+import array
+
+EMPTY_SAMPLES = {"sample_values": [], "sample_times_sec": [], "samples_size": 0, "num_events": 0}
+
+# 'q' is the portable 64 bit code but only exists from Python 3.3; 'l' is 64 bits on LP64 platforms
+try:
+  array.array("q")
+  INT64_TYPECODE = "q"
+except ValueError:
+  INT64_TYPECODE = "l"
+
+
+def int64_array(values):
+  return array.array(INT64_TYPECODE, values)
+
+
+class _Record(object):
+  __slots__ = ()
+
+  def __getitem__(self, key):
+    try:
+      return getattr(self, key)
+    except AttributeError:
+      raise KeyError(key)
+
+  def get(self, key, default=None):
+    return getattr(self, key, default)
+
+
+class SampleSet(_Record):
+  __slots__ = ("sample_values", "sample_times_sec", "samples_size", "num_events")
+
+  def __init__(self, sample_set):
+    '''Assumes sample_set is a sample set object of a SAMPLER_JSON'''
+    self.sample_values = int64_array(sample_set["sample_values"])
+    self.sample_times_sec = int64_array(sample_set["sample_times_sec"])
+    self.samples_size = sample_set["samples_size"]
+    self.num_events = sample_set["num_events"]
+
+
+class SamplerRecord(_Record):
+  __slots__ = ("latest_time_sec", "last_minute_samples", "all_time_samples")
+
+  def __init__(self, sampler_data):
+    '''Assumes that sampler_data is an SAMPLER_JSON object, per the protocol definition'''
+    self.latest_time_sec = sampler_data["latest_time_sec"]
+    self.last_minute_samples = SampleSet(sampler_data.get("last_minute_samples", EMPTY_SAMPLES))
+    self.all_time_samples = SampleSet(sampler_data["all_time_samples"])
+
+
+class CounterRecord(_Record):
+  __slots__ = ("min_counters", "all_time_count", "latest_time_sec")
+
+  def __init__(self, counter_data):
+    '''Assumes that the counter_data is the COUNTER_JSON object per the protocol definition'''
+    self.min_counters = int64_array(counter_data["min_counters"])
+    self.all_time_count = counter_data["all_time_count"]
+    self.latest_time_sec = counter_data["latest_time_sec"]
+
+
+class DumpSnapshot(object):
+  '''All counters and samplers of one dump, in dump order, with a name -> index table per kind'''
+  __slots__ = ("counter_names", "counters", "counter_index",
+               "sampler_names", "samplers", "sampler_index")
+
+  def __init__(self):
+    self.counter_names = []
+    self.counters = []
+    self.counter_index = {}
+    self.sampler_names = []
+    self.samplers = []
+    self.sampler_index = {}
+
+  @classmethod
+  def from_dump(cls, dump):
+    '''Build a snapshot from the result of VARZClient.all_dump'''
+    return cls.from_entries((kind, entry["name"], entry["value"])
+                            for kind in ("mht_counters", "mht_samplers")
+                            for entry in dump.get(kind, []))
+
+  @classmethod
+  def from_entries(cls, entries):
+    '''Build a snapshot from (kind, name, value) entries, e.g. VARZClient.iter_dump(), without ever
+       holding the whole dump in its JSON form'''
+    snapshot = cls()
+    for kind, name, value in entries:
+      if kind == "mht_samplers":
+        snapshot.add_sampler(name, value)
+      else:
+        snapshot.add_counter(name, value)
+    return snapshot
+
+  def add_counter(self, name, counter_data):
+    self.counter_index[name] = len(self.counters)
+    self.counter_names.append(name)
+    self.counters.append(CounterRecord(counter_data))
+
+  def add_sampler(self, name, sampler_data):
+    self.sampler_index[name] = len(self.samplers)
+    self.sampler_names.append(name)
+    self.samplers.append(SamplerRecord(sampler_data))
+
+  def counter(self, name):
+    '''Returns: the CounterRecord for name; raises KeyError if there is none'''
+    return self.counters[self.counter_index[name]]
+
+  def sampler(self, name):
+    '''Returns: the SamplerRecord for name; raises KeyError if there is none'''
+    return self.samplers[self.sampler_index[name]]
+
+  def iter_entries(self):
+    '''Returns: (kind, name, record) for every variable, like VARZClient.iter_dump'''
+    for name, record in zip(self.counter_names, self.counters):
+      yield ("mht_counters", name, record)
+    for name, record in zip(self.sampler_names, self.samplers):
+      yield ("mht_samplers", name, record)
@@ -1,84 +1,406 @@
+import bisect
 import datetime
+import math
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 import utils
 
+# The order statistics every *_stats() call reports, as (key, percentile)
+DEFAULT_PERCENTILES = [("quartile_1", 25), ("median", 50), ("quartile_3", 75), ("percentile_95", 95)]
+# Below this many samples, or above this many requested positions, sorting beats selection
+SELECTION_MIN_SAMPLES = 64
+SELECTION_MAX_POSITIONS = 8
+
+
+def percentile_key(percentile):
+  '''The stats dict key for an extra requested percentile, e.g. 99.9 -> "percentile_99.9"'''
+  return "percentile_%g" % percentile
+
+def percentile_position(num_samples, percentile):
+  '''Index of the given percentile in num_samples sorted samples. Same rule as the fixed quartiles:
+     floor(num_samples * percentile / 100), so the median of 4 samples is the 3rd.'''
+  return min(num_samples - 1, int(num_samples * percentile / 100.0))
+
+
+class SortedSamples(object):
+  '''A sample set sorted by value at most once. Percentiles of the whole set are read from the
+     cached order. A second index, sorted by time, finds the samples of any time window with
+     bisect; they are put in value order by their cached ranks, without comparing values again.'''
+
+  def __init__(self, sample_values, sample_times_sec=None):
+    self.sample_values = sample_values
+    self.sample_times_sec = sample_times_sec
+    self._order = None
+    self._ranks = None
+    self._time_order = None
+    self._sorted_times = None
+
+  def is_sorted(self):
+    return self._order is not None
+
+  def order(self):
+    '''Returns: sample indexes in ascending order of value'''
+    if self._order is None:
+      self._order = sorted(xrange(len(self.sample_values)), key=self.sample_values.__getitem__)
+    return self._order
+
+  def ranks(self):
+    '''Returns: the position of every sample in order()'''
+    if self._ranks is None:
+      self._ranks = [0] * len(self.sample_values)
+      for rank, i in enumerate(self.order()):
+        self._ranks[i] = rank
+    return self._ranks
+
+  def sorted_values(self):
+    values = self.sample_values
+    return [values[i] for i in self.order()]
+
+  def sorted_values_in_window(self, end_time, num_sec_before_end):
+    '''Returns: the values of samples with end_time >= time > end_time - num_sec_before_end, in
+        ascending order. O(log n + k log k) for k samples in the window once both indexes exist.'''
+    start, end = self.window_bounds(end_time, num_sec_before_end)
+    ranks = self.ranks()
+    order = self.order()
+    values = self.sample_values
+    return [values[order[rank]] for rank in sorted(ranks[i] for i in self._time_order[start:end])]
+
+  def window_bounds(self, end_time, num_sec_before_end):
+    '''Returns: (start, end) such that time_order()[start:end] are the samples with
+        end_time >= time > end_time - num_sec_before_end'''
+    sorted_times = self._sorted_times_index()
+    return (bisect.bisect_right(sorted_times, end_time - num_sec_before_end),
+            bisect.bisect_right(sorted_times, end_time))
+
+  def values_in_window(self, end_time, num_sec_before_end):
+    '''Returns: the values of samples with end_time >= time > end_time - num_sec_before_end, in
+        ascending order of time'''
+    start, end = self.window_bounds(end_time, num_sec_before_end)
+    values = self.sample_values
+    return [values[i] for i in self._time_order[start:end]]
+
+  def _sorted_times_index(self):
+    if self._sorted_times is None:
+      times = self.sample_times_sec
+      self._time_order = sorted(xrange(len(times)), key=times.__getitem__)
+      self._sorted_times = [times[i] for i in self._time_order]
+    return self._sorted_times
+
+
+class QuantileSketch(object):
+  '''Mergeable quantile sketch: a histogram with logarithmically sized buckets, as in HDR
+     histograms and DDSketch. Any quantile is within relative_accuracy of the exact sample value at
+     that rank, its size only grows with the log of the value range (a few hundred buckets for
+     1..10**9 at 1%), and merging two sketches adds their bucket counts. min_value and max_value
+     are exact.'''
+  DEFAULT_RELATIVE_ACCURACY = 0.01
+
+  def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+    if not 0 < relative_accuracy < 1:
+      raise ValueError("relative_accuracy must be between 0 and 1, got %r" % relative_accuracy)
+    self.relative_accuracy = relative_accuracy
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+    # Bucket i of each dict counts the values v with gamma**(i-1) < abs(v) <= gamma**i
+    self.positive = {}
+    self.negative = {}
+    self.zero_count = 0
+    self.count = 0
+    self.min_value = None
+    self.max_value = None
+
+  def add(self, value, count=1):
+    if value > 0:
+      buckets, index = self.positive, self._index(value)
+    elif value < 0:
+      buckets, index = self.negative, self._index(-value)
+    else:
+      self.zero_count += count
+      buckets = None
+    if buckets is not None:
+      buckets[index] = buckets.get(index, 0) + count
+    self._add_extremes(value, value, count)
+
+  def add_all(self, values):
+    '''Add every value of a list; vectorized when numpy is available'''
+    if numpy is None or len(values) < SELECTION_MIN_SAMPLES:
+      for value in values:
+        self.add(value)
+      return
+    values = numpy.asarray(values)
+    for buckets, magnitudes in [(self.positive, values[values > 0]),
+                                (self.negative, -values[values < 0])]:
+      if len(magnitudes):
+        indexes, counts = numpy.unique(numpy.ceil(numpy.log(magnitudes) / self.log_gamma),
+                                       return_counts=True)
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+          buckets[int(index)] = buckets.get(int(index), 0) + count
+    self.zero_count += int((values == 0).sum())
+    self._add_extremes(values.min().item(), values.max().item(), len(values))
+
+  def merge(self, other):
+    '''Add the counts of other, a sketch with the same relative_accuracy, to this one'''
+    if other.relative_accuracy != self.relative_accuracy:
+      raise ValueError("can't merge sketches with relative accuracies %r and %r" % (
+          self.relative_accuracy, other.relative_accuracy))
+    for buckets, other_buckets in [(self.positive, other.positive),
+                                   (self.negative, other.negative)]:
+      for index, count in other_buckets.iteritems():
+        buckets[index] = buckets.get(index, 0) + count
+    self.zero_count += other.zero_count
+    if other.count:
+      self._add_extremes(other.min_value, other.max_value, other.count)
+    return self
+
+  def quantile(self, percentile):
+    '''Returns: the value at percentile_position(count, percentile), within relative_accuracy;
+        0 for an empty sketch'''
+    if not self.count:
+      return 0
+    remaining = percentile_position(self.count, percentile)
+    for index in sorted(self.negative, reverse=True):
+      remaining -= self.negative[index]
+      if remaining < 0:
+        return self._clamp(-self._bucket_value(index))
+    remaining -= self.zero_count
+    if remaining < 0:
+      return 0
+    for index in sorted(self.positive):
+      remaining -= self.positive[index]
+      if remaining < 0:
+        return self._clamp(self._bucket_value(index))
+    return self.max_value
+
+  def to_json(self):
+    '''Returns: a JSON serializable object, the buckets of each sign as a dense run of counts'''
+    return {"relative_accuracy": self.relative_accuracy,
+            "count": self.count,
+            "zero_count": self.zero_count,
+            "min_value": self.min_value,
+            "max_value": self.max_value,
+            "positive": self._dense_buckets(self.positive),
+            "negative": self._dense_buckets(self.negative)}
+
+  @classmethod
+  def from_json(cls, sketch_json):
+    sketch = cls(sketch_json["relative_accuracy"])
+    for buckets, dense in [(sketch.positive, sketch_json["positive"]),
+                           (sketch.negative, sketch_json["negative"])]:
+      for offset, count in enumerate(dense["counts"]):
+        if count:
+          buckets[dense["first_index"] + offset] = count
+    sketch.zero_count = sketch_json["zero_count"]
+    sketch.count = sketch_json["count"]
+    sketch.min_value = sketch_json["min_value"]
+    sketch.max_value = sketch_json["max_value"]
+    return sketch
+
+  def _index(self, magnitude):
+    return int(math.ceil(math.log(magnitude) / self.log_gamma))
+
+  def _bucket_value(self, index):
+    # The point of the bucket with the same relative error to both of its bounds
+    return 2 * self.gamma ** index / (self.gamma + 1)
+
+  def _clamp(self, value):
+    return min(self.max_value, max(self.min_value, value))
+
+  def _add_extremes(self, min_value, max_value, count):
+    if not self.count:
+      self.min_value, self.max_value = min_value, max_value
+    else:
+      self.min_value = min(self.min_value, min_value)
+      self.max_value = max(self.max_value, max_value)
+    self.count += count
+
+  def _dense_buckets(self, buckets):
+    if not buckets:
+      return {"first_index": 0, "counts": []}
+    first_index = min(buckets)
+    return {"first_index": first_index,
+            "counts": [buckets.get(index, 0) for index in xrange(first_index, max(buckets) + 1)]}
+
+
+def sketch_order_statistics(sketch, percentiles=()):
+  '''The stats dict of SamplerStats._compute_order_statistics, read from a QuantileSketch.
+     Percentiles are rounded to the nearest int; largest_value is exact.'''
+  keyed_percentiles = DEFAULT_PERCENTILES + [(percentile_key(p), p) for p in percentiles]
+  stats = dict((key, int(round(sketch.quantile(p)))) for key, p in keyed_percentiles)
+  stats["largest_value"] = sketch.max_value if sketch.count else 0
+  return stats
+
 
 class SamplerStats(object):
   
-  def __init__(self, sampler_data, current_epoch_sec):
-    '''Assumes that sampler_data is an SAMPLER_JSON object, per the protocol definition'''
+  def __init__(self, sampler_data, current_epoch_sec, events_counter_data=None):
+    '''Assumes that sampler_data is an SAMPLER_JSON object, per the protocol definition
+    events_counter_data (optional): COUNTER_JSON of the sampler's companion counter (see
+        utils.sampler_events_counter_name) when the client samples values before sending them.
+        Event counts then come from it, since the sampler's num_events only counts what was sent.'''
     self.sampler_data = sampler_data
     self.current_epoch_sec = current_epoch_sec
     self.current_min = utils.epoch_sec_to_minutes_since_epoch(self.current_epoch_sec)
+    self.all_time_sorted = None
+    self.events_counter = None
+    if events_counter_data is not None:
+      self.events_counter = CounterStats(events_counter_data, current_epoch_sec)
 
-  def last_minute_stats(self):
+  def last_minute_stats(self, percentiles=()):
+    '''percentiles (optional): Extra percentiles to report, e.g. [99, 99.9], see percentile_key'''
     # TODO: Lots of changes need to happen to make this the last full clock time minute
     latest_min  = utils.epoch_sec_to_minutes_since_epoch(self.sampler_data["latest_time_sec"])
     if latest_min != self.current_min:
-      stats = self._compute_order_statistics([])
+      stats = self._compute_order_statistics([], percentiles)
       stats["count"] = 0
     else:
       last_minute_samples = self.sampler_data["last_minute_samples"]
-      stats = self._compute_order_statistics(last_minute_samples["sample_values"])
+      stats = self._compute_order_statistics(last_minute_samples["sample_values"], percentiles)
       stats["count"] = last_minute_samples["num_events"]
+    if self.events_counter:
+      stats["count"] = self.events_counter.last_minute_count()
     return stats
 
-  def all_time_stats(self):
-    all_time_samples = self.sampler_data["all_time_samples"]
-    stats = self._compute_order_statistics(all_time_samples["sample_values"])
-    stats["count"] = all_time_samples["num_events"]
+  def all_time_stats(self, percentiles=()):
+    '''percentiles (optional): Extra percentiles to report, e.g. [99, 99.9], see percentile_key'''
+    stats = self._compute_sorted_order_statistics(self._all_time_sorted().sorted_values(),
+                                                  percentiles)
+    stats["count"] = self._all_time_num_events()
     return stats
 
-  def last_hour_stats(self):
+  def last_hour_stats(self, percentiles=()):
+    '''percentiles (optional): Extra percentiles to report, e.g. [99, 99.9], see percentile_key'''
+    return self.stats_for_window(3600, percentiles)
+
+  def stats_for_window(self, seconds, percentiles=()):
+    '''Stats for the all time samples taken in the given number of seconds up to the current time.
+       Unlike last_minute_stats, stats_for_window(60) uses the all time reservoir.
+    Arguments
+      seconds: Length of the window, e.g. 300, 900, 1800 or 3600
+      percentiles (optional): Extra percentiles to report, e.g. [99, 99.9], see percentile_key'''
     all_time_samples = self.sampler_data["all_time_samples"]
-    last_hour_data = self._filter_last_n_seconds(sample_set=all_time_samples,
-                                                 end_time=self.current_epoch_sec,
-                                                 num_sec_before_end=3600)
-    stats = self._compute_order_statistics(last_hour_data)
-    stats["count"] = self._estimate_num_events_in_last_hour(all_time_samples, len(last_hour_data))
+    window_data = self._all_time_sorted().sorted_values_in_window(self.current_epoch_sec, seconds)
+    stats = self._compute_sorted_order_statistics(window_data, percentiles)
+    stats["count"] = self._estimate_num_events_in_window(all_time_samples, len(window_data),
+                                                         seconds)
     return stats
 
-  def _estimate_num_events_in_last_hour(self, all_time_samples, num_last_hour_samples):
-    num_all_time_events = all_time_samples["num_events"]
+  def _all_time_sorted(self):
+    '''Returns: the SortedSamples of the all time reservoir, sorted on first use and shared by
+        all_time_stats and every window'''
+    if self.all_time_sorted is None:
+      all_time_samples = self.sampler_data["all_time_samples"]
+      self.all_time_sorted = SortedSamples(all_time_samples["sample_values"],
+                                           all_time_samples["sample_times_sec"])
+    return self.all_time_sorted
+
+  def _all_time_num_events(self):
+    if self.events_counter:
+      return self.events_counter.all_time_count()
+    return self.sampler_data["all_time_samples"]["num_events"]
+
+  def _estimate_num_events_in_window(self, all_time_samples, num_window_samples, seconds=None):
+    if self.events_counter and seconds is not None and seconds % 60 == 0 and seconds <= 3600:
+      # Whole minutes within the counter's hour are counted exactly
+      return self.events_counter.count_for_window(seconds / 60)
+    num_all_time_events = self._all_time_num_events()
     num_total_all_time_samples = all_time_samples["samples_size"]
     # Multiply then divide so we can do this entirely with ints
-    return (num_all_time_events * num_last_hour_samples) / num_total_all_time_samples
+    return (num_all_time_events * num_window_samples) / num_total_all_time_samples
 
-  def _compute_order_statistics(self, samples):
-    '''Compute the median, quartiles, 95th percentile and largest_value (largest sample value)
+  def _compute_order_statistics(self, samples, percentiles=()):
+    '''Compute the median, quartiles, 95th percentile, any extra percentiles and largest_value
+       (largest sample value). When few positions are needed, they are found by selection
+       (numpy.partition) instead of a full sort.
     Arguments
       samples: An array of integers [sample1, sample2, ...]
+      percentiles (optional): Extra percentiles, reported under percentile_key(percentile)
     Returns: {'quartile_1': #, 'median': #,  'quartile_3' #, 'percentile_95': #, 'largest_value': #}
     '''
-    if not samples:
-      return {"quartile_1": 0, "median": 0, "quartile_3": 0, "percentile_95": 0, "largest_value": 0}
-    sorted_samples = sorted(samples)
+    num_positions = len(DEFAULT_PERCENTILES) + len(percentiles) + 1
+    if (numpy is None or len(samples) < SELECTION_MIN_SAMPLES or
+        num_positions > SELECTION_MAX_POSITIONS):
+      return self._compute_sorted_order_statistics(sorted(samples), percentiles)
+    keyed_percentiles = self._keyed_percentiles(percentiles)
+    positions = [percentile_position(len(samples), p) for _, p in keyed_percentiles]
+    positions.append(len(samples) - 1)
+    selected = numpy.partition(numpy.array(samples), positions)
+    stats = dict((key, int(selected[pos])) for (key, _), pos in zip(keyed_percentiles, positions))
+    stats["largest_value"] = int(selected[-1])
+    return stats
+
+  def _compute_sorted_order_statistics(self, sorted_samples, percentiles=()):
+    '''Same as _compute_order_statistics, for samples that are already in ascending order'''
+    keyed_percentiles = self._keyed_percentiles(percentiles)
+    if not sorted_samples:
+      stats = dict((key, 0) for key, _ in keyed_percentiles)
+      stats["largest_value"] = 0
+      return stats
     num_samples = len(sorted_samples)
-    pos_quartile1 = (num_samples) / 4
-    pos_quartile3 = (num_samples * 3)  / 4
-    pos_95 = (num_samples * 95) / 100
-    quartile1 = sorted_samples[pos_quartile1]
-    median = sorted_samples[num_samples/2]
-    quartile3 = sorted_samples[pos_quartile3]
-    percentile_95 = sorted_samples[pos_95]
-    largest_value = sorted_samples[-1]
-    return {"quartile_1": quartile1,
-            "median": median,
-            "quartile_3": quartile3,
-            "percentile_95": percentile_95,
-            "largest_value": largest_value}
-
-  def _filter_last_n_seconds(self, sample_set, end_time, num_sec_before_end):
-    '''Filter the provided samples array for samples up to num_sec after the supplied end_time
-    Arguments
-      sample_set: A sample set with {"sample_values":..., "sample_times_sec":..., "samples_size":...
-      end_time: The end time under consideration (in ms since the epoch)
-      num_sec: How many seconds before the end time we which to keep
-    Returns: An array of sample_values [sample1, sample2...]'''
-    min_time = end_time - num_sec_before_end
-    sample_values = sample_set["sample_values"]
-    sample_times = sample_set["sample_times_sec"]
-    return [sample_values[i] for i, x in enumerate(sample_times) if end_time >= x > min_time]
+    stats = dict((key, sorted_samples[percentile_position(num_samples, p)])
+                 for key, p in keyed_percentiles)
+    stats["largest_value"] = sorted_samples[-1]
+    return stats
+
+  def _keyed_percentiles(self, percentiles):
+    return DEFAULT_PERCENTILES + [(percentile_key(p), p) for p in percentiles]
+
+
+class SketchSamplerStats(SamplerStats):
+  '''Same results as SamplerStats, within relative_accuracy, computed from QuantileSketches of the
+     samples instead of the sorted samples. The sketches can be kept, serialized and merged across
+     time windows or hosts in place of the raw sample lists.'''
+
+  def __init__(self, sampler_data, current_epoch_sec,
+               relative_accuracy=QuantileSketch.DEFAULT_RELATIVE_ACCURACY, events_counter_data=None):
+    SamplerStats.__init__(self, sampler_data, current_epoch_sec, events_counter_data)
+    self.relative_accuracy = relative_accuracy
+    self.all_time_sketch_cache = None
+
+  def last_minute_sketch(self):
+    '''Returns: a QuantileSketch of the last minute samples, empty if they aren't from the current
+        minute'''
+    sketch = QuantileSketch(self.relative_accuracy)
+    latest_min = utils.epoch_sec_to_minutes_since_epoch(self.sampler_data["latest_time_sec"])
+    if latest_min == self.current_min:
+      sketch.add_all(self.sampler_data["last_minute_samples"]["sample_values"])
+    return sketch
+
+  def all_time_sketch(self):
+    '''Returns: a QuantileSketch of the all time samples'''
+    if self.all_time_sketch_cache is None:
+      self.all_time_sketch_cache = QuantileSketch(self.relative_accuracy)
+      self.all_time_sketch_cache.add_all(self.sampler_data["all_time_samples"]["sample_values"])
+    return self.all_time_sketch_cache
+
+  def window_sketch(self, seconds):
+    '''Returns: a QuantileSketch of the all time samples taken in the given number of seconds up to
+        the current time'''
+    sketch = QuantileSketch(self.relative_accuracy)
+    sketch.add_all(self._all_time_sorted().values_in_window(self.current_epoch_sec, seconds))
+    return sketch
+
+  def last_minute_stats(self, percentiles=()):
+    sketch = self.last_minute_sketch()
+    stats = sketch_order_statistics(sketch, percentiles)
+    stats["count"] = self.sampler_data["last_minute_samples"]["num_events"] if sketch.count else 0
+    if self.events_counter:
+      stats["count"] = self.events_counter.last_minute_count()
+    return stats
+
+  def all_time_stats(self, percentiles=()):
+    stats = sketch_order_statistics(self.all_time_sketch(), percentiles)
+    stats["count"] = self._all_time_num_events()
+    return stats
+
+  def stats_for_window(self, seconds, percentiles=()):
+    sketch = self.window_sketch(seconds)
+    stats = sketch_order_statistics(sketch, percentiles)
+    stats["count"] = self._estimate_num_events_in_window(self.sampler_data["all_time_samples"],
+                                                         sketch.count, seconds)
+    return stats
 
 
 class CounterStats(object):
@@ -105,14 +427,21 @@ class CounterStats(object):
     return self.counter_data["min_counters"][curr_min_of_hour]
 
   def last_hour_count(self):
+    return self.count_for_window(60)
+
+  def count_for_window(self, minutes):
+    '''Sum of the counter over the given number of minutes up to and including the current one,
+       e.g. 5, 15 or 30. The counter only keeps the last hour, so minutes must be at most 60.'''
+    if not 0 < minutes <= 60:
+      raise ValueError("window of %d minutes is outside the 60 minute counter history" % minutes)
     last_min_since_epoch = utils.epoch_sec_to_minutes_since_epoch(self.counter_data["latest_time_sec"])
     curr_min_since_epoch = utils.epoch_sec_to_minutes_since_epoch(self.current_epoch_sec)
 
-    # If the current time is more than 1 hour aheads of the data return 0
+    # If the current time is more than the window aheads of the data return 0
     # OR
     # We somehow have data ahead of the current_time (we won't try to resolve that)
     difference_btw_curr_and_last = curr_min_since_epoch - last_min_since_epoch
-    if difference_btw_curr_and_last >= 60 or difference_btw_curr_and_last < 0:
+    if difference_btw_curr_and_last >= minutes or difference_btw_curr_and_last < 0:
       return 0
 
     # Example:
@@ -126,9 +455,9 @@ class CounterStats(object):
     # Thus we want values starting from position 15 going backward through position 21
 
     last_min_of_hour_with_data = last_min_since_epoch % 60
-    num_mins_with_data_in_last_hour = 60 - difference_btw_curr_and_last
+    num_mins_with_data_in_window = minutes - difference_btw_curr_and_last
     filtered_mins = self._filter_counters_data(last_min_of_hour_with_data,
-                                               num_mins_with_data_in_last_hour,
+                                               num_mins_with_data_in_window,
                                                self.counter_data["min_counters"]) 
     return sum(filtered_mins)
 
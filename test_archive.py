@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import archive
+import server
+
+def counter_entry(name, latest_time_sec, min_counters):
+  return {"name": name, "value": {"min_counters": min_counters, "all_time_count": sum(min_counters),
+                                  "latest_time_sec": latest_time_sec}}
+
+def sampler_entry(name, latest_time_sec, values, num_events):
+  minute_samples = {"sample_values": values, "sample_times_sec": [latest_time_sec] * len(values),
+                    "samples_size": len(values), "num_events": num_events}
+  return {"name": name, "value": {"latest_time_sec": latest_time_sec,
+                                  "last_minute_samples": minute_samples,
+                                  "all_time_samples": minute_samples}}
+
+class ArchiveTestCase(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, "varz.arc")
+    self.base_min = 10000 * 60 # minute 0 of an hour
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def writeDumps(self, num_minutes, start_minute=0, dump_sec_of_minute=lambda minute: 59):
+    writer = archive.ArchiveWriter(self.path)
+    for minute in xrange(start_minute, start_minute + num_minutes):
+      minute_sec = (self.base_min + minute) * 60
+      # The counter's ring holds minute + 1 in every slot of the last hour
+      min_counters = [0] * 60
+      for age in xrange(min(60, minute + 1)):
+        min_counters[(self.base_min + minute - age) % 60] = minute - age + 1
+      writer.append({"mht_counters": [counter_entry("requests", minute_sec + 30, min_counters)],
+                     "mht_samplers": [sampler_entry("latency", minute_sec + 30,
+                                                    range(minute * 10, minute * 10 + 10), 100)]},
+                    dump_time_sec=minute_sec + dump_sec_of_minute(minute))
+    writer.close()
+
+  def test_counter_per_minute(self):
+    self.writeDumps(130)
+    reader = archive.ArchiveReader(self.path)
+    start_sec = (self.base_min + 5) * 60
+    per_minute = reader.counter_per_minute("requests", start_sec, start_sec + 120 * 60 - 1)
+    self.assertEquals([(start_sec + i * 60, i + 6) for i in xrange(120)], per_minute)
+    self.assertEquals([], reader.counter_per_minute("missing", start_sec, start_sec + 60))
+    reader.close()
+
+  def test_sampler_stats_per_hour(self):
+    self.writeDumps(120)
+    reader = archive.ArchiveReader(self.path)
+    start_sec = self.base_min * 60
+    per_hour = reader.sampler_stats_per_period("latency", start_sec, start_sec + 2 * 3600,
+                                               percentiles=[99])
+    self.assertEquals([start_sec, start_sec + 3600], [period for period, _ in per_hour])
+    first_hour = per_hour[0][1]
+    self.assertEquals(60 * 100, first_hour["count"])
+    self.assertEquals(570, first_hour["percentile_95"])
+    self.assertEquals(594, first_hour["percentile_99"])
+    self.assertEquals(599, first_hour["largest_value"])
+    self.assertEquals(1199, per_hour[1][1]["largest_value"])
+    reader.close()
+
+  def test_frames_dumped_mid_minute_are_left_out_of_sampler_stats(self):
+    # Even minutes are dumped at :59, odd ones at :40, after the last event at :30
+    self.writeDumps(60, dump_sec_of_minute=lambda minute: 59 if minute % 2 == 0 else 40)
+    reader = archive.ArchiveReader(self.path)
+    start_sec = self.base_min * 60
+    per_hour = reader.sampler_stats_per_period("latency", start_sec, start_sec + 3600)
+    self.assertEquals(30 * 100, per_hour[0][1]["count"])
+    self.assertEquals(589, per_hour[0][1]["largest_value"])
+    reader.close()
+
+  def test_sampler_counts_every_event_of_a_live_sampler(self):
+    start_sec = self.base_min * 60
+    for dump_sec_of_minute, expected_counts in [(30, []), (59, [3600])]:
+      writer = archive.ArchiveWriter(self.path)
+      sampler = server.Sampler(128, 1024)
+      for sec in xrange(start_sec, start_sec + 3600):
+        sampler.add(sec, sec % 1000)
+        if sec % 60 == dump_sec_of_minute:
+          writer.append({"mht_samplers": [{"name": "latency", "value": sampler.to_json()}]},
+                        dump_time_sec=sec)
+      writer.close()
+      reader = archive.ArchiveReader(self.path)
+      per_hour = reader.sampler_stats_per_period("latency", start_sec, start_sec + 3600)
+      self.assertEquals(expected_counts, [period_stats["count"] for _, period_stats in per_hour])
+      reader.close()
+      os.remove(self.path)
+
+  def test_appending_after_reopen_keeps_name_dictionary(self):
+    self.writeDumps(3)
+    self.writeDumps(3, start_minute=3)
+    reader = archive.ArchiveReader(self.path)
+    self.assertEquals(["requests", "latency"], reader.names)
+    self.assertEquals(6, len(reader.frames))
+    per_minute = reader.counter_per_minute("requests", 0, 2 ** 31)
+    self.assertEquals([1, 2, 3, 4, 5, 6], [count for _, count in per_minute if count])
+    reader.close()
+
+  def test_truncated_frame_is_ignored_and_overwritten(self):
+    self.writeDumps(2)
+    with open(self.path, "ab") as f:
+      f.write("FRAM\xff\xff")
+    self.assertEquals(2, len(archive.ArchiveReader(self.path).frames))
+    self.writeDumps(1, start_minute=2)
+    self.assertEquals(3, len(archive.ArchiveReader(self.path).frames))
+
+  def test_not_an_archive(self):
+    with open(self.path, "wb") as f:
+      f.write("{}")
+    self.assertRaises(ValueError, archive.ArchiveReader, self.path)
+
+if __name__ == '__main__':
+  unittest.main()
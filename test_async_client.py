@@ -0,0 +1,96 @@
+import datetime
+import os
+import subprocess
+import time
+import unittest
+
+try:
+  import asyncio
+  import shutil
+  from varz_async import client as async_client
+except ImportError:
+  async_client = None
+
+def find_python2():
+  '''server.py is Python 2 only, so it runs in a child interpreter: $VARZ_PYTHON2 or python2'''
+  if async_client is None:
+    return None
+  check_version = "import sys; sys.exit(sys.version_info[0] != 2)"
+  for candidate in [os.environ.get("VARZ_PYTHON2"), shutil.which("python2"),
+                    shutil.which("python2.7")]:
+    # pyenv shims are on the PATH even when they cannot run
+    if candidate and subprocess.call([candidate, "-c", check_version], stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL) == 0:
+      return candidate
+  return None
+
+PYTHON2 = find_python2()
+
+@unittest.skipIf(async_client is None, "async_client requires Python 3")
+@unittest.skipIf(PYTHON2 is None, "set VARZ_PYTHON2 to a Python 2 interpreter to run server.py")
+class AsyncVARZClientTestCase(unittest.TestCase):
+  def setUp(self):
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    self.server = subprocess.Popen([PYTHON2, "-u", server_path, "0", "0"],
+                                   stdout=subprocess.PIPE, universal_newlines=True)
+    # "Serving varz on udp:<port> tcp:<port>"
+    ports = self.server.stdout.readline().split()[-2:]
+    udp_port, tcp_port = [int(port.split(":")[1]) for port in ports]
+    self.loop = asyncio.new_event_loop()
+    self.client = async_client.AsyncVARZClient(udp_port=udp_port, tcp_port=tcp_port)
+    self.runUntilComplete(self.client.setup())
+
+  def tearDown(self):
+    self.runUntilComplete(self.client.close())
+    self.loop.close()
+    self.server.terminate()
+    self.server.wait()
+    self.server.stdout.close()
+
+  def runUntilComplete(self, coroutine):
+    return self.loop.run_until_complete(coroutine)
+
+  def dumpWhen(self, condition):
+    '''UDP commands arrive asynchronously: poll all_dump until condition(dump) holds'''
+    deadline = time.time() + 5
+    while True:
+      dump = self.runUntilComplete(self.client.all_dump())
+      if condition(dump) or time.time() > deadline:
+        return dump
+      time.sleep(0.01)
+
+  def test_counters_and_samplers_reach_the_server(self):
+    when = datetime.datetime.now()
+    self.runUntilComplete(self.client.counter_increment("requests", 2, time=when))
+    self.runUntilComplete(self.client.counter_increment("requests", 3, time=when,
+                                                        mode=async_client.AsyncVARZClient.MODE_TCP))
+    self.runUntilComplete(self.client.sampler_add("latency", 42, time=when))
+    self.runUntilComplete(self.client.sampler_add("latency", 7,
+                                                  mode=async_client.AsyncVARZClient.MODE_TCP))
+    dump = self.dumpWhen(lambda dump: len(dump["mht_counters"]) == 1 and
+                         dump["mht_counters"][0]["value"]["all_time_count"] == 5 and
+                         len(dump["mht_samplers"]) == 1 and
+                         dump["mht_samplers"][0]["value"]["all_time_samples"]["num_events"] == 2)
+    self.assertEqual([("requests", 5)], [(counter["name"], counter["value"]["all_time_count"])
+                                         for counter in dump["mht_counters"]])
+    sampler = dump["mht_samplers"][0]
+    self.assertEqual("latency", sampler["name"])
+    self.assertEqual([7, 42], sorted(sampler["value"]["all_time_samples"]["sample_values"]))
+    self.assertEqual({"mht_counters": ["requests"], "mht_samplers": ["latency"]},
+                     self.runUntilComplete(self.client.all_list()))
+
+  def test_all_flush(self):
+    self.runUntilComplete(self.client.counter_increment("requests",
+                                                        mode=async_client.AsyncVARZClient.MODE_TCP))
+    self.dumpWhen(lambda dump: dump["mht_counters"])
+    self.runUntilComplete(self.client.all_flush())
+    self.assertEqual({"mht_counters": [], "mht_samplers": []},
+                     self.runUntilComplete(self.client.all_dump()))
+
+  def test_long_names_are_rejected(self):
+    with self.assertRaises(ValueError) as raised:
+      self.runUntilComplete(self.client.counter_increment("x" * 129))
+    self.assertEqual("name '%s' is longer than 128" % ("x" * 129), str(raised.exception))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,88 @@
+import random
+import unittest
+
+try:
+  import batch_stats
+except ImportError:
+  batch_stats = None
+import stats
+
+@unittest.skipIf(batch_stats is None, "batch_stats requires numpy")
+class BatchStatsTestCase(unittest.TestCase):
+  def setUp(self):
+    random.seed(4447)
+    self.latest_time_sec = 60 * 140000
+
+  def createFakeSampler(self, latest_time_sec, num_samples, num_events, duration_sec):
+    return {"latest_time_sec": latest_time_sec,
+            "last_minute_samples": self.createFakeSamples(latest_time_sec, 60,
+                                                          random.randrange(0, 50), num_events),
+            "all_time_samples": self.createFakeSamples(latest_time_sec, duration_sec,
+                                                       num_samples, num_events)}
+
+  def createFakeSamples(self, end_time, duration_sec, num_samples, num_events):
+    return {"sample_values": [random.randrange(10000) for x in range(num_samples)],
+            "sample_times_sec": [end_time - random.randrange(duration_sec)
+                                 for x in range(num_samples)],
+            "samples_size": num_samples,
+            "num_events": max(num_events, num_samples)}
+
+  def createFakeSamplers(self, num_samplers=200):
+    samplers = []
+    for i in range(num_samplers):
+      latest_time_sec = self.latest_time_sec - random.choice([0, 30, 59, 61, 1800, 7200])
+      samplers.append({"name": "sampler_%d" % i,
+                       "value": self.createFakeSampler(latest_time_sec, random.randrange(1, 300),
+                                                       random.randrange(0, 5000),
+                                                       random.choice([60, 3600, 3600*24]))})
+    return samplers
+
+  def createFakeCounters(self, num_counters=200):
+    counters = []
+    for i in range(num_counters):
+      latest_time_sec = self.latest_time_sec - 60 * random.randrange(-3, 70)
+      counters.append({"name": "counter_%d" % i,
+                       "value": {"min_counters": [random.randrange(100) for x in range(60)],
+                                 "all_time_count": random.randrange(100000),
+                                 "latest_time_sec": latest_time_sec}})
+    return counters
+
+  def assertMatchesSamplerStats(self, batch_result, per_sampler_fn, samplers):
+    for i, sampler in enumerate(samplers):
+      expected = per_sampler_fn(sampler)
+      for key, value in expected.iteritems():
+        self.assertEquals(value, batch_result[key][i], "%s of %s" % (key, sampler["name"]))
+
+  def test_sampler_stats_match_sampler_stats(self):
+    samplers = self.createFakeSamplers()
+    for current_epoch_sec in [self.latest_time_sec, self.latest_time_sec + 45,
+                              self.latest_time_sec + 1800]:
+      batch = batch_stats.BatchSamplerStats(samplers, current_epoch_sec)
+      single = lambda sampler: stats.SamplerStats(sampler["value"], current_epoch_sec)
+      self.assertMatchesSamplerStats(batch.last_minute_stats(),
+                                     lambda s: single(s).last_minute_stats(), samplers)
+      self.assertMatchesSamplerStats(batch.last_hour_stats(),
+                                     lambda s: single(s).last_hour_stats(), samplers)
+      self.assertMatchesSamplerStats(batch.all_time_stats(),
+                                     lambda s: single(s).all_time_stats(), samplers)
+
+  def test_counter_stats_match_counter_stats(self):
+    counters = self.createFakeCounters()
+    for current_epoch_sec in [self.latest_time_sec, self.latest_time_sec + 59,
+                              self.latest_time_sec + 1800]:
+      batch = batch_stats.BatchCounterStats(counters, current_epoch_sec)
+      last_minute = batch.last_minute_count()
+      last_hour = batch.last_hour_count()
+      all_time = batch.all_time_count()
+      for i, counter in enumerate(counters):
+        single = stats.CounterStats(counter["value"], current_epoch_sec)
+        self.assertEquals(single.last_minute_count(), last_minute[i])
+        self.assertEquals(single.last_hour_count(), last_hour[i])
+        self.assertEquals(single.all_time_count(), all_time[i])
+
+  def test_empty_dump(self):
+    self.assertEquals(0, len(batch_stats.BatchSamplerStats([], 0).all_time_stats()["median"]))
+    self.assertEquals(0, len(batch_stats.BatchCounterStats([], 0).last_hour_count()))
+
+if __name__ == "__main__":
+  unittest.main()
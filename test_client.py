@@ -0,0 +1,442 @@
+import datetime
+import errno
+import json
+import socket
+import threading
+import time
+import unittest
+
+import client
+import utils
+
+def wait_for(condition, timeout_sec=1):
+  '''Flushers run on their own thread: poll until condition() holds or timeout_sec passes'''
+  deadline = time.time() + timeout_sec
+  while not condition() and time.time() < deadline:
+    time.sleep(0.001)
+
+class UDPCommandBatcherTestCase(unittest.TestCase):
+  def setUp(self):
+    self.sent = []
+
+  def createBatcher(self, max_payload=64, max_latency_sec=60):
+    return client.UDPCommandBatcher(self.sent.append, max_payload, max_latency_sec)
+
+  def test_commands_are_buffered_until_flush(self):
+    b = self.createBatcher()
+    b.add("MHTCOUNTERADD a 1 1;")
+    b.add("MHTCOUNTERADD b 1 1;")
+    self.assertEquals([], self.sent)
+    b.flush()
+    self.assertEquals(["MHTCOUNTERADD a 1 1;MHTCOUNTERADD b 1 1;"], self.sent)
+
+  def test_full_buffer_is_sent_before_overflowing(self):
+    b = self.createBatcher(max_payload=45)
+    b.add("MHTCOUNTERADD a 1 1;")
+    b.add("MHTCOUNTERADD b 1 1;")
+    b.add("MHTCOUNTERADD c 1 1;")
+    self.assertEquals(["MHTCOUNTERADD a 1 1;MHTCOUNTERADD b 1 1;"], self.sent)
+    b.flush()
+    self.assertEquals("MHTCOUNTERADD c 1 1;", self.sent[-1])
+
+  def test_flush_with_empty_buffer_sends_nothing(self):
+    b = self.createBatcher()
+    b.flush()
+    self.assertEquals([], self.sent)
+
+  def test_timer_flushes_after_max_latency(self):
+    b = self.createBatcher(max_latency_sec=0.01)
+    b.add("MHTSAMPLEADD a 1 5;")
+    wait_for(lambda: self.sent)
+    self.assertEquals(["MHTSAMPLEADD a 1 5;"], self.sent)
+
+  def test_one_flusher_thread_serves_every_window(self):
+    threads = []
+    def send(datagram):
+      threads.append(threading.current_thread())
+    b = client.UDPCommandBatcher(send, 64, 0.01)
+    for i in xrange(3):
+      b.add("MHTSAMPLEADD a 1 %d;" % i)
+      wait_for(lambda: len(threads) > i)
+    self.assertEquals(3, len(threads))
+    self.assertEquals([b.flusher.thread] * 3, threads)
+    self.assertTrue(b.flusher.thread.is_alive())
+
+  def test_flush_before_the_deadline_disarms_the_flusher(self):
+    b = self.createBatcher(max_latency_sec=0.02)
+    b.add("MHTSAMPLEADD a 1 5;")
+    b.flush()
+    time.sleep(0.05)
+    b.add("MHTSAMPLEADD a 1 6;")
+    time.sleep(0.01)
+    # The cancelled deadline doesn't flush the second command early
+    self.assertEquals(["MHTSAMPLEADD a 1 5;"], self.sent)
+    wait_for(lambda: len(self.sent) == 2)
+    self.assertEquals("MHTSAMPLEADD a 1 6;", self.sent[-1])
+
+class CounterAggregatorTestCase(unittest.TestCase):
+  def setUp(self):
+    self.sent = []
+
+  def createAggregator(self, interval_sec=60, max_keys=1024):
+    return client.CounterAggregator(self.sent.append, interval_sec, max_keys)
+
+  def test_increments_are_summed_per_name_and_second(self):
+    a = self.createAggregator()
+    a.add("a", 100, 1)
+    a.add("a", 100, 2)
+    a.add("a", 101, 4)
+    a.add("b", 100, 8)
+    self.assertEquals([], self.sent)
+    a.flush()
+    self.assertEquals(sorted(["MHTCOUNTERADD a 100 3;", "MHTCOUNTERADD a 101 4;",
+                              "MHTCOUNTERADD b 100 8;"]),
+                      sorted(self.sent))
+
+  def test_reaching_max_keys_forces_a_flush(self):
+    a = self.createAggregator(max_keys=2)
+    a.add("a", 100, 1)
+    a.add("a", 100, 1)
+    self.assertEquals([], self.sent)
+    a.add("b", 100, 1)
+    self.assertEquals(2, len(self.sent))
+    self.assertEquals({}, a.totals)
+
+  def test_timer_flushes_after_interval(self):
+    a = self.createAggregator(interval_sec=0.01)
+    a.add("a", 100, 5)
+    wait_for(lambda: self.sent)
+    self.assertEquals(["MHTCOUNTERADD a 100 5;"], self.sent)
+
+
+class SamplerRateLimiterTestCase(unittest.TestCase):
+  def setUp(self):
+    self.sent = []
+
+  def createLimiter(self, max_values_per_sec=4, interval_sec=60, max_keys=1024):
+    return client.SamplerRateLimiter(self.sent.append, max_values_per_sec, interval_sec, max_keys)
+
+  def test_values_are_capped_per_second_and_events_counted_exactly(self):
+    l = self.createLimiter()
+    for value in xrange(100):
+      l.add("latency", 100, value)
+    l.add("latency", 101, 7)
+    self.assertEquals([], self.sent)
+    l.flush()
+    samples_100 = [c for c in self.sent if c.startswith("MHTSAMPLEADD latency 100 ")]
+    self.assertEquals(4, len(samples_100))
+    self.assertEquals(4, len(set(samples_100)))
+    self.assertTrue("MHTSAMPLEADD latency 101 7;" in self.sent)
+    self.assertTrue("MHTCOUNTERADD latency.events 100 100;" in self.sent)
+    self.assertTrue("MHTCOUNTERADD latency.events 101 1;" in self.sent)
+    self.assertEquals(7, len(self.sent))
+
+  def test_reaching_max_keys_forces_a_flush(self):
+    l = self.createLimiter(max_keys=2)
+    l.add("a", 100, 1)
+    self.assertEquals([], self.sent)
+    l.add("b", 100, 1)
+    self.assertEquals(4, len(self.sent))
+    self.assertEquals({}, l.reservoirs)
+
+  def test_timer_flushes_after_interval(self):
+    l = self.createLimiter(interval_sec=0.01)
+    l.add("a", 100, 5)
+    wait_for(lambda: self.sent)
+    self.assertEquals(["MHTSAMPLEADD a 100 5;", "MHTCOUNTERADD a.events 100 1;"], self.sent)
+
+  def test_sampled_names_leave_room_for_the_events_counter(self):
+    c = client.VARZClient(sampler_max_values_per_sec=2)
+    c._sendto_udp = self.sent.append
+    c._send_tcp_command = self.sent.append
+    longest = "s" * (client.VARZClient.MAX_NAME_LEN - len(utils.SAMPLER_EVENTS_SUFFIX))
+    c.sampler_add(longest, 1, time=datetime.datetime(2014, 5, 1, 12, 30, 15))
+    c.sampler(longest).add(2)
+    c.flush()
+    counter_names = [command.split()[1] for command in self.sent
+                     if command.startswith("MHTCOUNTERADD")]
+    self.assertTrue(counter_names)
+    self.assertEquals(set([client.VARZClient.MAX_NAME_LEN]), set(map(len, counter_names)))
+    self.assertRaises(ValueError, c.sampler_add, longest + "s", 1)
+    self.assertRaises(ValueError, c.sampler, longest + "s")
+    # Unsampled TCP sends have no companion counter, so the full length is allowed
+    c.sampler_add(longest + "s", 1, mode=client.VARZClient.MODE_TCP)
+    c.sampler(longest + "s", mode=client.VARZClient.MODE_TCP).add(1)
+
+  def test_client_routes_udp_samples_through_limiter(self):
+    c = client.VARZClient(sampler_max_values_per_sec=2)
+    c._sendto_udp = self.sent.append
+    when = datetime.datetime(2014, 5, 1, 12, 30, 15)
+    sec_since_epoch = utils.datetime_to_sec_since_epoch(when)
+    for value in xrange(5):
+      c.sampler_add("latency", value, time=when)
+      c.sampler("latency").add(value, time=when)
+    self.assertEquals([], self.sent)
+    c.flush()
+    self.assertEquals(3, len(self.sent))
+    self.assertEquals("MHTCOUNTERADD latency.events %d 10;" % sec_since_epoch, self.sent[-1])
+
+
+class ClientSetupTestCase(unittest.TestCase):
+  def setUp(self):
+    self.registered = []
+    self.register = client.atexit.register
+    client.atexit.register = self.registered.append
+
+  def tearDown(self):
+    client.atexit.register = self.register
+
+  def test_flush_is_registered_at_exit_once_per_client(self):
+    c = client.VARZClient(batch_udp=True, aggregate_counters=True, sampler_max_values_per_sec=4)
+    c.setup()
+    c.close()
+    c.setup()
+    c.after_fork()
+    c.setup()
+    c.close()
+    self.assertEquals([c.flush], self.registered)
+
+  def test_unbuffered_client_registers_nothing(self):
+    c = client.VARZClient()
+    c.setup()
+    c.close()
+    self.assertEquals([], self.registered)
+
+  def test_self_stats_reporter_is_started_once(self):
+    c = client.VARZClient(self_stats_report_interval_sec=60)
+    c.setup()
+    reporter = c.self_stats_reporter
+    c.setup()
+    self.assertTrue(reporter is c.self_stats_reporter)
+    c.close()
+    self.assertTrue(c.self_stats_reporter is None)
+
+  def test_self_stats_are_reported_from_one_thread(self):
+    threads = []
+    c = client.VARZClient(self_stats_report_interval_sec=0.005)
+    c.report_self_stats = lambda: threads.append(threading.current_thread())
+    c.setup()
+    wait_for(lambda: len(threads) >= 3)
+    c.close()
+    num_reports = len(threads)
+    self.assertTrue(num_reports >= 3)
+    self.assertEquals(set([threads[0]]), set(threads))
+    self.assertFalse(threads[0].is_alive())
+    time.sleep(0.02)
+    self.assertEquals(num_reports, len(threads))
+
+  def test_close_waits_for_a_report_in_progress(self):
+    reporting = threading.Event()
+    finish_report = threading.Event()
+    reports = []
+    def report():
+      reports.append(1)
+      reporting.set()
+      finish_report.wait()
+    c = client.VARZClient(self_stats_report_interval_sec=0.005)
+    c.report_self_stats = report
+    c.setup()
+    reporting.wait(1)
+    closer = threading.Thread(target=c.close)
+    closer.start()
+    closer.join(0.02)
+    self.assertTrue(closer.is_alive())
+    finish_report.set()
+    closer.join(1)
+    self.assertFalse(closer.is_alive())
+    time.sleep(0.02)
+    self.assertEquals(1, len(reports))
+
+class MetricHandleTestCase(unittest.TestCase):
+  def setUp(self):
+    self.sent = []
+    self.client = client.VARZClient()
+    self.client._sendto_udp = self.sent.append
+    self.client._send_tcp_command = self.sent.append
+
+  def test_handles_send_the_same_commands(self):
+    when = datetime.datetime(2014, 5, 1, 12, 30, 15)
+    self.client.counter_increment("requests", 3, time=when)
+    self.client.counter("requests").increment(3, time=when)
+    self.client.sampler_add("latency", 42, time=when)
+    self.client.sampler("latency").add(42, time=when)
+    self.assertEquals(self.sent[0], self.sent[1])
+    self.assertEquals(self.sent[2], self.sent[3])
+
+  def test_handle_uses_current_second_by_default(self):
+    before = utils.sec_since_epoch_now()
+    self.client.counter("requests").increment()
+    after = utils.datetime_to_sec_since_epoch(datetime.datetime.now())
+    sec_since_epoch = int(self.sent[0].split()[2])
+    self.assertTrue(before <= sec_since_epoch <= after)
+
+  def test_tcp_mode_handle(self):
+    self.client.sampler("latency", mode=client.VARZClient.MODE_TCP).add(7, time=None)
+    self.assertTrue(self.sent[0].startswith("MHTSAMPLEADD latency "))
+
+  def test_bad_names_are_rejected_once(self):
+    self.assertRaises(ValueError, self.client.counter, "x" * 129)
+    self.assertRaises(ValueError, self.client.counter, "two words")
+    self.assertRaises(ValueError, self.client.sampler, "semi;colon")
+    self.assertRaises(ValueError, self.client.sampler, "")
+
+
+class ClientSelfStatsTestCase(unittest.TestCase):
+  def setUp(self):
+    self.sent = []
+    self.client = client.VARZClient(instrument=True, instrument_sample_every=2)
+    self.client.setup()
+    self.client.udp_socket = self
+
+  def sendto(self, datagram, address):
+    if datagram == "fail;":
+      raise socket.error(errno.ECONNREFUSED, "refused")
+    if datagram == "full;":
+      raise socket.error(errno.EAGAIN, "try again")
+    self.sent.append(datagram)
+
+  def test_commands_bytes_and_sampled_latencies_are_counted(self):
+    for x in xrange(3):
+      self.client.counter_increment("requests")
+    self.client.sampler("latency").add(5)
+    stats = self.client.self_stats()
+    self.assertEquals({"MHTCOUNTERADD": 3, "MHTSAMPLEADD": 1}, stats["commands"])
+    self.assertEquals(4, stats["counts"]["udp_datagrams"])
+    self.assertEquals(sum(len(d) for d in self.sent), stats["counts"]["udp_bytes"])
+    self.assertEquals(2, stats["latencies"]["udp_sendto_us"]["count"])
+
+  def test_send_errors_are_counted_and_raised(self):
+    self.assertRaises(socket.error, self.client._sendto_udp, "fail;")
+    self.assertRaises(socket.error, self.client._sendto_udp, "full;")
+    counts = self.client.self_stats()["counts"]
+    self.assertEquals((1, 1, 0), (counts["udp_errors"], counts["udp_eagain_drops"],
+                                  counts["udp_datagrams"]))
+
+  def test_report_sends_increases_under_reserved_prefix(self):
+    self.client.counter_increment("requests")
+    self.client.counter_increment("requests")
+    self.client.report_self_stats()
+    reported = dict((command.split()[1], int(command.split()[3].rstrip(";")))
+                    for command in self.sent[2:] if command.startswith("MHTCOUNTERADD"))
+    self.assertEquals(2, reported["varz_client.commands_mhtcounteradd"])
+    self.assertEquals(2, reported["varz_client.udp_datagrams"])
+    self.assertTrue(all(command.split()[1].startswith(client.SELF_STATS_PREFIX)
+                        for command in self.sent[2:]))
+    del self.sent[:]
+    self.client.report_self_stats()
+    self.assertFalse([c for c in self.sent if c.split()[1].endswith("commands_mhtsampleadd")])
+
+  def test_uninstrumented_client_has_no_self_stats(self):
+    self.assertEquals(None, client.VARZClient().self_stats())
+
+
+class RecvJSONDocumentTestCase(unittest.TestCase):
+  def setUp(self):
+    self.server_end, self.client_end = socket.socketpair()
+
+  def tearDown(self):
+    self.server_end.close()
+    self.client_end.close()
+
+  def test_document_ends_when_braces_balance(self):
+    self.server_end.sendall('{"a": {"b": 1}}')
+    self.assertEquals(({"a": {"b": 1}}, False, 15), client._recv_json_document(self.client_end))
+
+  def test_braces_and_escaped_quotes_in_strings_are_skipped(self):
+    self.client_end.settimeout(5)
+    self.server_end.sendall('{"a{": "}\\"{", "b": {"c": "\\\\"}}')
+    self.assertEquals(({"a{": '}"{', "b": {"c": "\\"}}, False, 32),
+                      client._recv_json_document(self.client_end))
+
+  def test_depth_is_tracked_across_any_chunking(self):
+    document = '{"n{": "x\\"}\\\\", "v": [{"w": "{{"}], "z": {}}'
+    for split in xrange(len(document) + 1):
+      state = (0, False, False)
+      for chunk in (document[:split], document[split:]):
+        state = client._scan_json_depth(chunk, state)
+      self.assertEquals((0, False, False), state)
+    self.assertEquals((1, True, False), client._scan_json_depth(document[:4], (0, False, False)))
+
+  def test_document_ends_when_server_closes(self):
+    self.server_end.sendall('{"a": "}", "b": 2}')
+    self.server_end.shutdown(socket.SHUT_WR)
+    self.assertEquals(({"a": "}", "b": 2}, True, 18), client._recv_json_document(self.client_end))
+
+
+class KeepAliveServer(object):
+  '''Stand-in TCP server that only closes a connection once the client has shut down its side,
+     recording everything received on it'''
+  def __init__(self):
+    self.listener = socket.socket()
+    self.listener.bind(("localhost", 0))
+    self.listener.listen(8)
+    self.port = self.listener.getsockname()[1]
+    self.received = []
+    thread = threading.Thread(target=self.serve)
+    thread.daemon = True
+    thread.start()
+
+  def serve(self):
+    while True:
+      try:
+        conn, _ = self.listener.accept()
+      except socket.error:
+        return
+      data = []
+      while True:
+        new_data = conn.recv(4096)
+        if not new_data:
+          break
+        data.append(new_data)
+      self.received.append("".join(data))
+      conn.close()
+
+class AllFlushTestCase(unittest.TestCase):
+  def test_flush_is_sent_once_and_returns_with_keep_alive_server(self):
+    stand_in = KeepAliveServer()
+    c = client.VARZClient(tcp_port=stand_in.port)
+    c.all_flush()
+    self.assertEquals(["ALLFLUSH;"], stand_in.received)
+    stand_in.listener.close()
+
+
+class DumpStreamParserTestCase(unittest.TestCase):
+  def createDump(self):
+    return {"mht_counters": [{"name": "c%d" % i,
+                              "value": {"min_counters": range(60), "all_time_count": 5000 + i,
+                                        "latest_time_sec": 36900}} for i in range(3)],
+            "version": 12345,
+            "mht_samplers": [{"name": "s{%d" % i,
+                              "value": {"latest_time_sec": 36900,
+                                        "all_time_samples": {"sample_values": [1, 22, 333],
+                                                             "sample_times_sec": [1, 2, 3],
+                                                             "samples_size": 3,
+                                                             "num_events": 7}}}
+                             for i in range(2)]}
+
+  def expectedEntries(self, dump):
+    return [(kind, e["name"], e["value"]) for kind in ("mht_counters", "mht_samplers")
+            for e in dump[kind]]
+
+  def parseInChunks(self, text, chunk_size):
+    parser = client.DumpStreamParser()
+    entries = []
+    for i in range(0, len(text), chunk_size):
+      entries.extend(parser.feed(text[i:i + chunk_size]))
+    parser.finish()
+    return entries
+
+  def test_entries_match_json_loads_for_any_chunk_size(self):
+    dump = self.createDump()
+    text = json.dumps(dump, indent=1)
+    for chunk_size in [1, 2, 7, 64, len(text)]:
+      self.assertEquals(sorted(self.expectedEntries(dump)),
+                        sorted(self.parseInChunks(text, chunk_size)))
+
+  def test_truncated_reply_raises(self):
+    text = json.dumps(self.createDump())
+    self.assertRaises(ValueError, self.parseInChunks, text[:-1], 16)
+
+
+if __name__ == "__main__":
+  unittest.main()
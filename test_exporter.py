@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+import unittest
+import urllib2
+
+import client
+import exporter
+import server
+
+class SingleFlightCacheTestCase(unittest.TestCase):
+  def setUp(self):
+    self.now = 100.0
+    self.num_fetches = 0
+    self.release = threading.Event()
+
+  def fetch(self):
+    self.num_fetches += 1
+    self.release.wait()
+    return self.num_fetches
+
+  def createCache(self, fetch_fn=None):
+    return exporter.SingleFlightCache(fetch_fn or self.fetch, 5, clock=lambda: self.now)
+
+  def test_concurrent_callers_share_one_fetch(self):
+    cache = self.createCache()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get())) for i in xrange(20)]
+    for thread in threads:
+      thread.start()
+    time.sleep(0.05)
+    self.release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEquals([1] * 20, results)
+    self.assertEquals(1, self.num_fetches)
+
+  def test_value_is_refetched_after_ttl(self):
+    self.release.set()
+    cache = self.createCache()
+    self.assertEquals(1, cache.get())
+    self.now += 4.9
+    self.assertEquals(1, cache.get())
+    self.now += 0.2
+    self.assertEquals(2, cache.get())
+
+  def test_failures_are_raised_and_not_cached(self):
+    outcomes = [IOError("daemon down"), "dump"]
+    def fetch():
+      outcome = outcomes.pop(0)
+      if isinstance(outcome, Exception):
+        raise outcome
+      return outcome
+    cache = self.createCache(fetch)
+    self.assertRaises(IOError, cache.get)
+    self.assertEquals("dump", cache.get())
+
+class RenderTestCase(unittest.TestCase):
+  def setUp(self):
+    self.now = 6000 * 60 + 30
+    self.dump = {"mht_counters": [{"name": 'requests"x', "value": {
+                    "min_counters": [2] * 60, "all_time_count": 500, "latest_time_sec": self.now}}],
+                 "mht_samplers": [{"name": "latency", "value": {
+                    "latest_time_sec": self.now,
+                    "last_minute_samples": {"sample_values": [1, 2, 3, 4], "num_events": 8,
+                                            "sample_times_sec": [self.now] * 4, "samples_size": 4},
+                    "all_time_samples": {"sample_values": [1, 2, 3, 4], "num_events": 8,
+                                         "sample_times_sec": [self.now] * 4, "samples_size": 4}}}]}
+
+  def test_prometheus(self):
+    lines = exporter.render_prometheus(self.dump, self.now).splitlines()
+    self.assertTrue('varz_counter{name="requests\\"x",window="last_minute"} 2' in lines)
+    self.assertTrue('varz_counter{name="requests\\"x",window="last_hour"} 120' in lines)
+    self.assertTrue('varz_counter{name="requests\\"x",window="all_time"} 500' in lines)
+    self.assertTrue('varz_sampler{name="latency",window="last_minute",quantile="0.5"} 3' in lines)
+    self.assertTrue('varz_sampler{name="latency",window="all_time",quantile="1"} 4' in lines)
+    self.assertTrue('varz_sampler_count{name="latency",window="last_hour"} 8' in lines)
+
+  def test_json(self):
+    rendered = json.loads(exporter.render_json(self.dump, self.now))
+    self.assertEquals({"last_minute": 2, "last_hour": 120, "all_time": 500},
+                      rendered["counters"]['requests"x'])
+    self.assertEquals(3, rendered["samplers"]["latency"]["all_time"]["median"])
+
+class ExporterHTTPServerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.varz_server = server.VARZServer(udp_port=0, tcp_port=0)
+    self.varz_server.start()
+    self.varz_server.counter_add("requests", 6000, 1)
+    self.num_dumps = 0
+    varz_client = client.VARZClient(tcp_port=self.varz_server.tcp_port)
+    all_dump = varz_client.all_dump
+    def counting_all_dump():
+      self.num_dumps += 1
+      return all_dump()
+    varz_client.all_dump = counting_all_dump
+    self.http_server = exporter.ExporterHTTPServer(("localhost", 0), varz_client, ttl_sec=60)
+    thread = threading.Thread(target=self.http_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.base_url = "http://localhost:%d" % self.http_server.server_address[1]
+
+  def tearDown(self):
+    self.http_server.shutdown()
+    self.http_server.server_close()
+    self.varz_server.stop()
+
+  def test_scrapes_share_one_dump(self):
+    bodies = [urllib2.urlopen(self.base_url + "/metrics").read() for i in xrange(5)]
+    self.assertTrue('varz_counter{name="requests",window="all_time"} 1' in bodies[0])
+    self.assertEquals(set(bodies[:1]), set(bodies))
+    self.assertEquals(1, json.load(urllib2.urlopen(self.base_url + "/metrics.json"))[
+        "counters"]["requests"]["all_time"])
+    self.assertEquals(1, self.num_dumps)
+
+  def test_non_ascii_names_are_served_as_utf8(self):
+    self.varz_server.counter_add(u"caf\xe9_requests".encode("utf-8"), 6000, 3)
+    response = urllib2.urlopen(self.base_url + "/metrics")
+    body = response.read()
+    self.assertEquals(str(len(body)), response.info()["Content-Length"])
+    self.assertTrue(u'varz_counter{name="caf\xe9_requests",window="all_time"} 3' in
+                    body.decode("utf-8"))
+    self.assertEquals(3, json.load(urllib2.urlopen(self.base_url + "/metrics.json"))[
+        "counters"][u"caf\xe9_requests"]["all_time"])
+
+  def test_unknown_path(self):
+    try:
+      urllib2.urlopen(self.base_url + "/other")
+      self.fail("expected a 404")
+    except urllib2.HTTPError as e:
+      self.assertEquals(404, e.code)
+
+if __name__ == '__main__':
+  unittest.main()
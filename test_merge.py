@@ -0,0 +1,103 @@
+import unittest
+
+import client
+import merge
+import server
+import stats
+
+def counter_json(latest_time_sec, min_counters, all_time_count=None):
+  if all_time_count is None:
+    all_time_count = sum(min_counters)
+  return {"min_counters": min_counters, "all_time_count": all_time_count,
+          "latest_time_sec": latest_time_sec}
+
+def sample_set(values, sec, num_events=None):
+  return {"sample_values": values, "sample_times_sec": [sec] * len(values),
+          "samples_size": len(values), "num_events": num_events or len(values)}
+
+def sampler_json(latest_time_sec, values, num_events=None):
+  return {"latest_time_sec": latest_time_sec,
+          "last_minute_samples": sample_set(values, latest_time_sec, num_events),
+          "all_time_samples": sample_set(values, latest_time_sec, num_events)}
+
+class MergeCountersTestCase(unittest.TestCase):
+  def test_counters_are_summed_per_minute(self):
+    # Host a last saw an event in minute 1000 (slot 40), host b in minute 1002 (slot 42)
+    a = [0] * 60
+    a[40] = 5
+    a[39] = 1
+    a[41] = 7 # from minute 941, over an hour before b's latest minute
+    b = [0] * 60
+    b[40] = 10
+    b[42] = 3
+    merged = merge.merge_dumps([{"mht_counters": [{"name": "c", "value": counter_json(1000 * 60, a)}]},
+                                {"mht_counters": [{"name": "c", "value": counter_json(1002 * 60 + 5, b)}]}])
+    value = merged["mht_counters"][0]["value"]
+    self.assertEquals(1002 * 60 + 5, value["latest_time_sec"])
+    self.assertEquals(26, value["all_time_count"])
+    expected = [0] * 60
+    expected[39] = 1
+    expected[40] = 15
+    expected[42] = 3
+    self.assertEquals(expected, value["min_counters"])
+    counter_stats = stats.CounterStats(value, 1002 * 60 + 30)
+    self.assertEquals(19, counter_stats.last_hour_count())
+    self.assertEquals(3, counter_stats.count_for_window(1))
+
+  def test_merge_order_does_not_matter(self):
+    dumps = [{"mht_counters": [{"name": "c", "value": counter_json(t * 60, [t] * 60)}]}
+             for t in (1000, 1030, 1075)]
+    self.assertEquals(merge.merge_dumps(dumps), merge.merge_dumps(reversed(dumps)))
+
+class MergeSamplersTestCase(unittest.TestCase):
+  def test_busy_hosts_outweigh_quiet_ones(self):
+    busy = {"mht_samplers": [{"name": "latency", "value": sampler_json(6000, [1] * 100, 100000)}]}
+    quiet = {"mht_samplers": [{"name": "latency", "value": sampler_json(6000, [1000] * 100, 100)}]}
+    merger = merge.DumpMerger(last_minute_size=100, all_time_size=100, seed=1)
+    merger.add_dump(busy)
+    merger.add_dump(quiet)
+    value = merger.dump()["mht_samplers"][0]["value"]
+    self.assertEquals(100100, value["all_time_samples"]["num_events"])
+    self.assertEquals(100, value["all_time_samples"]["samples_size"])
+    sampler_stats = stats.SamplerStats(value, 6010)
+    self.assertEquals(1, sampler_stats.all_time_stats()["percentile_95"])
+    self.assertEquals(100100, sampler_stats.last_minute_stats()["count"])
+
+  def test_equal_hosts_share_the_reservoir(self):
+    merger = merge.DumpMerger(all_time_size=200, seed=2)
+    for value in (1, 2):
+      merger.add("mht_samplers", "latency", sampler_json(6000, [value] * 200, 1000))
+    values = merger.dump()["mht_samplers"][0]["value"]["all_time_samples"]["sample_values"]
+    self.assertTrue(60 < values.count(1) < 140, values.count(1))
+
+  def test_stale_last_minute_samples_are_dropped(self):
+    merged = merge.merge_dumps([{"mht_samplers": [{"name": "s", "value": sampler_json(6000, [1])}]},
+                                {"mht_samplers": [{"name": "s", "value": sampler_json(6065, [2])}]}])
+    value = merged["mht_samplers"][0]["value"]
+    self.assertEquals([2], value["last_minute_samples"]["sample_values"])
+    self.assertEquals([1, 2], sorted(value["all_time_samples"]["sample_values"]))
+
+class FetchAndMergeTestCase(unittest.TestCase):
+  def test_dumps_of_several_daemons_are_streamed_and_merged(self):
+    servers = [server.VARZServer(udp_port=0, tcp_port=0) for i in xrange(3)]
+    clients = []
+    try:
+      for i, s in enumerate(servers):
+        s.start()
+        s.counter_add("requests", 6000, i + 1)
+        s.sampler_add("latency", 6000, 10 * i)
+        clients.append(client.VARZClient(udp_port=s.udp_port, tcp_port=s.tcp_port))
+      merged = merge.fetch_and_merge(clients, max_concurrency=2)
+    finally:
+      for s in servers:
+        s.stop()
+    self.assertEquals(6, merged["mht_counters"][0]["value"]["all_time_count"])
+    self.assertEquals([0, 10, 20], sorted(
+        merged["mht_samplers"][0]["value"]["all_time_samples"]["sample_values"]))
+
+  def test_fetch_errors_are_raised(self):
+    unreachable = client.VARZClient(tcp_port=1)
+    self.assertRaises(Exception, merge.fetch_and_merge, [unreachable])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,203 @@
+import argparse
+import StringIO
+import unittest
+
+import print_stats
+
+NOW = 6000 * 60 + 30
+
+def counter_value(per_minute, latest_time_sec=NOW):
+  return {"min_counters": [per_minute] * 60, "all_time_count": per_minute * 60,
+          "latest_time_sec": latest_time_sec}
+
+def sampler_value(values, latest_time_sec=NOW):
+  sample_set = {"sample_values": values, "sample_times_sec": [latest_time_sec] * len(values),
+                "samples_size": len(values), "num_events": len(values)}
+  return {"latest_time_sec": latest_time_sec, "last_minute_samples": sample_set,
+          "all_time_samples": sample_set}
+
+class StaticDumpClient(object):
+  '''Stands in for a VARZClient, streaming a fixed list of (kind, name, value) entries'''
+  def __init__(self, entries):
+    self.entries = entries
+
+  def iter_dump(self):
+    return iter(self.entries)
+
+def parse_args(argv=()):
+  return print_stats.main_parser().parse_args(list(argv))
+
+class ParseWindowsTestCase(unittest.TestCase):
+  def test_windows_in_minutes(self):
+    self.assertEquals([1, 5, 60, None], print_stats.parse_windows("1m,5m,1h,all"))
+
+  def test_bad_windows_are_rejected(self):
+    for windows in ["5s", "0m", "m", "2h", "61m", "1m,", "all,x"]:
+      self.assertRaises(argparse.ArgumentTypeError, print_stats.parse_windows, windows)
+
+class RowCacheTestCase(unittest.TestCase):
+  def setUp(self):
+    self.cache = print_stats.RowCache()
+    self.windows = [1, 60, None]
+
+  def row(self, value, current_epoch_sec=NOW):
+    return self.cache.row("mht_counters", "requests", value, current_epoch_sec, self.windows)
+
+  def test_unchanged_variable_is_reused_within_the_minute(self):
+    first = self.row(counter_value(2))
+    self.assertEquals(("requests", 2, 120, 120), first)
+    self.assertEquals(first, self.row(counter_value(2), NOW + 29))
+    self.assertEquals(1, self.cache.num_computed)
+
+  def test_new_events_invalidate_the_row(self):
+    self.row(counter_value(2))
+    self.assertEquals(("requests", 3, 180, 180), self.row(counter_value(3)))
+    self.row(counter_value(3, NOW + 1), NOW + 1)
+    self.assertEquals(3, self.cache.num_computed)
+
+  def test_next_minute_invalidates_the_row(self):
+    self.row(counter_value(2))
+    self.assertEquals(0, self.row(counter_value(2), NOW + 60)[1])
+    self.assertEquals(2, self.cache.num_computed)
+
+  def test_variables_missing_from_the_dump_are_forgotten(self):
+    self.row(counter_value(2))
+    self.cache.row("mht_counters", "other", counter_value(1), NOW, self.windows)
+    self.cache.retain_only(set([("mht_counters", "other")]))
+    self.assertEquals([("mht_counters", "other")], self.cache.entries.keys())
+
+class LastMinuteRateTestCase(unittest.TestCase):
+  def test_sampler_rate_is_read_from_the_dump(self):
+    value = sampler_value([4, 3, 2, 1])
+    value["last_minute_samples"]["num_events"] = 40
+    self.assertEquals(40, print_stats.last_minute_rate("mht_samplers", value, NOW))
+    self.assertEquals(0, print_stats.last_minute_rate("mht_samplers", value, NOW + 60))
+
+  def test_counter_rate(self):
+    self.assertEquals(7, print_stats.last_minute_rate("mht_counters", counter_value(7), NOW))
+
+class CollectRowsTestCase(unittest.TestCase):
+  def setUp(self):
+    self.client = StaticDumpClient(
+        [("mht_counters", "b_requests", counter_value(5)),
+         ("mht_counters", "a_requests", counter_value(1)),
+         ("mht_counters", "c_errors", counter_value(9)),
+         ("mht_counters", "d_requests", counter_value(7)),
+         ("mht_samplers", "z_latency", sampler_value([4, 3, 2, 1])),
+         ("mht_samplers", "y_latency", sampler_value([10]))])
+
+  def collect(self, argv=(), cache=None):
+    return print_stats.collect_rows(self.client, NOW, parse_args(argv),
+                                    cache or print_stats.RowCache())
+
+  def test_rows_are_sorted_by_name(self):
+    sampler_rows, counter_rows = self.collect()
+    self.assertEquals(["y_latency", "z_latency"], [row[0] for row in sampler_rows])
+    self.assertEquals(["a_requests", "b_requests", "c_errors", "d_requests"],
+                      [row[0] for row in counter_rows])
+    self.assertEquals(("z_latency", 3, 4, 3, 4, 3, 4), sampler_rows[1])
+
+  def test_filter(self):
+    sampler_rows, counter_rows = self.collect(["--filter", "requests$"])
+    self.assertEquals([], sampler_rows)
+    self.assertEquals(["a_requests", "b_requests", "d_requests"], [row[0] for row in counter_rows])
+
+  def test_top_keeps_the_busiest_and_sorts_them_by_name(self):
+    sampler_rows, counter_rows = self.collect(["--top", "2", "--filter", "requests|latency"])
+    self.assertEquals(["b_requests", "d_requests"], [row[0] for row in counter_rows])
+    self.assertEquals(["y_latency", "z_latency"], [row[0] for row in sampler_rows])
+    sampler_rows, counter_rows = self.collect(["--top", "1"])
+    self.assertEquals(["c_errors"], [row[0] for row in counter_rows])
+    self.assertEquals(["z_latency"], [row[0] for row in sampler_rows])
+
+  def test_cache_is_pruned_to_the_filtered_variables(self):
+    cache = print_stats.RowCache()
+    self.collect(cache=cache)
+    self.collect(["--filter", "^a_"], cache)
+    self.assertEquals([("mht_counters", "a_requests")], cache.entries.keys())
+    self.assertEquals(6, cache.num_computed)
+
+  def test_top_only_builds_rows_for_the_top_variables(self):
+    cache = print_stats.RowCache()
+    self.collect(["--top", "1"], cache)
+    self.assertEquals(2, cache.num_computed)
+    self.assertEquals(sorted([("mht_counters", "c_errors"), ("mht_samplers", "z_latency")]),
+                      sorted(cache.entries))
+
+  def test_top_trims_its_candidates_while_the_dump_streams(self):
+    self.client = StaticDumpClient([("mht_counters", "counter_%02d" % i, counter_value(i % 7))
+                                    for i in xrange(50)])
+    original_slack = print_stats.TOP_CANDIDATES_SLACK
+    print_stats.TOP_CANDIDATES_SLACK = 3
+    try:
+      sampler_rows, counter_rows = self.collect(["--top", "4"])
+    finally:
+      print_stats.TOP_CANDIDATES_SLACK = original_slack
+    self.assertEquals(["counter_06", "counter_13", "counter_20", "counter_27"],
+                      [row[0] for row in counter_rows])
+
+class PooledCollectRowsTestCase(unittest.TestCase):
+  def setUp(self):
+    entries = []
+    for i in xrange(40):
+      entries.append(("mht_counters", "counter_%02d" % (i * 7 % 40), counter_value(i % 5)))
+      entries.append(("mht_samplers", "sampler_%02d" % (i * 3 % 40),
+                      sampler_value(range(i, i + 10 + i % 4))))
+    self.client = StaticDumpClient(entries)
+    self.pool = print_stats.create_pool(3)
+
+  def tearDown(self):
+    self.pool.terminate()
+
+  def test_pooled_rows_match_serial_rows(self):
+    for argv in [(), ("--top", "5"), ("--filter", "_[12]", "--windows", "1m,5m,all")]:
+      args = parse_args(argv)
+      serial = print_stats.collect_rows(self.client, NOW, args, print_stats.RowCache())
+      pooled = print_stats.collect_rows(self.client, NOW, args, print_stats.RowCache(), self.pool,
+                                        chunk_size=3)
+      self.assertEquals(serial, pooled)
+
+  def test_pooled_rows_fill_and_reuse_the_cache(self):
+    args = parse_args()
+    cache = print_stats.RowCache()
+    first = print_stats.collect_rows(self.client, NOW, args, cache, self.pool, chunk_size=4)
+    self.assertEquals(80, cache.num_computed)
+    cache.num_computed = 0
+    self.assertEquals(first, print_stats.collect_rows(self.client, NOW, args, cache, self.pool,
+                                                      chunk_size=4))
+    self.assertEquals(0, cache.num_computed)
+
+  def test_top_ties_do_not_depend_on_cache_hits(self):
+    args = parse_args(["--top", "3"])
+    serial = print_stats.collect_rows(self.client, NOW, args, print_stats.RowCache())
+    cache = print_stats.RowCache()
+    # Half the variables are cache hits, which are collected ahead of the pooled ones
+    print_stats.collect_rows(StaticDumpClient(self.client.entries[40:]), NOW, args, cache)
+    self.assertEquals(serial, print_stats.collect_rows(self.client, NOW, args, cache, self.pool,
+                                                       chunk_size=3))
+
+class TerminalRedrawerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.out = StringIO.StringIO()
+    self.redrawer = print_stats.TerminalRedrawer(self.out)
+
+  def draw(self, lines):
+    self.out.truncate(0)
+    self.redrawer.draw(lines)
+    return self.out.getvalue()
+
+  def test_first_draw_clears_the_screen(self):
+    self.assertEquals("\033[H\033[2J\033[1;1Ha\033[K\033[2;1Hb\033[K", self.draw(["a", "b"]))
+
+  def test_only_changed_lines_are_rewritten(self):
+    self.draw(["a", "b", "c"])
+    self.assertEquals("\033[2;1HB\033[K", self.draw(["a", "B", "c"]))
+    self.assertEquals("", self.draw(["a", "B", "c"]))
+
+  def test_longer_and_shorter_reports(self):
+    self.draw(["a"])
+    self.assertEquals("\033[2;1Hb\033[K", self.draw(["a", "b"]))
+    self.assertEquals("\033[2;1H\033[J", self.draw(["a"]))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,114 @@
+import time
+import unittest
+
+import client
+import server
+import stats
+
+class VARZServerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.server = server.VARZServer(udp_port=0, tcp_port=0)
+    self.server.start()
+    self.client = client.VARZClient(udp_port=self.server.udp_port, tcp_port=self.server.tcp_port)
+    self.client.setup()
+
+  def tearDown(self):
+    self.client.close()
+    self.server.stop()
+
+  def waitForEvents(self, num_events, timeout_sec=2):
+    deadline = time.time() + timeout_sec
+    while time.time() < deadline:
+      dump = self.client.all_dump()
+      total = (sum(c["value"]["all_time_count"] for c in dump["mht_counters"]) +
+               sum(s["value"]["all_time_samples"]["num_events"] for s in dump["mht_samplers"]))
+      if total >= num_events:
+        return dump
+      time.sleep(0.01)
+    self.fail("timed out waiting for %d events" % num_events)
+
+  def test_udp_commands_show_up_in_dump(self):
+    self.client.counter_increment("requests", 3)
+    self.client.sampler_add("latency", 42)
+    dump = self.waitForEvents(4)
+    self.assertEquals(["requests"], [c["name"] for c in dump["mht_counters"]])
+    self.assertEquals(3, dump["mht_counters"][0]["value"]["all_time_count"])
+    self.assertEquals([42], dump["mht_samplers"][0]["value"]["all_time_samples"]["sample_values"])
+    self.assertEquals({"mht_counters": ["requests"], "mht_samplers": ["latency"]},
+                      self.client.all_list())
+
+  def test_batched_datagrams_and_pipelined_tcp_commands(self):
+    batched_client = client.VARZClient(udp_port=self.server.udp_port, batch_udp=True)
+    batched_client.setup()
+    for x in range(100):
+      batched_client.counter_increment("batched")
+      self.client.counter_increment("pipelined", mode=client.VARZClient.MODE_TCP)
+    batched_client.close()
+    dump = self.waitForEvents(200)
+    counts = dict((c["name"], c["value"]["all_time_count"]) for c in dump["mht_counters"])
+    self.assertEquals({"batched": 100, "pipelined": 100}, counts)
+
+  def test_iter_dump_and_flush(self):
+    self.client.counter_increment("requests")
+    self.waitForEvents(1)
+    self.assertEquals(["requests"], [name for kind, name, value in self.client.iter_dump()])
+    self.client.all_flush()
+    self.assertEquals([], list(self.client.iter_dump()))
+
+  def test_self_stats_time_tcp_requests_and_dumps(self):
+    instrumented = client.VARZClient(udp_port=self.server.udp_port, tcp_port=self.server.tcp_port,
+                                     instrument=True)
+    instrumented.setup()
+    instrumented.counter_increment("requests", mode=client.VARZClient.MODE_TCP)
+    self.waitForEvents(1)
+    instrumented.all_dump()
+    list(instrumented.iter_dump())
+    instrumented.all_list()
+    stats = instrumented.self_stats()
+    instrumented.close()
+    self.assertEquals(2, stats["counts"]["dumps"])
+    self.assertTrue(stats["largest_dump_bytes"] > 0)
+    self.assertEquals(1, stats["latencies"]["tcp_alldumpjson_us"]["count"])
+    self.assertEquals(1, stats["latencies"]["tcp_alllistjson_us"]["count"])
+    self.assertTrue(stats["counts"]["tcp_connects"] >= 2)
+
+  def test_malformed_commands_are_counted_and_ignored(self):
+    self.server.execute_commands("MHTCOUNTERADD a b c;BOGUS;MHTCOUNTERADD a 60 1;")
+    self.assertEquals(2, self.server.num_bad_commands)
+    self.assertEquals(1, self.server.counters["a"].all_time_count)
+
+
+class CounterTestCase(unittest.TestCase):
+  def test_ring_matches_counter_stats(self):
+    counter = server.Counter()
+    for minute in range(600, 616):
+      counter.add(minute * 60 + 5, minute - 600)
+    counter.add(555 * 60, 1000) # Too old for the ring
+    counter_stats = stats.CounterStats(counter.to_json(), 615 * 60)
+    self.assertEquals(15, counter_stats.last_minute_count())
+    self.assertEquals(sum(range(16)), counter_stats.last_hour_count())
+    self.assertEquals(sum(range(16)) + 1000, counter_stats.all_time_count())
+
+  def test_skipped_minutes_are_zeroed(self):
+    counter = server.Counter()
+    counter.add(600 * 60, 5)
+    counter.add(659 * 60, 7)
+    counter.add(700 * 60, 1)
+    self.assertEquals(1 + 7, sum(counter.min_counters))
+
+
+class SamplerTestCase(unittest.TestCase):
+  def test_reservoir_is_bounded_and_counts_every_event(self):
+    sampler = server.Sampler(last_minute_size=10, all_time_size=100)
+    for x in range(1000):
+      sampler.add(6000 + x / 100, x)
+    sampler_json = sampler.to_json()
+    self.assertEquals(100, sampler_json["all_time_samples"]["samples_size"])
+    self.assertEquals(1000, sampler_json["all_time_samples"]["num_events"])
+    self.assertEquals(10, sampler_json["last_minute_samples"]["samples_size"])
+    self.assertEquals(1000, sampler_json["last_minute_samples"]["num_events"])
+    sampler.add(6060, 5)
+    self.assertEquals([5], sampler.to_json()["last_minute_samples"]["sample_values"])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,114 @@
+import time
+import unittest
+
+import server
+import sharded
+
+class HashRingTestCase(unittest.TestCase):
+  def test_names_spread_over_all_nodes(self):
+    ring = sharded.HashRing(["a", "b", "c", "d"])
+    counts = {}
+    for i in xrange(4000):
+      node = ring.node_for("variable_%d" % i)
+      counts[node] = counts.get(node, 0) + 1
+    self.assertEquals(["a", "b", "c", "d"], sorted(counts))
+    self.assertTrue(min(counts.values()) > 600, counts)
+
+  def test_adding_a_node_only_moves_names_to_it(self):
+    before = sharded.HashRing(["a", "b", "c", "d"])
+    after = sharded.HashRing(["a", "b", "c", "d", "e"])
+    names = ["variable_%d" % i for i in xrange(4000)]
+    moved = [name for name in names if before.node_for(name) != after.node_for(name)]
+    self.assertEquals(set(["e"]), set(after.node_for(name) for name in moved))
+    self.assertTrue(len(moved) < len(names) / 3, len(moved))
+
+class MergeTestCase(unittest.TestCase):
+  def counter(self, name, latest_time_sec):
+    return {"name": name, "value": {"min_counters": [0] * 60, "all_time_count": latest_time_sec,
+                                    "latest_time_sec": latest_time_sec}}
+
+  def test_merge_dumps_merges_entries_of_names_on_several_shards(self):
+    old_shard = self.counter("a", 60)
+    old_shard["value"]["min_counters"][1] = 5
+    new_shard = self.counter("a", 120)
+    new_shard["value"]["min_counters"][2] = 7
+    sampler = {"latest_time_sec": 60,
+               "all_time_samples": {"sample_values": [3], "sample_times_sec": [60],
+                                    "samples_size": 1, "num_events": 1}}
+    merged = sharded.merge_dumps([{"mht_counters": [old_shard, self.counter("b", 60)],
+                                   "mht_samplers": [{"name": "s", "value": sampler}]},
+                                  {"mht_counters": [new_shard],
+                                   "mht_samplers": [{"name": "s", "value": sampler}]}])
+    counters = dict((c["name"], c["value"]) for c in merged["mht_counters"])
+    self.assertEquals(["a", "b"], sorted(counters))
+    self.assertEquals(180, counters["a"]["all_time_count"])
+    self.assertEquals(120, counters["a"]["latest_time_sec"])
+    self.assertEquals([5, 7], counters["a"]["min_counters"][1:3])
+    self.assertEquals(["s"], [s["name"] for s in merged["mht_samplers"]])
+    all_time_samples = merged["mht_samplers"][0]["value"]["all_time_samples"]
+    self.assertEquals(([3, 3], 2), (all_time_samples["sample_values"],
+                                    all_time_samples["num_events"]))
+
+  def test_merge_lists(self):
+    merged = sharded.merge_lists([{"mht_counters": ["b", "a"], "mht_samplers": ["s"]},
+                                  {"mht_counters": ["a", "c"], "mht_samplers": []}])
+    self.assertEquals({"mht_counters": ["a", "b", "c"], "mht_samplers": ["s"]}, merged)
+
+  def test_parse_shards(self):
+    self.assertEquals([("host1", 4447, 14447), ("10.0.0.2", 5000, 15000)],
+                      sharded.parse_shards("host1:4447:14447,10.0.0.2:5000:15000"))
+
+class ShardedVARZClientTestCase(unittest.TestCase):
+  def setUp(self):
+    self.servers = [server.VARZServer(udp_port=0, tcp_port=0) for i in xrange(3)]
+    for s in self.servers:
+      s.start()
+    self.client = sharded.ShardedVARZClient([("localhost", s.udp_port, s.tcp_port)
+                                             for s in self.servers])
+    self.client.setup()
+
+  def tearDown(self):
+    self.client.close()
+    for s in self.servers:
+      s.stop()
+
+  def test_variables_are_routed_to_one_shard_and_merged_back(self):
+    names = ["variable_%d" % i for i in xrange(30)]
+    for name in names:
+      self.client.counter_increment(name, 2)
+    deadline = time.time() + 2
+    while time.time() < deadline:
+      dump = self.client.all_dump()
+      if len(dump["mht_counters"]) == len(names):
+        break
+      time.sleep(0.01)
+    self.assertEquals(names, sorted(self.client.all_list()["mht_counters"],
+                                    key=lambda name: int(name.split("_")[1])))
+    self.assertEquals(set([2]), set(c["value"]["all_time_count"] for c in dump["mht_counters"]))
+    self.assertTrue(all(s.counters for s in self.servers))
+    for s in self.servers:
+      for name in s.counters:
+        self.assertEquals("localhost:%d:%d" % (s.udp_port, s.tcp_port),
+                          self.client.ring.node_for(name))
+    self.assertEquals(len(names), len(list(self.client.iter_dump())))
+
+  def test_names_on_two_shards_are_merged(self):
+    moved = self.client.clients[0]
+    stayed = self.client.clients[1]
+    moved.counter_increment("moved", 3)
+    stayed.counter_increment("moved", 4)
+    deadline = time.time() + 2
+    while time.time() < deadline:
+      if all(s.counters for s in self.servers[:2]):
+        break
+      time.sleep(0.01)
+    self.assertEquals([("mht_counters", "moved", 7)],
+                      [(kind, name, value["all_time_count"])
+                       for kind, name, value in self.client.iter_dump()])
+    self.assertEquals([7], [c["value"]["all_time_count"]
+                            for c in self.client.all_dump()["mht_counters"]])
+    self.client.all_flush()
+    self.assertEquals({"mht_counters": [], "mht_samplers": []}, self.client.all_list())
+
+if __name__ == '__main__':
+  unittest.main()
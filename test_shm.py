@@ -0,0 +1,165 @@
+import os
+import threading
+import unittest
+
+import client
+import shm
+import utils
+
+class RecordingClient(object):
+  '''Stands in for a VARZClient, recording (kind, name, sec_since_epoch, amount)'''
+  def __init__(self):
+    self.sent = []
+    self.num_after_forks = 0
+
+  def counter_increment(self, counter_name, amt=1, time=None, mode=None):
+    self.sent.append(("counter", counter_name, utils.datetime_to_sec_since_epoch(time), amt))
+
+  def sampler_add(self, sampler_name, value, time=None, mode=None):
+    self.sent.append(("sampler", sampler_name, utils.datetime_to_sec_since_epoch(time), value))
+
+  def flush(self):
+    pass
+
+  def after_fork(self):
+    self.num_after_forks += 1
+
+class SharedMemoryTestCase(unittest.TestCase):
+  def setUp(self):
+    self.region = shm.SharedMetricsRegion(max_workers=8, max_names=16, ring_size=4)
+    self.varz = RecordingClient()
+    self.sender = shm.SharedMetricsSender(self.region, self.varz)
+
+  def runInChildren(self, num_children, fn):
+    '''Returns: the exit status of each child; fn's result is its exit code'''
+    pids = []
+    for i in xrange(num_children):
+      pid = os.fork()
+      if pid == 0:
+        code = 1
+        try:
+          code = fn(i) or 0
+        finally:
+          os._exit(code)
+      pids.append(pid)
+    return [os.waitpid(pid, 0)[1] >> 8 for pid in pids]
+
+  def test_counters_are_summed_across_workers_into_one_command(self):
+    c = shm.SharedMemoryClient(self.region)
+    c.counter_increment("requests")
+    def work(i):
+      for _ in xrange(10):
+        c.counter_increment("requests", i + 1)
+    self.runInChildren(4, work)
+    self.sender.drain()
+    self.assertEquals([("counter", "requests", self.varz.sent[0][2], 1 + 10 * (1 + 2 + 3 + 4))],
+                      self.varz.sent)
+
+  def test_drain_sends_only_increments_since_the_last_drain(self):
+    c = shm.SharedMemoryClient(self.region)
+    c.counter_increment("a", 5)
+    self.sender.drain()
+    self.sender.drain()
+    c.counter_increment("a", 2)
+    self.sender.drain()
+    self.assertEquals([5, 2], [amount for _, _, _, amount in self.varz.sent])
+
+  def test_samples_keep_their_time_and_value(self):
+    c = shm.SharedMemoryClient(self.region)
+    def work(i):
+      c.sampler_add("latency", 100 + i, time=utils.sec_since_epoch_to_datetime(1000 + i))
+    self.runInChildren(2, work)
+    self.sender.drain()
+    self.assertEquals([("sampler", "latency", 1000, 100), ("sampler", "latency", 1001, 101)],
+                      sorted(self.varz.sent))
+
+  def test_full_ring_drops_and_counts_samples(self):
+    c = shm.SharedMemoryClient(self.region)
+    for value in xrange(6):
+      c.sampler_add("latency", value)
+    self.assertEquals(2, self.region.dropped_samples())
+    self.sender.drain()
+    self.assertEquals(range(4), [value for _, _, _, value in self.varz.sent])
+    c.sampler_add("latency", 9)
+    self.sender.drain()
+    self.assertEquals(9, self.varz.sent[-1][3])
+
+  def test_counter_and_sampler_with_the_same_name_are_separate(self):
+    c = shm.SharedMemoryClient(self.region)
+    c.counter_increment("x", 3)
+    c.sampler_add("x", 7)
+    self.sender.drain()
+    self.assertEquals([("counter", 3), ("sampler", 7)],
+                      sorted((kind, amount) for kind, _, _, amount in self.varz.sent))
+
+  def test_sampled_names_are_checked_when_registered(self):
+    c = shm.SharedMemoryClient(self.region, client.VARZClient(sampler_max_values_per_sec=2))
+    longest = "s" * (client.VARZClient.MAX_NAME_LEN - len(utils.SAMPLER_EVENTS_SUFFIX))
+    c.sampler_add(longest, 1)
+    self.assertRaises(ValueError, c.sampler_add, longest + "s", 1)
+    c.counter_increment(longest + "s")
+
+  def test_drain_sends_after_releasing_the_region_lock(self):
+    region = self.region
+    lock_free_during_sends = []
+    class LockCheckingClient(RecordingClient):
+      def counter_increment(self, counter_name, amt=1, time=None, mode=None):
+        lock_free_during_sends.append(self.lock_is_free())
+        RecordingClient.counter_increment(self, counter_name, amt, time, mode)
+      def sampler_add(self, sampler_name, value, time=None, mode=None):
+        lock_free_during_sends.append(self.lock_is_free())
+        RecordingClient.sampler_add(self, sampler_name, value, time, mode)
+      def lock_is_free(self):
+        if not region.lock.acquire(False):
+          return False
+        region.lock.release()
+        return True
+    c = shm.SharedMemoryClient(region)
+    c.counter_increment("requests")
+    c.sampler_add("latency", 5)
+    varz = LockCheckingClient()
+    shm.SharedMetricsSender(region, varz).drain()
+    self.assertEquals(2, len(varz.sent))
+    self.assertEquals([True, True], lock_free_during_sends)
+
+  def test_threads_of_one_worker_lose_no_updates(self):
+    region = shm.SharedMetricsRegion(max_workers=2, max_names=4, ring_size=4 * 5000)
+    c = shm.SharedMemoryClient(region)
+    def work():
+      for i in xrange(5000):
+        c.counter_increment("requests")
+        c.sampler_add("latency", i)
+    threads = [threading.Thread(target=work) for i in xrange(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    shm.SharedMetricsSender(region, self.varz).drain()
+    self.assertEquals([4 * 5000], [amount for kind, _, _, amount in self.varz.sent
+                                   if kind == "counter"])
+    self.assertEquals(0, region.dropped_samples())
+    self.assertEquals(4 * 5000, len([kind for kind, _, _, _ in self.varz.sent if kind == "sampler"]))
+
+  def test_varz_client_is_only_reset_in_forked_children(self):
+    c = shm.SharedMemoryClient(self.region, self.varz, elect_sender=True, interval_sec=60)
+    c.counter_increment("requests")
+    self.assertEquals(0, self.varz.num_after_forks)
+    def work(i):
+      c.counter_increment("requests")
+      c.counter_increment("requests")
+      return self.varz.num_after_forks
+    self.assertEquals([1, 1], self.runInChildren(2, work))
+    self.assertEquals(0, self.varz.num_after_forks)
+
+  def test_slots_of_exited_workers_are_reused(self):
+    self.runInChildren(self.region.max_workers + 2, lambda i: self.region.claim_worker_slot())
+    self.region.claim_worker_slot()
+
+  def test_elected_sender_is_kept_while_it_heartbeats(self):
+    self.assertTrue(self.region.try_become_sender(stale_after_sec=60))
+    self.region.header.sender_pid = 1
+    self.assertFalse(self.region.try_become_sender(stale_after_sec=60))
+    self.assertTrue(self.region.try_become_sender(stale_after_sec=-1))
+
+if __name__ == '__main__':
+  unittest.main()
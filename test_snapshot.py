@@ -0,0 +1,73 @@
+import random
+import unittest
+
+try:
+  import batch_stats
+except ImportError:
+  batch_stats = None
+import snapshot
+import stats
+
+class DumpSnapshotTestCase(unittest.TestCase):
+  def setUp(self):
+    random.seed(14447)
+    self.latest_time_sec = 60 * 140000
+
+  def createFakeSamples(self, num_samples, duration_sec):
+    return {"sample_values": [random.randrange(100000) for x in range(num_samples)],
+            "sample_times_sec": [self.latest_time_sec - random.randrange(duration_sec)
+                                 for x in range(num_samples)],
+            "samples_size": num_samples,
+            "num_events": num_samples * 3}
+
+  def createFakeDump(self, num_vars=50):
+    return {"mht_counters": [{"name": "counter_%d" % i,
+                              "value": {"min_counters": [random.randrange(1000) for x in range(60)],
+                                        "all_time_count": 123456789012,
+                                        "latest_time_sec": self.latest_time_sec - 60 * (i % 5)}}
+                             for i in range(num_vars)],
+            "mht_samplers": [{"name": "sampler_%d" % i,
+                              "value": {"latest_time_sec": self.latest_time_sec,
+                                        "last_minute_samples": self.createFakeSamples(20, 60),
+                                        "all_time_samples": self.createFakeSamples(300, 7200)}}
+                             for i in range(num_vars)]}
+
+  def test_name_lookup(self):
+    dump = self.createFakeDump()
+    snap = snapshot.DumpSnapshot.from_dump(dump)
+    self.assertEquals(list(dump["mht_counters"][7]["value"]["min_counters"]),
+                      list(snap.counter("counter_7")["min_counters"]))
+    self.assertEquals(dump["mht_samplers"][3]["value"]["all_time_samples"]["num_events"],
+                      snap.sampler("sampler_3")["all_time_samples"]["num_events"])
+    self.assertRaises(KeyError, snap.sampler, "counter_7")
+
+  def test_stats_match_dict_form(self):
+    dump = self.createFakeDump()
+    snap = snapshot.DumpSnapshot.from_dump(dump)
+    current_epoch_sec = self.latest_time_sec + 30
+    for entry in dump["mht_samplers"]:
+      expected = stats.SamplerStats(entry["value"], current_epoch_sec)
+      actual = stats.SamplerStats(snap.sampler(entry["name"]), current_epoch_sec)
+      self.assertEquals(expected.last_minute_stats(), actual.last_minute_stats())
+      self.assertEquals(expected.last_hour_stats([99]), actual.last_hour_stats([99]))
+      self.assertEquals(expected.all_time_stats([99.9]), actual.all_time_stats([99.9]))
+    for entry in dump["mht_counters"]:
+      expected = stats.CounterStats(entry["value"], current_epoch_sec)
+      actual = stats.CounterStats(snap.counter(entry["name"]), current_epoch_sec)
+      self.assertEquals(expected.last_minute_count(), actual.last_minute_count())
+      self.assertEquals(expected.count_for_window(15), actual.count_for_window(15))
+      self.assertEquals(expected.all_time_count(), actual.all_time_count())
+
+  @unittest.skipIf(batch_stats is None, "batch_stats requires numpy")
+  def test_batch_stats_accept_records(self):
+    dump = self.createFakeDump()
+    snap = snapshot.DumpSnapshot.from_dump(dump)
+    records = [{"name": name, "value": record} for kind, name, record in snap.iter_entries()
+               if kind == "mht_samplers"]
+    expected = batch_stats.BatchSamplerStats(dump["mht_samplers"], self.latest_time_sec)
+    actual = batch_stats.BatchSamplerStats(records, self.latest_time_sec)
+    self.assertEquals(list(expected.last_hour_stats()["median"]),
+                      list(actual.last_hour_stats()["median"]))
+
+if __name__ == "__main__":
+  unittest.main()
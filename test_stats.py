@@ -1,6 +1,12 @@
+import json
+import random
 import unittest
 
 import stats
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 class SamplerStatsTestCase(unittest.TestCase):
   def setUp(self):
@@ -97,6 +103,168 @@ class SamplerStatsTestCase(unittest.TestCase):
     self.assertEquals(0, hr_stats["largest_value"])
     self.assertEquals(0, hr_stats["count"])
 
+  def test_extra_percentiles(self):
+    s = stats.SamplerStats(self.createFakeData(), self.latest_time_sec)
+    at_stats = s.all_time_stats(percentiles=[90, 99, 99.9])
+    self.assertEquals(900, at_stats["percentile_90"])
+    self.assertEquals(990, at_stats["percentile_99"])
+    self.assertEquals(999, at_stats["percentile_99.9"])
+    self.assertEquals(500, at_stats["median"])
+
+  def test_extra_percentiles_for_last_hour_and_empty_windows(self):
+    s = stats.SamplerStats(self.createFakeData(3600*3, 600, 6000), self.latest_time_sec)
+    self.assertEquals(198, s.last_hour_stats(percentiles=[99])["percentile_99"])
+    s = stats.SamplerStats(self.createFakeData(), self.latest_time_sec + 60)
+    self.assertEquals(0, s.last_minute_stats(percentiles=[99.9])["percentile_99.9"])
+
+  def test_selection_and_sorting_agree(self):
+    samples = [(x * 7919) % 1000 for x in range(1000)]
+    s = stats.SamplerStats(self.createFakeData(), self.latest_time_sec)
+    selected = s._compute_order_statistics(samples, [99])
+    self.assertEquals(s._compute_sorted_order_statistics(sorted(samples), [99]), selected)
+
+  def test_all_time_stats_same_before_and_after_sorting(self):
+    s = stats.SamplerStats(self.createFakeData(), self.latest_time_sec)
+    before = s.all_time_stats()
+    s.last_hour_stats()
+    self.assertEquals(before, s.all_time_stats())
+
+  def test_all_time_reservoir_is_sorted_once_for_every_window(self):
+    sort_sizes = []
+    num_partitions = [0]
+    def counting_sorted(iterable, *args, **kwargs):
+      result = sorted(iterable, *args, **kwargs)
+      sort_sizes.append(len(result))
+      return result
+    class CountingNumpy(object):
+      def __getattr__(self, name):
+        return getattr(numpy, name)
+      def partition(self, *args):
+        num_partitions[0] += 1
+        return numpy.partition(*args)
+    stats.sorted = counting_sorted
+    original_numpy = stats.numpy
+    stats.numpy = CountingNumpy() if numpy is not None else None
+    try:
+      s = stats.SamplerStats(self.createFakeData(3600*3, 600, 6000), self.latest_time_sec)
+      s.all_time_stats()
+      hour_count = s.last_hour_stats()["count"]
+      half_hour_count = s.stats_for_window(1800, [99])["count"]
+      s.all_time_stats([99.9])
+    finally:
+      del stats.sorted
+      stats.numpy = original_numpy
+    # The value order and the time index are each built once over all 600 samples; each window
+    # then only orders the ranks of its own samples
+    self.assertEquals([600, 600, 200, 100], sort_sizes)
+    self.assertEquals([2000, 1000], [hour_count, half_hour_count])
+    self.assertEquals(0, num_partitions[0])
+
+  def test_sorted_values_in_window(self):
+    values = [5, 3, 9, 1, 7, 3, 8]
+    times = [10, 12, 11, 15, 13, 14, 10]
+    samples = stats.SortedSamples(values, times)
+    for end_time, seconds in [(15, 3), (15, 100), (12, 2), (9, 5), (14, 1)]:
+      expected = sorted(v for v, t in zip(values, times) if end_time >= t > end_time - seconds)
+      self.assertEquals(expected, samples.sorted_values_in_window(end_time, seconds))
+
+  def test_stats_for_window(self):
+    s = stats.SamplerStats(self.createFakeData(3600*3, 600, 6000), self.latest_time_sec)
+    window_stats = s.stats_for_window(1800)
+    self.assertEquals(50, window_stats["median"])
+    self.assertEquals(99, window_stats["largest_value"])
+    self.assertEquals(1000, window_stats["count"])
+
+  def test_companion_events_counter_gives_exact_counts(self):
+    events_counter = {"min_counters": [7] * 60, "all_time_count": 60000,
+                      "latest_time_sec": self.latest_time_sec}
+    s = stats.SamplerStats(self.createFakeData(3600*3, 600, 6000), self.latest_time_sec,
+                           events_counter)
+    self.assertEquals(7, s.last_minute_stats()["count"])
+    self.assertEquals(7 * 30, s.stats_for_window(1800)["count"])
+    self.assertEquals(7 * 60, s.last_hour_stats()["count"])
+    self.assertEquals(60000, s.all_time_stats()["count"])
+    # Beyond the counter's hour the all-time count is scaled by the window's share of samples
+    self.assertEquals(40000, s.stats_for_window(7200)["count"])
+    self.assertEquals(50, s.stats_for_window(1800)["median"])
+
+  def test_stats_for_window_same_before_and_after_sorting(self):
+    s = stats.SamplerStats(self.createFakeData(3600*3, 600, 6000), self.latest_time_sec)
+    before = [s.stats_for_window(seconds, [99]) for seconds in [300, 3600, 7200]]
+    s.all_time_stats(percentiles=range(10))
+    self.assertEquals(before, [s.stats_for_window(seconds, [99]) for seconds in [300, 3600, 7200]])
+    self.assertEquals(before[1], s.last_hour_stats([99]))
+
+
+class QuantileSketchTestCase(unittest.TestCase):
+  def assertWithinAccuracy(self, exact, approximate, accuracy):
+    # Sketch percentiles are rounded to ints, so allow half a unit on top of the relative error
+    self.assertTrue(abs(approximate - exact) <= abs(exact) * accuracy + 0.5,
+                    "%r not within %r of %r" % (approximate, accuracy, exact))
+
+  def test_percentiles_within_accuracy_of_exact_stats(self):
+    rng = random.Random(7)
+    distributions = [[rng.randrange(1, 1000) for x in xrange(1000)],
+                     [int(rng.lognormvariate(8, 2)) for x in xrange(1000)],
+                     [rng.randrange(-500, 500) for x in xrange(1000)],
+                     [5] * 10]
+    for values in distributions:
+      sampler_data = {"latest_time_sec": 6000,
+                      "all_time_samples": {"sample_values": values,
+                                           "sample_times_sec": [6000] * len(values),
+                                           "samples_size": len(values), "num_events": 5000}}
+      exact = stats.SamplerStats(sampler_data, 6000).all_time_stats([99, 99.9])
+      sketched = stats.SketchSamplerStats(sampler_data, 6000).all_time_stats([99, 99.9])
+      self.assertEquals(sorted(exact), sorted(sketched))
+      self.assertEquals(exact["largest_value"], sketched["largest_value"])
+      self.assertEquals(exact["count"], sketched["count"])
+      for key in exact:
+        self.assertWithinAccuracy(exact[key], sketched[key], 0.01)
+
+  def test_windows_match_sampler_stats(self):
+    data = SamplerStatsTestCase("test_stats_for_window")
+    data.setUp()
+    sampler_data = data.createFakeData(3600*3, 600, 6000)
+    exact = stats.SamplerStats(sampler_data, data.latest_time_sec)
+    sketched = stats.SketchSamplerStats(sampler_data, data.latest_time_sec, relative_accuracy=0.02)
+    for seconds in [300, 1800, 3600]:
+      exact_stats = exact.stats_for_window(seconds, [99])
+      sketched_stats = sketched.stats_for_window(seconds, [99])
+      self.assertEquals(exact_stats["count"], sketched_stats["count"])
+      for key in exact_stats:
+        self.assertWithinAccuracy(exact_stats[key], sketched_stats[key], 0.02)
+    self.assertEquals(exact.last_minute_stats()["count"], sketched.last_minute_stats()["count"])
+
+  def test_merge_equals_sketch_of_all_values(self):
+    rng = random.Random(3)
+    parts = [[rng.randrange(-100, 100000) for x in xrange(n)] for n in (10, 500, 2000)]
+    merged = stats.QuantileSketch()
+    for values in parts:
+      part = stats.QuantileSketch()
+      part.add_all(values)
+      merged.merge(part)
+    whole = stats.QuantileSketch()
+    for values in parts:
+      for value in values:
+        whole.add(value)
+    self.assertEquals(whole.to_json(), merged.to_json())
+
+  def test_merging_different_accuracies_raises(self):
+    self.assertRaises(ValueError, stats.QuantileSketch(0.01).merge, stats.QuantileSketch(0.02))
+
+  def test_serialized_sketch_is_small_and_round_trips(self):
+    rng = random.Random(5)
+    sketch = stats.QuantileSketch()
+    sketch.add_all([rng.randrange(1, 10**6) for x in xrange(100000)])
+    serialized = json.dumps(sketch.to_json())
+    self.assertTrue(len(serialized) < 8192, len(serialized))
+    copy = stats.QuantileSketch.from_json(json.loads(serialized))
+    self.assertEquals(sketch.to_json(), copy.to_json())
+    self.assertEquals(sketch.quantile(95), copy.quantile(95))
+
+  def test_empty_sketch(self):
+    self.assertEquals({"quartile_1": 0, "median": 0, "quartile_3": 0, "percentile_95": 0,
+                       "largest_value": 0}, stats.sketch_order_statistics(stats.QuantileSketch()))
 
 class CounterStatsTestCase(unittest.TestCase):
   def setUp(self):
@@ -139,6 +307,20 @@ class CounterStatsTestCase(unittest.TestCase):
     s = stats.CounterStats(self.createFakeData(), 610*60)
     self.assertEquals(0, s.last_hour_count())
 
+  def test_count_for_window(self):
+    s = stats.CounterStats(self.createFakeData(), 615*60)
+    self.assertEquals(15+14+13+12+11, s.count_for_window(5))
+    self.assertEquals(15, s.count_for_window(1))
+
+  def test_count_for_window_partially_elapsed(self):
+    s = stats.CounterStats(self.createFakeData(), 618*60)
+    self.assertEquals(15+14, s.count_for_window(5))
+    self.assertEquals(0, s.count_for_window(3))
+
+  def test_count_for_window_longer_than_an_hour_raises(self):
+    s = stats.CounterStats(self.createFakeData(), 615*60)
+    self.assertRaises(ValueError, s.count_for_window, 61)
+
   def test_all_time_count(self):
     s = stats.CounterStats(self.createFakeData(), 610*60)
     self.assertEquals(5000, s.all_time_count())
@@ -1,11 +1,40 @@
 import datetime
 import time
 
+# Command modes and the longest variable name the daemon accepts, shared by the Python 2 client and
+# the Python 3 varz_async client
+MODE_TCP = 1
+MODE_UDP = 2
+MAX_NAME_LEN = 128
+
+# Suffix of the counter a sampling client keeps next to each sampler with its exact event count
+SAMPLER_EVENTS_SUFFIX = ".events"
+
+def sampler_events_counter_name(sampler_name):
+  '''The name of the companion counter holding sampler_name's exact event count'''
+  return sampler_name + SAMPLER_EVENTS_SUFFIX
+
+def defaults_for_name_time_and_mode(name, time, mode):
+  '''Check the length of name and fill in the current time and UDP mode when they aren't given
+  Returns: (name, time, mode)'''
+  if len(name) > MAX_NAME_LEN:
+    raise ValueError("name '%s' is longer than %d" % (name, MAX_NAME_LEN))
+  if not time:
+    time = datetime.datetime.now()
+  if not mode:
+    mode = MODE_UDP # TODO: Let this be an object level setting
+  return (name, time, mode)
+
 def datetime_to_sec_since_epoch(dt):
   '''Take a python datetime object and convert it to seconds since the unix epoch. Not timezone
      aware'''
   return int(time.mktime(dt.timetuple()))
 
+def sec_since_epoch_now():
+  '''The current time as seconds since the unix epoch; same value as
+     datetime_to_sec_since_epoch(datetime.datetime.now()) without building a datetime'''
+  return int(time.time())
+
 def sec_since_epoch_to_datetime(sec_since_epoch):
   '''Take some number seconds since the epoch and convert them to a python datetime object. Not
      timezone aware'''
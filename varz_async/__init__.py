@@ -0,0 +1,3 @@
+'''Python 3 asyncio client for the varz daemon. Kept out of the Python 2 varz_client package, which
+setup.py only installs it next to under Python 3.'''
+from varz_async.client import AsyncVARZClient
@@ -0,0 +1,40 @@
+'''Events/sec of AsyncVARZClient under many concurrent coroutines. Requires Python 3; run it with
+python3 -m varz_async.bench.'''
+import asyncio
+import random
+import time
+
+from varz_async import client as async_client
+
+
+async def event_loop_worker(c, num_events, num_names=2048, value_range=16384):
+  for x in range(num_events):
+    name = "variable_%d" % random.randrange(num_names)
+    if random.randrange(2) == 0:
+      await c.counter_increment(name)
+    else:
+      await c.sampler_add(name, random.randrange(value_range))
+    if x % 64 == 0:
+      await asyncio.sleep(0) # Let the other workers in, as a request handler would
+
+
+async def benchmark_concurrent_events(num_coroutines, events_per_coroutine=4096):
+  c = async_client.AsyncVARZClient()
+  await c.setup()
+  start_time = time.time()
+  await asyncio.gather(*[event_loop_worker(c, events_per_coroutine)
+                         for x in range(num_coroutines)])
+  elapsed_seconds = time.time() - start_time
+  num_events = num_coroutines * events_per_coroutine
+  print("%5d coroutines: %0.2fs; %0.2f events per sec" % (
+      num_coroutines, elapsed_seconds, num_events / elapsed_seconds))
+  await c.close()
+
+
+def main():
+  for num_coroutines in [1, 16, 256, 1024]:
+    asyncio.run(benchmark_concurrent_events(num_coroutines))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,120 @@
+'''asyncio flavour of varz_client.client.VARZClient for services that run on an event loop. Requires
+Python 3, so it lives outside the Python 2 varz_client package and only shares its utils module.'''
+import asyncio
+try:
+  import simplejson as json
+except ImportError:
+  import json
+import socket
+
+try:
+  from varz_client import utils
+except ImportError:
+  # Run from a source checkout, where the varz_client modules are top level
+  import utils
+
+
+class _DiscardingDatagramProtocol(asyncio.DatagramProtocol):
+  '''The daemon never answers on UDP; we only need the transport'''
+  def error_received(self, exc):
+    pass
+
+
+class AsyncVARZClient(object):
+  MODE_TCP = utils.MODE_TCP
+  MODE_UDP = utils.MODE_UDP
+  MAX_NAME_LEN = utils.MAX_NAME_LEN
+
+  def __init__(self, hostname='localhost', udp_port=4447, tcp_port=14447):
+    self.hostname = hostname
+    self.udp_port = udp_port
+    self.tcp_port = tcp_port
+    self.udp_transport = None
+    self.host_ip = None
+    self.tcp_command_lock = None
+    self.tcp_command_writer = None
+
+  async def setup(self):
+    '''Resolve the hostname without blocking the loop and open the UDP transport'''
+    loop = asyncio.get_running_loop()
+    addr_info = await loop.getaddrinfo(self.hostname, self.udp_port, family=socket.AF_INET,
+                                       type=socket.SOCK_DGRAM)
+    self.host_ip = addr_info[0][4][0]
+    self.udp_transport, _ = await loop.create_datagram_endpoint(
+        _DiscardingDatagramProtocol, remote_addr=(self.host_ip, self.udp_port))
+    self.tcp_command_lock = asyncio.Lock()
+
+  async def close(self):
+    if self.udp_transport is not None:
+      self.udp_transport.close()
+      self.udp_transport = None
+    if self.tcp_command_writer is not None:
+      self.tcp_command_writer.close()
+      self.tcp_command_writer = None
+
+  async def counter_increment(self, counter_name, amt=1, time=None, mode=None):
+    '''Same arguments as VARZClient.counter_increment. UDP sends never wait on the network.'''
+    counter_name, time, mode = utils.defaults_for_name_time_and_mode(counter_name, time, mode)
+    sec_since_epoch = utils.datetime_to_sec_since_epoch(time)
+    command = "MHTCOUNTERADD %s %d %d;" % (counter_name, sec_since_epoch, amt)
+    await self._send_with_mode(command.encode("utf-8"), mode)
+
+  async def sampler_add(self, sampler_name, value, time=None, mode=None):
+    '''Same arguments as VARZClient.sampler_add. UDP sends never wait on the network.'''
+    sampler_name, time, mode = utils.defaults_for_name_time_and_mode(sampler_name, time, mode)
+    sec_since_epoch = utils.datetime_to_sec_since_epoch(time)
+    command = "MHTSAMPLEADD %s %d %d;" % (sampler_name, sec_since_epoch, value)
+    await self._send_with_mode(command.encode("utf-8"), mode)
+
+  async def all_dump(self):
+    '''Execute the ALLDUMPJSON command over its own TCP connection. Decoding runs in the default
+       executor so a large dump doesn't stall other coroutines.'''
+    return await self._send_and_receive_tcp_json(b"ALLDUMPJSON;")
+
+  async def all_list(self):
+    '''Execute the ALLLISTJSON command
+    Returns: {'mhtcounters': [name1, name2...], 'mht_samplers': [name1, name2...]}'''
+    return await self._send_and_receive_tcp_json(b"ALLLISTJSON;")
+
+  async def all_flush(self):
+    '''Execute the ALLFLUSH command. This command will flush everything on the varz server, so be
+       very careful when calling it'''
+    await self._send_and_receive_tcp_command(b"ALLFLUSH;")
+
+  async def _send_with_mode(self, command_bytes, mode):
+    if mode == AsyncVARZClient.MODE_UDP:
+      self.udp_transport.sendto(command_bytes)
+    else:
+      await self._send_tcp_command(command_bytes)
+
+  async def _send_tcp_command(self, command_bytes):
+    '''Fire-and-forget commands share one long-lived stream, reconnecting once if it was dropped'''
+    async with self.tcp_command_lock:
+      if self.tcp_command_writer is None or self.tcp_command_writer.is_closing():
+        self.tcp_command_writer = await self._open_tcp_connection()
+      try:
+        self.tcp_command_writer.write(command_bytes)
+        await self.tcp_command_writer.drain()
+      except (ConnectionError, OSError):
+        self.tcp_command_writer.close()
+        self.tcp_command_writer = await self._open_tcp_connection()
+        self.tcp_command_writer.write(command_bytes)
+        await self.tcp_command_writer.drain()
+
+  async def _open_tcp_connection(self):
+    _, writer = await asyncio.open_connection(self.host_ip or self.hostname, self.tcp_port)
+    return writer
+
+  async def _send_and_receive_tcp_command(self, command_bytes):
+    reader, writer = await asyncio.open_connection(self.host_ip or self.hostname, self.tcp_port)
+    try:
+      writer.write(command_bytes)
+      await writer.drain()
+      return await reader.read()
+    finally:
+      writer.close()
+
+  async def _send_and_receive_tcp_json(self, command_bytes):
+    recved = await self._send_and_receive_tcp_command(command_bytes)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, json.loads, recved)